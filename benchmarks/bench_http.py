@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+End-to-end HTTP benchmark of httpkom, with a jskom-like workload.
+
+httpkom is run with Hypercorn in a separate process, against the fake
+LysKOM server in fakekom.py (which runs in the benchmark process,
+together with the virtual users). Each virtual user does what jskom
+does: creates a session, logs in, lists its memberships and unread
+conferences, and then, until the time is up, reads the unread texts
+in a conference and marks them as read, now and then writing a
+comment. When there is nothing left to read it sets some texts as
+unread again.
+
+Reported per route: number of requests, errors, latency (p50, p90,
+p99, max) and the number of LysKOM requests per HTTP request (each
+virtual user has its own LysKOM session, so the fake server can count
+them). Also the throughput and the CPU time of the httpkom process per
+request.
+
+The results are saved as JSON, and can be compared with an earlier
+run with --compare. With --capture, httpkom captures the requests (see
+replay.py).
+
+The event loop and the Hypercorn settings of httpkom can be chosen
+with the same options as for python3 -m httpkom (--loop, --keep-alive,
+--backlog and --http2-max-concurrent-streams). With --http2 the
+virtual users use HTTP/2 without TLS (h2c), and with
+--http2-connections N they share N connections, on which their
+requests are multiplexed, like the parallel requests from a jskom
+page.
+
+Usage (from the top directory)::
+
+  PYTHONPATH=. python3 benchmarks/bench_http.py [--users 20] [--duration 20] [--latency 0.001] \\
+      [--loop auto] [--http2 [--http2-connections 1]] \\
+      [--output results.json] [--compare old-results.json]
+
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import h11
+import h2.config
+import h2.connection
+import h2.events
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakekom
+
+
+SERVER_ID = 'fakekom'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class HttpConnection(object):
+    """A minimal HTTP/1.1 client connection with keep-alive, enough
+    for the benchmark (h11 is a dependency of Hypercorn, so it is
+    always there).
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._conn = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._conn = h11.Connection(h11.CLIENT)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def request(self, method, path, headers=(), body=None):
+        """Returns (status code, response headers, response body)."""
+        if self._conn is None or self._conn.our_state is not h11.IDLE:
+            await self.close()
+            await self._connect()
+        headers = [ ('Host', '{}:{}'.format(self.host, self.port)) ] + list(headers)
+        if body is not None:
+            headers.append(('Content-Type', 'application/json'))
+            headers.append(('Content-Length', str(len(body))))
+        data = self._conn.send(h11.Request(method=method, target=path, headers=headers))
+        if body is not None:
+            data += self._conn.send(h11.Data(data=body))
+        data += self._conn.send(h11.EndOfMessage())
+        self._writer.write(data)
+
+        response = None
+        chunks = []
+        while True:
+            event = self._conn.next_event()
+            if event is h11.NEED_DATA:
+                received = await self._reader.read(65536)
+                self._conn.receive_data(received)
+            elif isinstance(event, h11.Response):
+                response = event
+            elif isinstance(event, h11.Data):
+                chunks.append(event.data)
+            elif isinstance(event, h11.EndOfMessage):
+                break
+            elif isinstance(event, h11.ConnectionClosed):
+                raise ConnectionError("Connection closed by httpkom")
+        if self._conn.our_state is h11.DONE and self._conn.their_state is h11.DONE:
+            self._conn.start_next_cycle()
+        return response.status_code, dict(response.headers), b"".join(chunks)
+
+
+class Http2Connection(object):
+    """A minimal HTTP/2 client connection, without TLS and with prior
+    knowledge (h2c), on which concurrent requests are multiplexed (h2
+    is a dependency of Hypercorn too).
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._writer = None
+        self._conn = None
+        self._receiver = None
+        self._connecting = None
+        self._streams = {} # stream id -> [ future, status code, headers, chunks ]
+        self._stream_closed = asyncio.Event()
+
+    async def _connect(self):
+        reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self._conn.initiate_connection()
+        self._writer.write(self._conn.data_to_send())
+        self._receiver = asyncio.ensure_future(self._receive(reader))
+
+    async def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._conn = None
+        self._fail(ConnectionError("Connection closed"))
+
+    def _fail(self, exception):
+        for future, _, _, _ in self._streams.values():
+            if not future.done():
+                future.set_exception(exception)
+        self._streams.clear()
+
+    async def _receive(self, reader):
+        conn = self._conn
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                self._conn = None
+                self._fail(ConnectionError("Connection closed by httpkom"))
+                return
+            for event in conn.receive_data(data):
+                stream = self._streams.get(getattr(event, 'stream_id', None))
+                if isinstance(event, h2.events.ResponseReceived):
+                    headers = dict(event.headers)
+                    stream[1] = int(headers.pop(':status'))
+                    stream[2] = headers
+                elif isinstance(event, h2.events.DataReceived):
+                    stream[3].append(event.data)
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    del self._streams[event.stream_id]
+                    stream[0].set_result((stream[1], stream[2], b"".join(stream[3])))
+                    self._stream_closed.set()
+                elif isinstance(event, h2.events.StreamReset):
+                    del self._streams[event.stream_id]
+                    stream[0].set_exception(ConnectionError("Stream reset by httpkom"))
+                    self._stream_closed.set()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    self._conn = None
+                    self._fail(ConnectionError("Connection closed by httpkom"))
+                    return
+            self._writer.write(conn.data_to_send())
+
+    async def request(self, method, path, headers=(), body=None):
+        """Returns (status code, response headers, response body)."""
+        if self._conn is None:
+            # The requests that are made at the same time share the
+            # new connection.
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+            try:
+                await asyncio.shield(self._connecting)
+            finally:
+                self._connecting = None
+        while self._conn.open_outbound_streams >= self._conn.remote_settings.max_concurrent_streams:
+            self._stream_closed.clear()
+            await self._stream_closed.wait()
+        headers = [ (':method', method), (':scheme', 'http'), (':path', path),
+                    (':authority', '{}:{}'.format(self.host, self.port)) ] + \
+                  [ (name.lower(), value) for name, value in headers ]
+        if body is not None:
+            headers.append(('content-type', 'application/json'))
+            headers.append(('content-length', str(len(body))))
+        stream_id = self._conn.get_next_available_stream_id()
+        self._conn.send_headers(stream_id, headers, end_stream=body is None)
+        if body is not None:
+            # The bodies are smaller than the initial flow control
+            # window.
+            self._conn.send_data(stream_id, body, end_stream=True)
+        future = asyncio.get_running_loop().create_future()
+        self._streams[stream_id] = [ future, None, None, [] ]
+        self._writer.write(self._conn.data_to_send())
+        return await future
+
+
+class Results(object):
+    def __init__(self):
+        self.latencies = collections.defaultdict(list) # route -> [seconds]
+        self.errors = collections.Counter() # route -> count
+        self.lyskom_calls = collections.Counter() # route -> count
+
+    def add(self, route, seconds, ok, lyskom_calls):
+        self.latencies[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+        self.lyskom_calls[route] += lyskom_calls
+
+
+class VirtualUser(object):
+    def __init__(self, user_no, pers_no, passwd, args, fake_server, results, rnd, http):
+        self.user_no = user_no
+        self.pers_no = pers_no
+        self.passwd = passwd
+        self.args = args
+        self.fake_server = fake_server
+        self.results = results
+        self.rnd = rnd
+        self.http = http
+        self.headers = []
+        self.session_no = None
+        self.conf_nos = []
+
+    async def call(self, route, method, path, json_body=None, expected=(200, 201, 204)):
+        body = None if json_body is None else json.dumps(json_body).encode('utf-8')
+        calls_before = self.fake_server.session_calls[self.session_no]
+        t0 = time.perf_counter()
+        status, _, response_body = await self.http.request(
+            method, '/' + SERVER_ID + path, self.headers, body)
+        t = time.perf_counter() - t0
+        if self.session_no is None:
+            lyskom_calls = 0
+        else:
+            lyskom_calls = self.fake_server.session_calls[self.session_no] - calls_before
+        self.results.add(route, t, status in expected, lyskom_calls)
+        if status not in expected:
+            return None
+        if len(response_body) == 0:
+            return {}
+        return json.loads(response_body)
+
+    async def start(self):
+        session = await self.call(
+            'POST /sessions/', 'POST', '/sessions/',
+            dict(client=dict(name='bench_http', version='1.0')))
+        self.headers = [ ('Httpkom-Connection', session['connection_id']) ]
+        # Calls made while creating the session are not counted, as
+        # the session number isn't known until now.
+        self.session_no = session['session_no']
+        await self.call('POST /sessions/current/login', 'POST', '/sessions/current/login',
+                        dict(pers_no=self.pers_no, passwd=self.passwd))
+        memberships = await self.call(
+            'GET /persons/<pers_no>/memberships/', 'GET',
+            '/persons/{}/memberships/'.format(self.pers_no))
+        self.conf_nos = [ m['conference']['conf_no'] for m in memberships['memberships'] ]
+
+    async def read_conference(self):
+        unreads = await self.call(
+            'GET /persons/<pers_no>/memberships/unread/', 'GET',
+            '/persons/{}/memberships/unread/'.format(self.pers_no))
+        if unreads is None:
+            return
+        unreads = [ u for u in unreads['list'] if u['no_of_unread'] > 0 ]
+        if len(unreads) == 0:
+            # All read, so start over with some of them.
+            await self.call('POST /persons/current/memberships/<conf_no>/unread', 'POST',
+                            '/persons/current/memberships/{}/unread'.format(
+                                self.rnd.choice(self.conf_nos)),
+                            dict(no_of_unread=self.rnd.randint(5, 30)))
+            return
+
+        unread = unreads[0]
+        await self.call('GET /persons/<pers_no>/memberships/<conf_no>', 'GET',
+                        '/persons/{}/memberships/{}'.format(self.pers_no, unread['conf_no']))
+        for text_no in unread['unread_texts'][:self.args.texts_per_conference]:
+            text = await self.call('GET /texts/<text_no>', 'GET', '/texts/{}'.format(text_no))
+            if text is not None and self.rnd.random() < self.args.post_ratio:
+                await self.call('POST /texts/', 'POST', '/texts/', dict(
+                    subject=text['subject'],
+                    body="Håller med.\n\n" + " ".join(self.rnd.choices(fakekom._WORDS, k=40)),
+                    content_type='text/x-kom-basic',
+                    recipient_list=[ dict(type='to', recpt=dict(conf_no=unread['conf_no'])) ],
+                    comment_to_list=[ dict(type='comment', text_no=text_no) ]))
+            await self.call('PUT /texts/<text_no>/read-marking', 'PUT',
+                            '/texts/{}/read-marking'.format(text_no))
+            if self.args.think_time > 0:
+                await asyncio.sleep(self.rnd.expovariate(1 / self.args.think_time))
+
+    async def stop(self):
+        await self.call('POST /sessions/current/logout', 'POST', '/sessions/current/logout')
+        await self.call('DELETE /sessions/<session_no>', 'DELETE', '/sessions/0')
+
+    async def run(self, deadline):
+        await self.start()
+        while time.monotonic() < deadline:
+            await self.read_conference()
+        await self.stop()
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def summarize(results, seconds, cpu_seconds):
+    routes = {}
+    total_requests = 0
+    total_calls = 0
+    for route, latencies in sorted(results.latencies.items()):
+        latencies.sort()
+        routes[route] = dict(
+            requests=len(latencies),
+            errors=results.errors[route],
+            mean_ms=1000 * sum(latencies) / len(latencies),
+            p50_ms=1000 * percentile(latencies, 50),
+            p90_ms=1000 * percentile(latencies, 90),
+            p99_ms=1000 * percentile(latencies, 99),
+            max_ms=1000 * latencies[-1],
+            lyskom_calls_per_request=results.lyskom_calls[route] / len(latencies))
+        total_requests += len(latencies)
+        total_calls += results.lyskom_calls[route]
+    all_latencies = sorted(t for latencies in results.latencies.values() for t in latencies)
+    return dict(
+        requests=total_requests,
+        errors=sum(results.errors.values()),
+        seconds=seconds,
+        requests_per_second=total_requests / seconds,
+        p50_ms=1000 * percentile(all_latencies, 50),
+        p99_ms=1000 * percentile(all_latencies, 99),
+        lyskom_calls_per_request=total_calls / max(total_requests, 1),
+        httpkom_cpu_seconds=cpu_seconds,
+        httpkom_cpu_ms_per_request=None if cpu_seconds is None else
+            1000 * cpu_seconds / max(total_requests, 1),
+        routes=routes)
+
+
+def print_summary(summary):
+    print("{:<52} {:>7} {:>5} {:>8} {:>8} {:>8} {:>8} {:>7}".format(
+        "Route", "Reqs", "Errs", "p50 ms", "p90 ms", "p99 ms", "max ms", "LysKOM"))
+    for route, r in summary['routes'].items():
+        print("{:<52} {:>7} {:>5} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>7.2f}".format(
+            route, r['requests'], r['errors'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+            r['max_ms'], r['lyskom_calls_per_request']))
+    print()
+    print("{} requests ({} errors) in {:.1f} s: {:.1f} requests/s, p50 {:.2f} ms, "
+          "p99 {:.2f} ms, {:.2f} LysKOM requests per request".format(
+              summary['requests'], summary['errors'], summary['seconds'],
+              summary['requests_per_second'], summary['p50_ms'], summary['p99_ms'],
+              summary['lyskom_calls_per_request']))
+    if summary['httpkom_cpu_seconds'] is not None:
+        print("httpkom CPU time: {:.1f} s, {:.3f} ms per request".format(
+            summary['httpkom_cpu_seconds'], summary['httpkom_cpu_ms_per_request']))
+
+
+def print_comparison(old, new):
+    def change(old_value, new_value):
+        if not old_value:
+            return "      -"
+        return "{:>+6.1f}%".format(100.0 * (new_value - old_value) / old_value)
+
+    print()
+    print("Compared with {} ({}):".format(old['meta'].get('commit'), old['meta'].get('date')))
+    print("{:<52} {:>8} {:>8} {:>8}".format("Route", "p50", "p99", "LysKOM"))
+    for route, r in new['summary']['routes'].items():
+        o = old['summary']['routes'].get(route)
+        if o is None:
+            continue
+        print("{:<52} {:>8} {:>8} {:>8}".format(
+            route, change(o['p50_ms'], r['p50_ms']), change(o['p99_ms'], r['p99_ms']),
+            change(o['lyskom_calls_per_request'], r['lyskom_calls_per_request'])))
+    o, s = old['summary'], new['summary']
+    print("Throughput {}, p50 {}, p99 {}, httpkom CPU per request {}".format(
+        change(o['requests_per_second'], s['requests_per_second']),
+        change(o['p50_ms'], s['p50_ms']), change(o['p99_ms'], s['p99_ms']),
+        change(o['httpkom_cpu_ms_per_request'], s['httpkom_cpu_ms_per_request'])))
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port(host):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_httpkom(host, port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("httpkom exited with status {}".format(process.returncode))
+        http = HttpConnection(host, port)
+        try:
+            status, _, _ = await http.request('GET', '/')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            await http.close()
+        await asyncio.sleep(0.1)
+    raise RuntimeError("httpkom did not start")
+
+
+# Options for the HTTP server and event loop, passed on to httpkom
+# (see httpkom.__main__).
+SERVER_OPTIONS = ('loop', 'keep_alive', 'backlog', 'http2_max_concurrent_streams')
+
+def add_server_arguments(parser):
+    parser.add_argument('--loop', choices=[ 'auto', 'asyncio', 'uvloop' ], default='auto',
+                        help='Event loop in httpkom: uvloop, asyncio, or auto for uvloop '
+                        'if it is installed')
+    parser.add_argument('--keep-alive', type=float, default=None,
+                        help='Seconds httpkom keeps idle connections open')
+    parser.add_argument('--backlog', type=int, default=None, help='Listen backlog of httpkom')
+    parser.add_argument('--http2-max-concurrent-streams', type=int, default=None,
+                        help='Max concurrent requests on each HTTP/2 connection')
+
+
+def start_httpkom(args, lyskom_port, capture=None):
+    config = tempfile.NamedTemporaryFile('w', suffix='.cfg', prefix='bench_http-', delete=False)
+    with config:
+        config.write("HTTPKOM_LYSKOM_SERVERS = [ ({!r}, 'Fake LysKOM', {!r}, {!r}) ]\n".format(
+            SERVER_ID, args.host, lyskom_port))
+        if capture is not None:
+            config.write("HTTPKOM_CAPTURE_FILE = {!r}\n".format(os.path.abspath(capture)))
+    server_args = []
+    for name in SERVER_OPTIONS:
+        value = getattr(args, name, None)
+        if value is not None:
+            server_args += [ '--' + name.replace('_', '-'), str(value) ]
+    process = subprocess.Popen(
+        [ sys.executable, os.path.abspath(__file__), '--serve-httpkom', config.name,
+          '--host', args.host, '--httpkom-port', str(args.httpkom_port) ] + server_args)
+    return process, config.name
+
+
+def stop_httpkom(process):
+    """Stop httpkom and return the CPU time it used."""
+    process.send_signal(signal.SIGINT)
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return None
+    process.returncode = status
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def serve_httpkom(args):
+    """Run httpkom with Hypercorn (in the child process), like
+    python3 -m httpkom.
+    """
+    import logging
+    from hypercorn.asyncio import serve
+    from httpkom import app, init_app
+    from httpkom.__main__ import make_hypercorn_config, use_event_loop
+
+    # Logging every request would be measured too.
+    logging.basicConfig(level=logging.WARNING)
+    os.environ['HTTPKOM_SETTINGS'] = args.serve_httpkom
+    init_app(app)
+    config = make_hypercorn_config(argparse.Namespace(
+        host=args.host, port=args.httpkom_port, hypercorn_config=None, keep_alive=args.keep_alive,
+        backlog=args.backlog, http2_max_concurrent_streams=args.http2_max_concurrent_streams,
+        certfile=None, keyfile=None, http2=True))
+    use_event_loop(args.loop)
+    try:
+        asyncio.run(serve(app, config))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_benchmark(args):
+    t0 = time.time()
+    dataset = fakekom.Dataset(persons=args.persons, conferences=args.conferences,
+                              texts=args.texts, memberships=args.memberships, seed=args.seed)
+    print("Generated {} persons, {} conferences and {} texts in {:.1f} s".format(
+        len(dataset.persons), len(dataset.conferences), len(dataset.texts), time.time() - t0))
+    fake_server = fakekom.FakeKomServer(dataset, latency=args.latency)
+    lyskom_port = await fake_server.start(args.host)
+
+    process, config_path = start_httpkom(args, lyskom_port, args.capture)
+    cpu_seconds = None
+    try:
+        await wait_for_httpkom(args.host, args.httpkom_port, process)
+        rnd = random.Random(args.seed)
+        results = Results()
+        if args.http2 and args.http2_connections > 0:
+            shared = [ Http2Connection(args.host, args.httpkom_port)
+                       for _ in range(args.http2_connections) ]
+            connections = [ shared[i % len(shared)] for i in range(args.users) ]
+        else:
+            connection_class = Http2Connection if args.http2 else HttpConnection
+            connections = [ connection_class(args.host, args.httpkom_port)
+                            for _ in range(args.users) ]
+        users = [ VirtualUser(i, dataset.pers_nos[i % len(dataset.pers_nos)], 'test', args,
+                              fake_server, results, random.Random(rnd.random()), connections[i])
+                  for i in range(args.users) ]
+        print("{} users for {} s, LysKOM latency {} ms, {} over {} connections, {} event loop "
+              "in httpkom".format(args.users, args.duration, args.latency * 1000,
+                                  'HTTP/2' if args.http2 else 'HTTP/1.1',
+                                  len(set(map(id, connections))), args.loop))
+        t0 = time.monotonic()
+        await asyncio.gather(*[ u.run(t0 + args.duration) for u in users ])
+        seconds = time.monotonic() - t0
+        for http in set(connections):
+            await http.close()
+    finally:
+        cpu_seconds = stop_httpkom(process)
+        os.unlink(config_path)
+        await fake_server.stop()
+    return summarize(results, seconds, cpu_seconds), dict(fake_server.calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='Number of virtual users')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to run')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Seconds that the fake LysKOM server delays each reply')
+    parser.add_argument('--think-time', type=float, default=0,
+                        help='Mean seconds between reading texts (default: no pauses)')
+    parser.add_argument('--texts-per-conference', type=int, default=10,
+                        help='Texts to read in a conference before checking for unread again')
+    parser.add_argument('--post-ratio', type=float, default=0.05,
+                        help='Fraction of the read texts that get a comment')
+    parser.add_argument('--persons', type=int, default=100)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--memberships', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--httpkom-port', type=int, default=None)
+    parser.add_argument('--output', default=None,
+                        help='File to save the results in (default: benchmarks/results/)')
+    parser.add_argument('--compare', default=None, help='Results from an earlier run')
+    parser.add_argument('--capture', default=None,
+                        help='Capture the requests to this file (for replay.py)')
+    parser.add_argument('--http2', action='store_true',
+                        help='Use HTTP/2 without TLS (h2c) instead of HTTP/1.1')
+    parser.add_argument('--http2-connections', type=int, default=0,
+                        help='With --http2, the number of connections that the users share '
+                        '(default: one per user)')
+    add_server_arguments(parser)
+    parser.add_argument('--serve-httpkom', metavar='CONFIG', default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_httpkom is not None:
+        serve_httpkom(args)
+        return
+    if args.httpkom_port is None:
+        args.httpkom_port = free_port(args.host)
+
+    summary, lyskom_calls = asyncio.run(run_benchmark(args))
+    print()
+    print_summary(summary)
+
+    commit = git_commit()
+    results = dict(
+        meta=dict(commit=commit, date=datetime.datetime.now().isoformat(timespec='seconds'),
+                  python=platform.python_version(), platform=platform.platform(),
+                  args=dict((k, v) for k, v in vars(args).items() if k != 'serve_httpkom')),
+        summary=summary,
+        lyskom_calls=dict((str(call_no), n) for call_no, n in sorted(lyskom_calls.items())))
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'http-{}-{}.json'.format(
+            commit or 'unknown', time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results saved in {}".format(output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
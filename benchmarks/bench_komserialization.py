@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Micro-benchmarks for komserialization.to_dict(), per object type and
+list size, with memory use.
+
+The objects (texts, memberships, conferences, micro conferences and
+recipients) are the same pylyskom objects that httpkom gets from
+AioKomSession, made by parsing what the fake LysKOM server in
+fakekom.py sends. The session is a fake with the names and text stats
+in memory, so only the serialization is measured, not any lookups.
+
+Each case is timed cold (the fragment caches emptied and a new
+session each time, like the first time an object is serialized) and
+warm (the caches kept, like when the same objects are serialized
+again). The memory use is measured in a separate run with
+tracemalloc: the peak while serializing and the size of the result,
+per object.
+
+Usage (from the top directory)::
+
+  PYTHONPATH=. python3 benchmarks/bench_komserialization.py [--sizes 1,10,100,1000] \\
+      [--repeat 20] [--types text,membership] [--output results.json]
+
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from pylyskom import datatypes
+from pylyskom.aio import AioReceiveBuffer
+from pylyskom.komsession import (
+    KomAuxItem,
+    KomConference,
+    KomConferenceName,
+    KomMembership,
+    KomPersonName,
+    KomText,
+    KomUConference,
+)
+
+from httpkom import fragments
+from httpkom.komserialization import to_dict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakekom
+
+
+def parse(data_type, data):
+    buf = AioReceiveBuffer()
+    buf.append(data + b"\n")
+    return data_type.parse(buf)
+
+
+class FakeSession(object):
+    """The lookups that komserialization makes, from memory."""
+
+    def __init__(self, dataset, text_stats):
+        self._dataset = dataset
+        # Shared by the sessions, as parsing them is not part of the
+        # serialization.
+        self._text_stats = text_stats
+
+    async def get_conf_name(self, conf_no):
+        return conf_name(self._dataset, conf_no)
+
+    async def get_person_name(self, pers_no):
+        return person_name(self._dataset, pers_no)
+
+    async def get_text_stat(self, text_no):
+        text_stat = self._text_stats.get(text_no)
+        if text_stat is None:
+            text_stat = parse(datatypes.TextStat, self._dataset.texts[text_no].encode_stat())
+            self._text_stats[text_no] = text_stat
+        return text_stat
+
+
+def conf_name(dataset, conf_no):
+    return KomConferenceName(conf_no, dataset.conferences[conf_no].name.decode('latin1'))
+
+def person_name(dataset, pers_no):
+    return KomPersonName(pers_no, dataset.conferences[pers_no].name.decode('latin1'))
+
+
+def make_texts(dataset, n):
+    texts = []
+    for text_no in range(1, n + 1):
+        text = dataset.texts[text_no]
+        text_stat = parse(datatypes.TextStat, text.encode_stat())
+        author = person_name(dataset, text.author)
+        aux_items = [ KomAuxItem(ai, author) for ai in text_stat.aux_items ]
+        texts.append(KomText(text_no, text.contents, text_stat=text_stat, aux_items=aux_items,
+                             author=author))
+    return texts
+
+def make_memberships(dataset, n):
+    memberships = []
+    for person in dataset.persons.values():
+        for position, m in enumerate(person.memberships):
+            membership = parse(datatypes.Membership11, m.encode(position, True))
+            conf = dataset.conferences[m.conf_no]
+            memberships.append(KomMembership(
+                person.pers_no, membership=membership,
+                added_by=person_name(dataset, m.added_by),
+                conference=KomUConference(
+                    m.conf_no, uconf=parse(datatypes.UConference, conf.encode_micro()))))
+            if len(memberships) == n:
+                return memberships
+    return memberships
+
+def make_conferences(dataset, n):
+    conferences = []
+    for conf in list(dataset.conferences.values())[:n]:
+        conferences.append(KomConference(
+            conf.conf_no, conf=parse(datatypes.Conference, conf.encode()),
+            creator=person_name(dataset, conf.creator) if conf.creator else None,
+            supervisor=conf_name(dataset, conf.supervisor) if conf.supervisor else None,
+            permitted_submitters=None, super_conf=None, aux_items=[]))
+    return conferences
+
+def make_uconferences(dataset, n):
+    return [ KomUConference(conf.conf_no, uconf=parse(datatypes.UConference, conf.encode_micro()))
+             for conf in list(dataset.conferences.values())[:n] ]
+
+def make_recipients(dataset, n):
+    recipients = []
+    for text_no in range(1, len(dataset.texts) + 1):
+        text_stat = parse(datatypes.TextStat, dataset.texts[text_no].encode_stat())
+        recipients.extend(text_stat.misc_info.recipient_list)
+        if len(recipients) >= n:
+            break
+    return recipients[:n]
+
+
+TYPES = dict(
+    text=make_texts,
+    membership=make_memberships,
+    conference=make_conferences,
+    uconference=make_uconferences,
+    recipient=make_recipients,
+)
+
+
+def clear_caches():
+    fragments._fragments.clear()
+
+
+async def _noop():
+    pass
+
+def loop_overhead(loop, repeat):
+    """The time for running a coroutine in the loop, which is not
+    part of the serialization.
+    """
+    best = None
+    for _ in range(repeat * 10):
+        t0 = time.perf_counter()
+        loop.run_until_complete(_noop())
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench_time(loop, dataset, objects, repeat, cold):
+    text_stats = {}
+    session = FakeSession(dataset, text_stats)
+    loop.run_until_complete(to_dict(objects, session)) # warm up
+    best = None
+    # Like timeit, don't let the garbage collector disturb the
+    # timings.
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            if cold:
+                clear_caches()
+                session = FakeSession(dataset, text_stats)
+            t0 = time.perf_counter()
+            loop.run_until_complete(to_dict(objects, session))
+            t = time.perf_counter() - t0
+            best = t if best is None else min(best, t)
+    finally:
+        gc.enable()
+    return best
+
+
+def bench_memory(loop, dataset, objects):
+    text_stats = {}
+    loop.run_until_complete(to_dict(objects, FakeSession(dataset, text_stats)))
+    clear_caches()
+    session = FakeSession(dataset, text_stats)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = loop.run_until_complete(to_dict(objects, session))
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    # The result includes the fragments and the session's fragments.
+    return peak - before, after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1,10,100,1000',
+                        help='Comma separated list sizes')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--types', default=','.join(TYPES),
+                        help='Comma separated object types: ' + ', '.join(TYPES))
+    parser.add_argument('--output', default=None, help='File to save the results in (JSON)')
+    args = parser.parse_args()
+
+    sizes = [ int(s) for s in args.sizes.split(',') ]
+    dataset = fakekom.Dataset(persons=100, conferences=max(sizes), texts=max(sizes) * 2,
+                              memberships=20, seed=1)
+    loop = asyncio.new_event_loop()
+    overhead = loop_overhead(loop, args.repeat)
+    print("Event loop overhead per run: {:.2f} us (subtracted)".format(overhead * 1e6))
+    results = []
+    print("{:<12} {:>6} {:>12} {:>12} {:>12} {:>14}".format(
+        "Type", "Size", "cold us/obj", "warm us/obj", "peak KB", "result B/obj"))
+    try:
+        for type_name in args.types.split(','):
+            for size in sizes:
+                objects = TYPES[type_name](dataset, size)
+                n = len(objects)
+                cold = bench_time(loop, dataset, objects, args.repeat, cold=True) - overhead
+                warm = bench_time(loop, dataset, objects, args.repeat, cold=False) - overhead
+                peak, retained = bench_memory(loop, dataset, objects)
+                result = dict(type=type_name, size=n, cold_us=cold * 1e6 / n,
+                              warm_us=warm * 1e6 / n, peak_bytes=peak,
+                              result_bytes_per_object=retained / n)
+                results.append(result)
+                print("{:<12} {:>6} {:>12.2f} {:>12.2f} {:>12.1f} {:>14.0f}".format(
+                    type_name, n, result['cold_us'], result['warm_us'], peak / 1024,
+                    result['result_bytes_per_object']))
+    finally:
+        loop.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(repeat=args.repeat, loop_overhead_us=overhead * 1e6, results=results),
+                      f, indent=2)
+        print("Results saved in {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
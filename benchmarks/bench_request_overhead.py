@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Benchmark for the per-request overhead in httpkom's request pipeline
+(the server lookup, the CORS headers and the server list on /).
+
+Compares the hooks with the versions that read the config on every
+request (kept here as a baseline), and measures whole requests through
+Quart's test client, for / and for a view in the blueprint that does
+nothing (no LysKOM server is needed).
+
+Usage (from the top directory)::
+
+  PYTHONPATH=. python3 benchmarks/bench_request_overhead.py [--calls 10000] [--requests 2000]
+
+"""
+
+import argparse
+import asyncio
+import gc
+import time
+
+from quart import request, jsonify, g, abort, current_app
+
+import httpkom
+from httpkom import app, bp, init_app, Server
+
+
+ORIGIN = 'http://localhost:8000'
+
+
+@bp.route('/benchmark-noop')
+async def benchmark_noop():
+    return jsonify(server_id=g.server.id)
+
+
+# The old hooks, that used the config directly.
+
+def old_pull_server_id(endpoint, values):
+    _servers = dict()
+    for i, server in enumerate(current_app.config['HTTPKOM_LYSKOM_SERVERS']):
+        _servers[server[0]] = Server(server[0], i, server[1], server[2], server[3])
+    server_id = values.pop('server_id')
+    if server_id in _servers:
+        g.server = _servers[server_id]
+    else:
+        abort(404)
+
+def old_allow_crossdomain(resp):
+    if 'Origin' in request.headers:
+        h = resp.headers
+        allowed_origins = app.config['HTTPKOM_CROSSDOMAIN_ALLOWED_ORIGINS']
+        origin = request.headers['Origin']
+        if (allowed_origins == '*') or ('*' in allowed_origins):
+            h['Access-Control-Allow-Origin'] = '*'
+            is_allowed = True
+        elif origin in allowed_origins:
+            h['Access-Control-Allow-Origin'] = origin
+            is_allowed = True
+        else:
+            h['Access-Control-Allow-Origin'] = 'null'
+            is_allowed = False
+        if is_allowed:
+            h['Access-Control-Allow-Methods'] = \
+                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_ALLOW_METHODS'])
+            h['Access-Control-Max-Age'] = \
+                str(app.config['HTTPKOM_CROSSDOMAIN_MAX_AGE'])
+            h['Access-Control-Allow-Headers'] = \
+                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_ALLOW_HEADERS'])
+            h['Access-Control-Expose-Headers'] = \
+                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_EXPOSE_HEADERS'])
+    return resp
+
+async def old_index():
+    _servers = dict()
+    for i, server in enumerate(current_app.config['HTTPKOM_LYSKOM_SERVERS']):
+        _servers[server[0]] = Server(server[0], i, server[1], server[2], server[3])
+    servers = dict([ (s.id, s.to_dict()) for s in _servers.values() ])
+    return jsonify(servers)
+
+
+def timed(fn, n):
+    # Like timeit, don't let the garbage collector disturb the timings.
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        fn(n)
+        return time.perf_counter() - t0
+    finally:
+        gc.enable()
+
+async def atimed(fn, n):
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        await fn(n)
+        return time.perf_counter() - t0
+    finally:
+        gc.enable()
+
+
+def report(name, t, n, unit="call"):
+    print("{:<28} {:>10.2f} us/{}".format(name, t * 1e6 / n, unit))
+
+
+async def bench_hooks(calls, server_id):
+    async with app.test_request_context('/{}/benchmark-noop'.format(server_id),
+                                        headers={ 'Origin': ORIGIN }):
+
+        def pull(preprocessor):
+            def run(n):
+                for _ in range(n):
+                    preprocessor('benchmark_noop', { 'server_id': server_id })
+            return run
+
+        def cors(hook):
+            def run(n):
+                # A new response every time, as the hook adds headers.
+                for _ in range(n):
+                    hook(app.response_class(b'{}', mimetype='application/json'))
+            return run
+
+        def index(view):
+            async def run(n):
+                for _ in range(n):
+                    await view()
+            return run
+
+        print("Hooks, {} calls:".format(calls))
+        report("pull_server_id (old)", timed(pull(old_pull_server_id), calls), calls)
+        report("pull_server_id", timed(pull(httpkom.pull_server_id), calls), calls)
+        report("allow_crossdomain (old)", timed(cors(old_allow_crossdomain), calls), calls)
+        report("allow_crossdomain", timed(cors(httpkom.allow_crossdomain), calls), calls)
+        report("index (old)", await atimed(index(old_index), calls), calls)
+        report("index", await atimed(index(httpkom.index), calls), calls)
+
+
+async def bench_requests(requests, server_id):
+    client = app.test_client()
+
+    def get(path):
+        async def run(n):
+            for _ in range(n):
+                response = await client.get(path, headers={ 'Origin': ORIGIN })
+                assert response.status_code == 200
+        return run
+
+    print("Whole requests, {} requests:".format(requests))
+    for path in ('/', '/{}/benchmark-noop'.format(server_id)):
+        await get(path)(10) # warm up
+        report("GET " + path, await atimed(get(path), requests), requests, "request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    init_app(app)
+    server_id = app.config['HTTPKOM_LYSKOM_SERVERS'][0][0]
+    asyncio.run(bench_hooks(args.calls, server_id))
+    asyncio.run(bench_requests(args.requests, server_id))
+
+
+if __name__ == '__main__':
+    main()
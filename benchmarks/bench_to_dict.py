@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Micro-benchmark for the per-object overhead of
+komserialization.to_dict() on membership lists.
+
+Compares to_dict() with the isinstance chain that it used to have
+(kept here as a baseline), and with calling KomMembership_to_dict()
+directly in a loop (no dispatch overhead at all).
+
+Usage (from the top directory)::
+
+  PYTHONPATH=. python3 benchmarks/bench_to_dict.py [--memberships 1000] [--repeat 20]
+
+"""
+
+import argparse
+import asyncio
+import gc
+import time
+
+from pylyskom import datatypes
+from pylyskom.komsession import KomMembership, KomPersonName, KomUConference
+
+from httpkom import komserialization
+from httpkom.komserialization import to_dict, KomMembership_to_dict
+
+
+async def isinstance_to_dict(obj, session=None, fields=None):
+    # The old dispatch: an isinstance chain, and an await per list
+    # element. Only the branches that are reached for memberships
+    # matter for the timing, but they are in the old order.
+    k = komserialization
+    if obj is None:
+        return None
+    elif isinstance(obj, list) or isinstance(obj, tuple):
+        return [ await isinstance_to_dict(el, session, fields) for el in obj ]
+    elif isinstance(obj, k.KomPerson):
+        return k.KomPerson_to_dict(obj)
+    elif isinstance(obj, k.KomPersonName):
+        return k.KomPersonName_to_dict(obj)
+    elif isinstance(obj, k.KomText):
+        return await k.KomText_to_dict(obj, session, fields)
+    elif isinstance(obj, datatypes.MIRecipient):
+        return await k.MIRecipient_to_dict(obj, session)
+    elif isinstance(obj, datatypes.MICommentTo):
+        return await k.MICommentTo_to_dict(obj, session)
+    elif isinstance(obj, datatypes.MICommentIn):
+        return await k.MICommentIn_to_dict(obj, session)
+    elif isinstance(obj, k.KomConferenceName):
+        return k.KomConferenceName_to_dict(obj)
+    elif isinstance(obj, k.KomConference):
+        return k.KomConference_to_dict(obj, fields)
+    elif isinstance(obj, k.KomUConference):
+        return k.KomUConference_to_dict(obj, fields)
+    elif isinstance(obj, k.KomMembership):
+        return k.KomMembership_to_dict(obj)
+    else:
+        return obj
+
+
+def make_memberships(n):
+    memberships = []
+    for i in range(n):
+        uconf = datatypes.UConference()
+        uconf.name = "Conference {}".format(i).encode('latin1')
+        uconf.type = datatypes.ExtendedConfType()
+        uconf.highest_local_no = 1000 + i
+        uconf.nice = 77
+        conference = KomUConference(1000 + i, uconf=uconf)
+        membership = datatypes.Membership(
+            position=i, last_time_read=datatypes.Time(), conference=1000 + i,
+            priority=100, added_by=14506, added_at=datatypes.Time(),
+            membership_type=datatypes.MembershipType())
+        memberships.append(KomMembership(
+            14506, membership=membership, added_by=KomPersonName(14506, "Oskars Testperson"),
+            conference=conference))
+    return memberships
+
+
+def bench(name, fn, memberships, repeat):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(fn(memberships)) # warm up caches
+        best = None
+        # Like timeit, don't let the garbage collector disturb the
+        # timings.
+        gc.disable()
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            loop.run_until_complete(fn(memberships))
+            t = time.perf_counter() - t0
+            best = t if best is None else min(best, t)
+    finally:
+        gc.enable()
+        loop.close()
+    print("{:<20} {:>10.2f} ms {:>10.2f} us/membership".format(
+        name, best * 1000, best * 1e6 / len(memberships)))
+    return best
+
+
+async def direct(memberships):
+    return [ KomMembership_to_dict(m) for m in memberships ]
+
+async def dispatch(memberships):
+    return await to_dict(memberships)
+
+async def isinstance_chain(memberships):
+    return await isinstance_to_dict(memberships)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--memberships', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    memberships = make_memberships(args.memberships)
+    print("{} memberships, best of {}".format(args.memberships, args.repeat))
+    t_direct = bench("direct", direct, memberships, args.repeat)
+    t_dispatch = bench("to_dict", dispatch, memberships, args.repeat)
+    t_isinstance = bench("isinstance chain", isinstance_chain, memberships, args.repeat)
+    print("Dispatch overhead: to_dict {:.2f} us/membership, isinstance chain {:.2f} us/membership".format(
+        (t_dispatch - t_direct) * 1e6 / len(memberships),
+        (t_isinstance - t_direct) * 1e6 / len(memberships)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,900 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+A fake LysKOM server, for benchmarks and load tests of httpkom without
+a real LysKOM server (or any network).
+
+It speaks enough of protocol A for everything that httpkom and
+pylyskom use: sessions, login, persons, conferences, memberships and
+read ranges, unread texts, local to global mapping, texts with comment
+trees, marks, name lookups, creating texts and the async messages for
+new texts and logouts. Other requests get a not-implemented error.
+
+The data is synthetic, generated from a seed, so runs are repeatable.
+Conferences 1-4 are the usual presentation and news conferences, then
+come the persons (all with the same password) and then the other
+conferences. Each person is a member of their own letterbox and of a
+number of other conferences, and has read most of the texts in them.
+
+Latency can be added to every reply, and per call type, to simulate a
+remote server. The replies are delayed, not the handling of the
+requests, so pipelined requests overlap like they would over a real
+network.
+
+Usage (from the top directory)::
+
+  python3 benchmarks/fakekom.py [--port 4894] [--persons 100] [--texts 20000] [--latency 0.002]
+
+and use it as a server in the httpkom config::
+
+  HTTPKOM_LYSKOM_SERVERS = [
+      ('fakekom', 'Fake LysKOM', '127.0.0.1', 4894),
+      ]
+
+It can also be started from Python (FakeKomServer), which is what
+the other benchmarks do.
+"""
+
+import argparse
+import asyncio
+import bisect
+import collections
+import logging
+import random
+import time
+
+from pylyskom import datatypes, errors, requests
+from pylyskom.aio import AioReceiveBuffer
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komauxitems import AI_CONTENT_TYPE
+from pylyskom.protocol import read_first_non_ws, read_int
+
+
+log = logging.getLogger("fakekom")
+
+CONTENT_TYPE = b"text/x-kom-basic;charset=utf-8"
+
+_SYSTEM_CONFERENCES = [
+    (1, "Presentation (av nya) möten"),
+    (2, "Presentation (av nya) medlemmar"),
+    (3, "Lappar (på) dörrar"),
+    (4, "Nyheter om LysKOM"),
+    ]
+
+_WORDS = ("och att det som en på är av för med till den har de inte om ett han men var "
+          "jag sig från vi så kan man när år säger hon under också efter eller nu sin där "
+          "vid mot ska skulle kommer ut får finns vara hade alla andra mycket än här då "
+          "sedan över bara in blir upp även vad få två vill ha många hur mer går sverige "
+          "kronor detta nya procent skall hans utan sina något svenska allt första fick "
+          "måste mellan blev bli dag någon några sitt stora varit dem bland bra tre ta "
+          "genom del hela annat fram gör ingen stockholm göra enligt mig redan inom").split()
+
+# Request classes by call number, for parsing the arguments.
+_REQUEST_CLASSES = dict(
+    (cls.CALL_NO, cls) for cls in vars(requests).values()
+    if isinstance(cls, type) and issubclass(cls, requests.Request) and cls.CALL_NO is not None)
+
+_ERROR_NOS = dict((cls, no) for no, cls in errors.error_dict.items())
+
+
+class KomError(Exception):
+    """Sent as an error reply."""
+
+    def __init__(self, error_class, status=0):
+        Exception.__init__(self, error_class.__name__, status)
+        self.error_no = _ERROR_NOS[error_class]
+        self.status = status
+
+
+# Encoding of the protocol A data types, in the same order as the
+# parse() methods in pylyskom.datatypes.
+
+def _h(s):
+    if isinstance(s, str):
+        s = s.encode('latin1')
+    return b"%dH%s" % (len(s), s)
+
+def _time(t):
+    return datatypes.Time(ptime=t).to_string()
+
+def _bits(bits):
+    return b"".join(b"1" if b else b"0" for b in bits)
+
+def _array(elements):
+    if len(elements) == 0:
+        return b"0 *"
+    return b"%d { %s }" % (len(elements), b" ".join(elements))
+
+def _aux_item(ai):
+    aux_no, tag, creator, created_at, inherit_limit, data = ai
+    return b"%d %d %d %s 00000000 %d %s" % (aux_no, tag, creator, _time(created_at),
+                                            inherit_limit, _h(data))
+
+
+class _Conference(object):
+    def __init__(self, conf_no, name, letterbox=False, created_at=0, creator=0):
+        self.conf_no = conf_no
+        self.name = name.encode('latin1', 'replace')
+        self.type = [0, 0, 0, 1 if letterbox else 0, 0, 0, 0, 0] # extended-conf-type
+        self.created_at = created_at
+        self.last_written = created_at
+        self.creator = creator
+        self.presentation = 0
+        self.supervisor = creator
+        self.super_conf = 0
+        self.nice = 77
+        self.keep_commented = 77
+        self.members = set()
+        self.local_nos = [] # sorted
+        self.text_nos = {} # local_no -> text_no
+
+    @property
+    def letterbox(self):
+        return bool(self.type[3])
+
+    @property
+    def highest_local_no(self):
+        return self.local_nos[-1] if self.local_nos else 0
+
+    def add_text(self, text_no, created_at):
+        local_no = self.highest_local_no + 1
+        self.local_nos.append(local_no)
+        self.text_nos[local_no] = text_no
+        self.last_written = created_at
+        return local_no
+
+    def encode(self):
+        first_local_no = self.local_nos[0] if self.local_nos else 1
+        return b"%s %s %s %s %d %d %d %d %d %d %d %d %d %d %d %d 0 *" % (
+            _h(self.name), _bits(self.type), _time(self.created_at), _time(self.last_written),
+            self.creator, self.presentation, self.supervisor, 0, self.super_conf, 0,
+            self.nice, self.keep_commented, len(self.members), first_local_no,
+            len(self.local_nos), 0)
+
+    def encode_micro(self):
+        return b"%s %s %d %d" % (_h(self.name), _bits(self.type), self.highest_local_no, self.nice)
+
+    def encode_z_info(self):
+        return b"%s %s %d" % (_h(self.name), _bits(self.type[:4]), self.conf_no)
+
+
+class _Person(object):
+    def __init__(self, pers_no, passwd, created_at):
+        self.pers_no = pers_no
+        self.passwd = passwd
+        self.created_at = created_at
+        self.last_login = created_at
+        self.user_area = 0
+        self.memberships = [] # in position order
+        self.marks = {} # text_no -> mark type
+        self.created_texts = 0
+
+    def get_membership(self, conf_no):
+        for m in self.memberships:
+            if m.conf_no == conf_no:
+                return m
+        return None
+
+    def encode(self, username):
+        return b"%s %s %s %s %d %d %d %d %d %d %d %d %d %d %d %d %d" % (
+            _h(username), b"0" * 16, b"0" * 8, _time(self.last_login), self.user_area,
+            0, 1, 0, 0, 0, 0, 0, 0, 1, self.created_texts, len(self.marks),
+            len(self.memberships))
+
+
+class _Membership(object):
+    def __init__(self, conf_no, priority, added_by, added_at):
+        self.conf_no = conf_no
+        self.priority = priority
+        self.added_by = added_by
+        self.added_at = added_at
+        self.last_time_read = added_at
+        self.passive = False
+        self.read_upto = 0 # all local numbers up to this are read
+        self.read_extra = set() # read local numbers after read_upto
+
+    def mark_as_read(self, local_no):
+        if local_no <= self.read_upto:
+            return
+        self.read_extra.add(local_no)
+        while self.read_upto + 1 in self.read_extra:
+            self.read_upto += 1
+            self.read_extra.discard(self.read_upto)
+
+    def mark_as_unread(self, local_no):
+        if local_no <= self.read_upto:
+            self.read_extra.update(range(local_no + 1, self.read_upto + 1))
+            self.read_upto = local_no - 1
+        else:
+            self.read_extra.discard(local_no)
+
+    def set_unread(self, conf, no_of_unread):
+        local_nos = conf.local_nos
+        if no_of_unread >= len(local_nos):
+            self.read_upto = 0
+        else:
+            self.read_upto = local_nos[len(local_nos) - no_of_unread - 1]
+        self.read_extra = set()
+
+    def is_read(self, local_no):
+        return local_no <= self.read_upto or local_no in self.read_extra
+
+    def unread_count(self, conf):
+        i = bisect.bisect_right(conf.local_nos, self.read_upto)
+        return len(conf.local_nos) - i - len(self.read_extra)
+
+    def read_ranges(self):
+        ranges = []
+        if self.read_upto > 0:
+            ranges.append([1, self.read_upto])
+        for local_no in sorted(self.read_extra):
+            if ranges and ranges[-1][1] == local_no - 1:
+                ranges[-1][1] = local_no
+            else:
+                ranges.append([local_no, local_no])
+        return ranges
+
+    def encode(self, position, want_read_ranges):
+        if want_read_ranges:
+            read_ranges = _array([ b"%d %d" % tuple(r) for r in self.read_ranges() ])
+        else:
+            read_ranges = b"0 *"
+        return b"%d %s %d %d %s %d %s %s" % (
+            position, _time(self.last_time_read), self.conf_no, self.priority, read_ranges,
+            self.added_by, _time(self.added_at), b"01000000" if self.passive else b"00000000")
+
+
+class _Text(object):
+    def __init__(self, text_no, author, created_at, contents, aux_items):
+        self.text_no = text_no
+        self.author = author
+        self.created_at = created_at
+        self.contents = contents # subject and body, utf-8
+        self.aux_items = aux_items # list of (aux_no, tag, creator, created_at, inherit_limit, data)
+        self.recipients = [] # list of (type, conf_no, local_no)
+        self.comment_to = [] # list of (type, text_no)
+        self.comment_in = [] # list of (type, text_no)
+        self.no_of_marks = 0
+
+    def encode_stat(self):
+        misc = []
+        for mi_type, text_no in self.comment_to:
+            misc.append(b"%d %d" % (mi_type, text_no))
+        for mi_type, conf_no, local_no in self.recipients:
+            misc.append(b"%d %d %d %d" % (mi_type, conf_no, datatypes.MI_LOC_NO, local_no))
+        for mi_type, text_no in self.comment_in:
+            misc.append(b"%d %d" % (mi_type, text_no))
+        no_of_misc = len(self.comment_to) + 2 * len(self.recipients) + len(self.comment_in)
+        if no_of_misc == 0:
+            misc_info = b"0 *"
+        else:
+            misc_info = b"%d { %s }" % (no_of_misc, b" ".join(misc))
+        return b"%s %d %d %d %d %s %s" % (
+            _time(self.created_at), self.author, self.contents.count(b"\n"),
+            len(self.contents), self.no_of_marks, misc_info,
+            _array([ _aux_item(ai) for ai in self.aux_items ]))
+
+
+class Dataset(object):
+    """The persons, conferences and texts of a fake LysKOM server."""
+
+    def __init__(self, persons=100, conferences=200, texts=20000, memberships=50,
+                 comment_ratio=0.6, read_ratio=0.95, body_words=60, passwd="test", seed=1):
+        rnd = random.Random(seed)
+        self.passwd = passwd.encode('latin1')
+        now = time.time()
+        t0 = now - 365 * 24 * 3600
+
+        self.conferences = {} # conf_no -> _Conference
+        self.persons = {} # pers_no -> _Person
+        self.texts = {} # text_no -> _Text
+        self._next_aux_no = 1
+
+        for conf_no, name in _SYSTEM_CONFERENCES:
+            self.conferences[conf_no] = _Conference(conf_no, name, created_at=t0)
+        first_pers_no = len(_SYSTEM_CONFERENCES) + 1
+        for pers_no in range(first_pers_no, first_pers_no + persons):
+            self.conferences[pers_no] = _Conference(
+                pers_no, "Person {}".format(pers_no), letterbox=True, created_at=t0,
+                creator=pers_no)
+            self.persons[pers_no] = _Person(pers_no, self.passwd, t0)
+        self.pers_nos = sorted(self.persons)
+        first_conf_no = first_pers_no + persons
+        for conf_no in range(first_conf_no, first_conf_no + conferences):
+            self.conferences[conf_no] = _Conference(
+                conf_no, "Möte {} ({})".format(conf_no, rnd.choice(_WORDS)), created_at=t0,
+                creator=rnd.choice(self.pers_nos))
+        self.conf_nos = list(range(first_conf_no, first_conf_no + conferences))
+
+        # Some conferences are much more popular than others.
+        conf_weights = [ 1.0 / (i + 1) for i in range(len(self.conf_nos)) ]
+        for pers_no in self.pers_nos:
+            person = self.persons[pers_no]
+            self._add_member(person, pers_no, 255, pers_no, t0)
+            for conf_no in self._sample(rnd, self.conf_nos, conf_weights,
+                                        min(memberships, len(self.conf_nos))):
+                self._add_member(person, conf_no, rnd.randint(50, 250), pers_no, t0)
+
+        self.next_text_no = 1
+        for i in range(texts):
+            created_at = t0 + (now - t0) * i / max(texts, 1)
+            author = rnd.choice(self.pers_nos)
+            comment_to = None
+            if self.next_text_no > 1 and rnd.random() < comment_ratio:
+                # Mostly comments to recent texts, which makes trees.
+                comment_to = max(1, self.next_text_no - 1 - int(rnd.expovariate(1 / 50.0)))
+                rcpts = [ r[1] for r in self.texts[comment_to].recipients ]
+            else:
+                rcpts = [ self._sample(rnd, self.conf_nos, conf_weights, 1)[0] ]
+                if rnd.random() < 0.05:
+                    rcpts.append(rnd.choice(self.pers_nos))
+            subject = " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 6)))
+            body = "\n".join(
+                " ".join(rnd.choice(_WORDS) for _ in range(12))
+                for _ in range(max(1, rnd.randint(body_words // 2, body_words * 3 // 2) // 12)))
+            self.create_text(author, created_at, (subject + "\n" + body).encode('utf-8'),
+                             [ (datatypes.MI_RECPT, r) for r in rcpts ],
+                             [] if comment_to is None else [ (datatypes.MI_COMM_TO, comment_to) ],
+                             [ (AI_CONTENT_TYPE, CONTENT_TYPE) ])
+
+        # Everyone has read most of their texts.
+        for person in self.persons.values():
+            for m in person.memberships:
+                conf = self.conferences[m.conf_no]
+                unread = int(len(conf.local_nos) * (1 - read_ratio) * rnd.random() * 2)
+                m.set_unread(conf, unread)
+
+    @staticmethod
+    def _sample(rnd, population, weights, k):
+        chosen = set()
+        while len(chosen) < k:
+            chosen.update(rnd.choices(population, weights, k=k - len(chosen)))
+        return sorted(chosen)
+
+    def _add_member(self, person, conf_no, priority, added_by, added_at):
+        m = _Membership(conf_no, priority, added_by, added_at)
+        person.memberships.append(m)
+        self.conferences[conf_no].members.add(person.pers_no)
+        return m
+
+    def create_text(self, author, created_at, contents, recipients, comment_to, aux_items):
+        """recipients is a list of (misc-info type, conf_no),
+        comment_to a list of (misc-info type, text_no) and aux_items a
+        list of (tag, data). Returns the new text.
+        """
+        text_no = self.next_text_no
+        self.next_text_no += 1
+        aux = []
+        for tag, data in aux_items:
+            aux.append((self._next_aux_no, tag, author, created_at, 0, data))
+            self._next_aux_no += 1
+        text = _Text(text_no, author, created_at, contents, aux)
+        author_person = self.persons.get(author)
+        for mi_type, conf_no in recipients:
+            local_no = self.conferences[conf_no].add_text(text_no, created_at)
+            text.recipients.append((mi_type, conf_no, local_no))
+            # Like lyskomd, new texts are read for their author.
+            m = author_person.get_membership(conf_no) if author_person is not None else None
+            if m is not None:
+                m.mark_as_read(local_no)
+        for mi_type, parent_no in comment_to:
+            text.comment_to.append((mi_type, parent_no))
+            self.texts[parent_no].comment_in.append((mi_type + 1, text_no))
+        self.texts[text_no] = text
+        if author_person is not None:
+            author_person.created_texts += 1
+        return text
+
+    def get_conference(self, conf_no):
+        if conf_no == 0:
+            raise KomError(errors.ConferenceZero)
+        conf = self.conferences.get(conf_no)
+        if conf is None:
+            raise KomError(errors.UndefinedConference, conf_no)
+        return conf
+
+    def get_person(self, pers_no):
+        person = self.persons.get(pers_no)
+        if person is None:
+            raise KomError(errors.UndefinedPerson, pers_no)
+        return person
+
+    def get_text(self, text_no):
+        if text_no == 0:
+            raise KomError(errors.TextZero)
+        text = self.texts.get(text_no)
+        if text is None:
+            raise KomError(errors.NoSuchText, text_no)
+        return text
+
+    def collate_table(self):
+        chars = []
+        for i in range(256):
+            c = chr(i).lower()
+            chars.append(c if len(c) == 1 and ord(c) < 256 else chr(i))
+        return "".join(chars).encode('latin1')
+
+
+class _Session(object):
+    def __init__(self, session_no, writer):
+        self.session_no = session_no
+        self.writer = writer
+        self.pers_no = 0
+        self.accepted_async = set()
+        self.disconnecting = False
+        self.buffer = AioReceiveBuffer()
+
+
+class FakeKomServer(object):
+    """Protocol A server for a Dataset.
+
+    latency is the number of seconds to delay each reply, and
+    call_latencies a dict with the delay for specific call numbers.
+    The number of requests per call number is counted in calls, and
+    per session number in session_calls.
+    """
+
+    def __init__(self, dataset, latency=0.0, call_latencies=None):
+        self.dataset = dataset
+        self.latency = latency
+        self.call_latencies = dict(call_latencies or {})
+        self.calls = collections.Counter()
+        self.session_calls = collections.Counter()
+        self._sessions = {} # session_no -> _Session
+        self._connection_tasks = set()
+        self._next_session_no = 1
+        self._server = None
+        self._handlers = {
+            requests.Requests.LOGOUT: self._logout,
+            requests.Requests.CHANGE_CONFERENCE: self._empty,
+            requests.Requests.GET_MARKS: self._get_marks,
+            requests.Requests.GET_TEXT: self._get_text,
+            requests.Requests.MARK_AS_READ: self._mark_as_read,
+            requests.Requests.SET_UNREAD: self._set_unread,
+            requests.Requests.GET_PERSON_STAT: self._get_person_stat,
+            requests.Requests.GET_UNREAD_CONFS: self._get_unread_confs,
+            requests.Requests.DISCONNECT: self._disconnect,
+            requests.Requests.WHO_AM_I: self._who_am_i,
+            requests.Requests.LOGIN: self._login,
+            requests.Requests.SET_CLIENT_VERSION: self._empty,
+            requests.Requests.MARK_TEXT: self._mark_text,
+            requests.Requests.UNMARK_TEXT: self._unmark_text,
+            requests.Requests.LOOKUP_Z_NAME: self._lookup_z_name,
+            requests.Requests.GET_UCONF_STAT: self._get_uconf_stat,
+            requests.Requests.ACCEPT_ASYNC: self._accept_async,
+            requests.Requests.USER_ACTIVE: self._empty,
+            requests.Requests.GET_COLLATE_TABLE: self._get_collate_table,
+            requests.Requests.CREATE_TEXT: self._create_text,
+            requests.Requests.GET_TEXT_STAT: self._get_text_stat,
+            requests.Requests.GET_CONF_STAT: self._get_conf_stat,
+            requests.Requests.GET_INFO: self._get_info,
+            requests.Requests.ADD_MEMBER: self._add_member,
+            requests.Requests.SUB_MEMBER: self._sub_member,
+            requests.Requests.LOCAL_TO_GLOBAL: self._local_to_global,
+            requests.Requests.QUERY_READ_TEXTS: self._query_read_texts,
+            requests.Requests.GET_MEMBERSHIP: self._get_membership,
+            requests.Requests.MARK_AS_UNREAD: self._mark_as_unread,
+            requests.Requests.SET_CONNECTION_TIME_FORMAT: self._empty,
+            requests.Requests.LOCAL_TO_GLOBAL_REVERSE: self._local_to_global_reverse,
+            }
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening. Returns the port."""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for session in list(self._sessions.values()):
+            session.writer.close()
+        if self._connection_tasks:
+            await asyncio.wait(self._connection_tasks)
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    # Connections
+
+    async def _handle_connection(self, reader, writer):
+        session = _Session(self._next_session_no, writer)
+        self._next_session_no += 1
+        task = asyncio.current_task()
+        self._connection_tasks.add(task)
+        try:
+            if not await self._handshake(session, reader):
+                return
+            self._sessions[session.session_no] = session
+            while True:
+                data = await reader.read(65536)
+                if len(data) == 0:
+                    break
+                session.buffer.append(data)
+                while True:
+                    parsed = self._try_parse_request(session)
+                    if parsed is None:
+                        break
+                    self._handle_request(session, *parsed)
+                    if session.disconnecting:
+                        return
+        except (ConnectionError, errors.ProtocolError) as e:
+            log.debug("Session %d: %r", session.session_no, e)
+        finally:
+            self._connection_tasks.discard(task)
+            self._sessions.pop(session.session_no, None)
+            if session.pers_no != 0:
+                self._broadcast_logout(session)
+            if not session.disconnecting:
+                writer.close()
+
+    async def _handshake(self, session, reader):
+        while True:
+            data = await reader.read(1024)
+            if len(data) == 0:
+                return False
+            session.buffer.append(data)
+            copy = session.buffer.copy()
+            try:
+                if read_first_non_ws(session.buffer) != b"A":
+                    return False
+                datatypes.String.parse(session.buffer)
+                break
+            except errors.NotEnoughDataInBufferError:
+                session.buffer = copy
+        session.writer.write(b"LysKOM\n")
+        return True
+
+    def _try_parse_request(self, session):
+        copy = session.buffer.copy()
+        try:
+            ref_no = read_int(session.buffer)
+            call_no = read_int(session.buffer)
+            request_class = _REQUEST_CLASSES.get(call_no)
+            if request_class is None:
+                raise errors.ProtocolError("Unknown call {}".format(call_no))
+            args = [ _parse_arg(arg.data_type, session.buffer) for arg in request_class.ARGS ]
+            return ref_no, call_no, args
+        except errors.NotEnoughDataInBufferError:
+            session.buffer = copy
+            return None
+
+    def _handle_request(self, session, ref_no, call_no, args):
+        self.calls[call_no] += 1
+        self.session_calls[session.session_no] += 1
+        handler = self._handlers.get(call_no)
+        try:
+            if handler is None:
+                raise KomError(errors.NotImplemented)
+            reply = b"=%d%s\n" % (ref_no, handler(session, *args))
+        except KomError as e:
+            reply = b"%%%d %d %d\n" % (ref_no, e.error_no, e.status)
+        delay = self.call_latencies.get(call_no, self.latency)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._write, session, reply)
+        else:
+            session.writer.write(reply)
+        if session.disconnecting:
+            asyncio.get_running_loop().call_later(delay, session.writer.close)
+
+    @staticmethod
+    def _write(session, data):
+        if not session.writer.is_closing():
+            session.writer.write(data)
+
+    def _send_async(self, msg_no, no_of_args, args):
+        message = b":%d %d %s\n" % (no_of_args, msg_no, args)
+        for session in self._sessions.values():
+            if msg_no in session.accepted_async:
+                self._write(session, message)
+
+    def _broadcast_logout(self, session):
+        self._send_async(AsyncMessages.LOGOUT, 2, b"%d %d" % (session.pers_no, session.session_no))
+
+    def _require_login(self, session):
+        if session.pers_no <= 0:
+            raise KomError(errors.LoginFirst)
+        return self.dataset.persons[session.pers_no]
+
+    def _get_membership_of(self, person, conf_no):
+        self.dataset.get_conference(conf_no)
+        m = person.get_membership(conf_no)
+        if m is None:
+            raise KomError(errors.NotMember, conf_no)
+        return m
+
+    # Requests. Each returns the reply (with a leading space if it is
+    # not empty).
+
+    def _empty(self, session, *args):
+        return b""
+
+    def _who_am_i(self, session):
+        return b" %d" % session.session_no
+
+    def _accept_async(self, session, request_list):
+        session.accepted_async = set(request_list)
+        return b""
+
+    def _login(self, session, pers_no, passwd, invisible):
+        person = self.dataset.get_person(pers_no)
+        if passwd != person.passwd:
+            raise KomError(errors.InvalidPassword)
+        if session.pers_no > 0:
+            self._broadcast_logout(session)
+        session.pers_no = pers_no
+        person.last_login = time.time()
+        return b""
+
+    def _logout(self, session):
+        if session.pers_no > 0:
+            self._broadcast_logout(session)
+        session.pers_no = 0
+        return b""
+
+    def _disconnect(self, session, session_no):
+        if session_no not in (0, session.session_no):
+            if session_no not in self._sessions:
+                raise KomError(errors.UndefinedSession, session_no)
+            raise KomError(errors.PermissionDenied, session_no)
+        if session.pers_no > 0:
+            self._broadcast_logout(session)
+        session.pers_no = 0
+        session.disconnecting = True # closed after the reply
+        return b""
+
+    def _get_person_stat(self, session, pers_no):
+        person = self.dataset.get_person(pers_no)
+        return b" " + person.encode(self.dataset.conferences[pers_no].name)
+
+    def _get_conf_stat(self, session, conf_no):
+        return b" " + self.dataset.get_conference(conf_no).encode()
+
+    def _get_uconf_stat(self, session, conf_no):
+        return b" " + self.dataset.get_conference(conf_no).encode_micro()
+
+    def _get_info(self, session):
+        return b" 10901 1 2 3 4 0 0 *"
+
+    def _get_collate_table(self, session):
+        return b" " + _h(self.dataset.collate_table())
+
+    def _lookup_z_name(self, session, name, want_pers, want_confs):
+        folded = name.translate(self.dataset.collate_table())
+        pattern = folded.split()
+        result = []
+        for conf in self.dataset.conferences.values():
+            if not ((want_pers and conf.letterbox) or (want_confs and not conf.letterbox)):
+                continue
+            words = conf.name.translate(self.dataset.collate_table()).split()
+            if len(words) >= len(pattern) and all(w.startswith(p) for w, p in zip(words, pattern)):
+                result.append(conf.encode_z_info())
+        return b" " + _array(result)
+
+    def _get_membership(self, session, pers_no, first, no_of_confs, want_read_ranges,
+                        max_ranges):
+        person = self.dataset.get_person(pers_no)
+        if first > len(person.memberships):
+            raise KomError(errors.IndexOutOfRange, first)
+        memberships = person.memberships[first:first + no_of_confs]
+        return b" " + _array([ m.encode(first + i, want_read_ranges)
+                               for i, m in enumerate(memberships) ])
+
+    def _query_read_texts(self, session, pers_no, conf_no, want_read_ranges, max_ranges):
+        person = self.dataset.get_person(pers_no)
+        m = self._get_membership_of(person, conf_no)
+        return b" " + m.encode(person.memberships.index(m), want_read_ranges)
+
+    def _get_unread_confs(self, session, pers_no):
+        person = self.dataset.get_person(pers_no)
+        conf_nos = [ b"%d" % m.conf_no for m in person.memberships
+                     if not m.passive and
+                     m.unread_count(self.dataset.conferences[m.conf_no]) > 0 ]
+        return b" " + _array(conf_nos)
+
+    def _add_member(self, session, conf_no, pers_no, priority, where, membership_type):
+        self._require_login(session)
+        person = self.dataset.get_person(pers_no)
+        conf = self.dataset.get_conference(conf_no)
+        m = person.get_membership(conf_no)
+        if m is None:
+            m = _Membership(conf_no, priority, session.pers_no, time.time())
+            conf.members.add(pers_no)
+        else:
+            person.memberships.remove(m)
+            m.priority = priority
+        m.passive = bool(membership_type[1])
+        person.memberships.insert(min(where, len(person.memberships)), m)
+        return b""
+
+    def _sub_member(self, session, conf_no, pers_no):
+        self._require_login(session)
+        person = self.dataset.get_person(pers_no)
+        m = self._get_membership_of(person, conf_no)
+        person.memberships.remove(m)
+        self.dataset.conferences[conf_no].members.discard(pers_no)
+        self._send_async(AsyncMessages.LEAVE_CONF, 1, b"%d" % conf_no)
+        return b""
+
+    def _local_to_global(self, session, conf_no, first_local_no, no_of_existing_texts):
+        conf = self.dataset.get_conference(conf_no)
+        if first_local_no == 0:
+            raise KomError(errors.LocalTextZero)
+        if no_of_existing_texts > 255:
+            raise KomError(errors.LongArray)
+        if first_local_no > conf.highest_local_no:
+            raise KomError(errors.NoSuchLocalText, first_local_no)
+        i = bisect.bisect_left(conf.local_nos, first_local_no)
+        local_nos = conf.local_nos[i:i + no_of_existing_texts]
+        if i + no_of_existing_texts < len(conf.local_nos):
+            range_end = conf.local_nos[i + no_of_existing_texts]
+            later_texts_exists = 1
+        else:
+            range_end = conf.highest_local_no + 1
+            later_texts_exists = 0
+        return b" %d %d %d 0 %s" % (first_local_no, range_end, later_texts_exists,
+                                    self._text_number_pairs(conf, local_nos))
+
+    def _local_to_global_reverse(self, session, conf_no, local_no_ceiling,
+                                 no_of_existing_texts):
+        conf = self.dataset.get_conference(conf_no)
+        if no_of_existing_texts > 255:
+            raise KomError(errors.LongArray)
+        if local_no_ceiling == 0 or local_no_ceiling > conf.highest_local_no + 1:
+            local_no_ceiling = conf.highest_local_no + 1
+        i = bisect.bisect_left(conf.local_nos, local_no_ceiling)
+        start = max(0, i - no_of_existing_texts)
+        local_nos = conf.local_nos[start:i]
+        if start > 0:
+            range_begin = local_nos[0]
+            earlier_texts_exists = 1
+        else:
+            range_begin = 1
+            earlier_texts_exists = 0
+        return b" %d %d %d 0 %s" % (range_begin, local_no_ceiling, earlier_texts_exists,
+                                    self._text_number_pairs(conf, local_nos))
+
+    @staticmethod
+    def _text_number_pairs(conf, local_nos):
+        return _array([ b"%d %d" % (l, conf.text_nos[l]) for l in local_nos ])
+
+    def _get_text_stat(self, session, text_no):
+        return b" " + self.dataset.get_text(text_no).encode_stat()
+
+    def _get_text(self, session, text_no, start_char, end_char):
+        text = self.dataset.get_text(text_no)
+        return b" " + _h(text.contents[start_char:end_char + 1])
+
+    def _create_text(self, session, contents, misc_info, aux_items):
+        person = self._require_login(session)
+        recipients = []
+        for r in misc_info.recipient_list:
+            self.dataset.get_conference(r.recpt)
+            recipients.append((r.type, r.recpt))
+        comment_to = []
+        for c in misc_info.comment_to_list:
+            self.dataset.get_text(c.text_no)
+            comment_to.append((c.type, c.text_no))
+        text = self.dataset.create_text(person.pers_no, time.time(), bytes(contents),
+                                        recipients, comment_to,
+                                        [ (ai.tag, bytes(ai.data)) for ai in aux_items ])
+        self._send_async(AsyncMessages.NEW_TEXT, 2,
+                         b"%d %s" % (text.text_no, text.encode_stat()))
+        return b" %d" % text.text_no
+
+    def _mark_as_read(self, session, conf_no, local_nos):
+        person = self._require_login(session)
+        m = self._get_membership_of(person, conf_no)
+        for local_no in local_nos:
+            m.mark_as_read(local_no)
+        m.last_time_read = time.time()
+        return b""
+
+    def _mark_as_unread(self, session, conf_no, local_no):
+        person = self._require_login(session)
+        self._get_membership_of(person, conf_no).mark_as_unread(local_no)
+        return b""
+
+    def _set_unread(self, session, conf_no, no_of_unread):
+        person = self._require_login(session)
+        m = self._get_membership_of(person, conf_no)
+        m.set_unread(self.dataset.conferences[conf_no], no_of_unread)
+        return b""
+
+    def _get_marks(self, session):
+        person = self._require_login(session)
+        return b" " + _array([ b"%d %d" % (text_no, mark_type)
+                               for text_no, mark_type in sorted(person.marks.items()) ])
+
+    def _mark_text(self, session, text_no, mark_type):
+        person = self._require_login(session)
+        text = self.dataset.get_text(text_no)
+        if text_no not in person.marks:
+            text.no_of_marks += 1
+        person.marks[text_no] = mark_type
+        return b""
+
+    def _unmark_text(self, session, text_no):
+        person = self._require_login(session)
+        text = self.dataset.get_text(text_no)
+        if text_no not in person.marks:
+            raise KomError(errors.NotMarked, text_no)
+        del person.marks[text_no]
+        text.no_of_marks -= 1
+        return b""
+
+
+class _AuxItemInput(object):
+    def __init__(self, tag, flags, inherit_limit, data):
+        self.tag = tag
+        self.flags = flags
+        self.inherit_limit = inherit_limit
+        self.data = data
+
+def _parse_arg(data_type, buf):
+    if data_type is datatypes.ArrayAuxItemInput:
+        # pylyskom never parses these, so there is no parse() for them.
+        length = read_int(buf)
+        items = []
+        left = read_first_non_ws(buf)
+        if left == b"*":
+            return items
+        elif left != b"{":
+            raise errors.ProtocolError()
+        for _ in range(length):
+            items.append(_AuxItemInput(datatypes.Int32.parse(buf),
+                                       datatypes.AuxItemFlags.parse(buf),
+                                       datatypes.Int32.parse(buf),
+                                       datatypes.String.parse(buf)))
+        if read_first_non_ws(buf) != b"}":
+            raise errors.ProtocolError()
+        return items
+    return data_type.parse(buf)
+
+
+def _parse_call_latency(s):
+    call_no, latency = s.split('=')
+    return int(call_no), float(latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4894)
+    parser.add_argument('--persons', type=int, default=100)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--memberships', type=int, default=50,
+                        help='Number of conferences per person (besides the letterbox)')
+    parser.add_argument('--passwd', default='test', help='Password for all persons')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to delay each reply')
+    parser.add_argument('--call-latency', type=_parse_call_latency, action='append', default=[],
+                        metavar='CALL_NO=SECONDS', help='Delay for a specific call number')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-7s %(name)-15s %(message)s',
+                        level=logging.INFO)
+    t0 = time.time()
+    dataset = Dataset(persons=args.persons, conferences=args.conferences, texts=args.texts,
+                      memberships=args.memberships, passwd=args.passwd, seed=args.seed)
+    log.info("Generated %d persons, %d conferences and %d texts in %.1f s (persons %d-%d)",
+             len(dataset.persons), len(dataset.conferences), len(dataset.texts),
+             time.time() - t0, dataset.pers_nos[0], dataset.pers_nos[-1])
+
+    async def run():
+        server = FakeKomServer(dataset, args.latency, dict(args.call_latency))
+        port = await server.start(args.host, args.port)
+        log.info("Listening on %s:%d", args.host, port)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
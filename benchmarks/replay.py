@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Replay of requests captured with HTTPKOM_CAPTURE_FILE (see
+httpkom/capture.py), against httpkom and the fake LysKOM server in
+fakekom.py.
+
+The requests are sent with the same timing as when they were
+captured, or N times faster with --speed N, so that the load looks
+like in production (for example when everyone checks for unread texts
+on Monday morning). Each captured connection gets its own session and
+HTTP connection, and its requests are sent in order.
+
+The captured person, conference and text numbers are hashes, so they
+are mapped to numbers in the fake server's dataset: each connection
+logs in as a person of its own, "self" is that person, conferences
+are mapped to the person's memberships and texts to any text. Request
+bodies are made up from what was captured (the lengths of lists and
+some numbers).
+
+By default httpkom and the fake server are started like in
+bench_http.py. With --target, the requests are sent to a running
+httpkom instead, which must use a fake server with the same dataset
+options (the dataset is generated here too, to know what numbers
+exist). LysKOM requests can only be counted with the fake server
+started here.
+
+Usage (from the top directory)::
+
+  PYTHONPATH=. python3 benchmarks/replay.py capture.jsonl [more.jsonl ...] [--speed 10] \\
+      [--target 127.0.0.1:5001 --server-id fakekom] [--output results.json]
+
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_http
+import fakekom
+
+
+_CONVERTER_RE = re.compile(r'<(?:[a-z]+:)?([a-z_]+)>')
+
+
+def route_name(method, route):
+    """Like the route names in bench_http.py: "GET /texts/<text_no>"."""
+    route = _CONVERTER_RE.sub(r'<\1>', route)
+    if route.startswith('/<server_id>'):
+        route = route[len('/<server_id>'):]
+    return method + ' ' + route
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+class ReplayedConnection(object):
+    """Replays the requests of one captured connection."""
+
+    def __init__(self, conn, records, dataset, args, fake_server, results, lag):
+        self.conn = conn
+        self.records = records
+        self.dataset = dataset
+        self.args = args
+        self.fake_server = fake_server
+        self.results = results
+        self.lag = lag
+        self.rnd = random.Random(conn)
+        self.pers_no = dataset.pers_nos[self._hash(conn) % len(dataset.pers_nos)]
+        self.conf_nos = [ m.conf_no for m in dataset.persons[self.pers_no].memberships ]
+        self.http = bench_http.HttpConnection(args.host, args.port)
+        self.headers = []
+        self.session_no = None
+
+    @staticmethod
+    def _hash(value):
+        return int(value, 16) if isinstance(value, str) else hash(value)
+
+    def _map_id(self, name, value, conf_no=None):
+        if value == 0:
+            return 0
+        if name == 'pers_no':
+            if value == 'self':
+                return self.pers_no
+            return self.dataset.pers_nos[self._hash(value) % len(self.dataset.pers_nos)]
+        elif name == 'conf_no':
+            return self.conf_nos[self._hash(value) % len(self.conf_nos)]
+        elif name == 'text_no':
+            return 1 + self._hash(value) % (self.dataset.next_text_no - 1)
+        elif name == 'local_text_no':
+            highest = self.dataset.conferences[conf_no].highest_local_no if conf_no else 0
+            return 1 + self._hash(value) % max(highest, 1)
+        elif name == 'session_no':
+            # Never disconnect someone else's session.
+            return self.session_no
+        return value
+
+    def _random_text_no(self):
+        return self.rnd.randint(1, self.dataset.next_text_no - 1)
+
+    def _path(self, record):
+        args = record['args']
+        conf_no = self._map_id('conf_no', args['conf_no']) if 'conf_no' in args else None
+
+        def replace(m):
+            name = m.group(1)
+            if name == 'server_id':
+                return self.args.server_id
+            if name == 'conf_no':
+                return str(conf_no)
+            return str(self._map_id(name, args.get(name), conf_no))
+
+        path = _CONVERTER_RE.sub(replace, record['route'])
+        query = []
+        for key, value in record['query'].items():
+            if value is None:
+                if key != 'name':
+                    continue
+                value = self.rnd.choice([ 'Person', 'Möte' ])
+            query.append((key, value))
+        if query:
+            path += '?' + urllib.parse.urlencode(query)
+        return path, conf_no
+
+    def _body(self, record, conf_no):
+        summary = record.get('body')
+        if summary is None:
+            return None
+        route = route_name(record['method'], record['route'])
+        if route == 'POST /sessions/':
+            return dict(client=dict(name='replay', version='1.0'))
+        elif route == 'POST /sessions/current/login':
+            return dict(pers_no=self.pers_no, passwd=self.args.passwd)
+
+        body = {}
+        for key, value in summary['values'].items():
+            if key in ('pers_no', 'conf_no', 'text_no'):
+                body[key] = self._map_id(key, value)
+            else:
+                body[key] = value
+        for key, length in summary['lists'].items():
+            if key == 'text_nos':
+                body[key] = [ self._random_text_no() for _ in range(length) ]
+            elif key == 'local_text_nos':
+                highest = self.dataset.conferences[conf_no].highest_local_no if conf_no else 1
+                body[key] = [ self.rnd.randint(1, max(highest, 1)) for _ in range(length) ]
+            elif key == 'recipient_list':
+                body[key] = [ dict(type='to', recpt=dict(conf_no=self.rnd.choice(self.conf_nos)))
+                              for _ in range(length) ]
+            elif key == 'comment_to_list':
+                body[key] = [ dict(type='comment', text_no=self._random_text_no())
+                              for _ in range(length) ]
+            else:
+                body[key] = []
+        if route == 'POST /texts/':
+            body.setdefault('subject', 'Replay')
+            body['body'] = " ".join(self.rnd.choices(fakekom._WORDS, k=60))
+            body.setdefault('content_type', 'text/x-kom-basic')
+        return body
+
+    async def _request(self, route, method, path, body, measure=True):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        calls_before = self.fake_server.session_calls[self.session_no] \
+            if self.fake_server is not None else 0
+        t0 = time.perf_counter()
+        status, headers, response_body = await self.http.request(method, path, self.headers, data)
+        t = time.perf_counter() - t0
+        if measure:
+            lyskom_calls = 0
+            if self.fake_server is not None and self.session_no is not None:
+                lyskom_calls = self.fake_server.session_calls[self.session_no] - calls_before
+            self.results.add(route, t, status < 400, lyskom_calls)
+        return status, response_body
+
+    async def _create_session(self, measure):
+        self.headers = []
+        status, body = await self._request(
+            'POST /sessions/', 'POST', '/{}/sessions/'.format(self.args.server_id),
+            dict(client=dict(name='replay', version='1.0')), measure)
+        if status == 201:
+            session = json.loads(body)
+            self.headers = [ ('Httpkom-Connection', session['connection_id']) ]
+            self.session_no = session['session_no']
+
+    async def _login(self, measure):
+        await self._request(
+            'POST /sessions/current/login', 'POST',
+            '/{}/sessions/current/login'.format(self.args.server_id),
+            dict(pers_no=self.pers_no, passwd=self.args.passwd), measure)
+
+    async def run(self, start, t0):
+        first_route = route_name(self.records[0]['method'], self.records[0]['route'])
+        if self.records[0]['conn'] is not None and first_route != 'POST /sessions/':
+            # The capture started after the session was created.
+            await self._create_session(False)
+            await self._login(False)
+        for record in self.records:
+            delay = start + (record['t'] - t0) / self.args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.lag.append(-delay)
+            route = route_name(record['method'], record['route'])
+            if route == 'POST /sessions/':
+                await self._create_session(True)
+            elif route == 'POST /sessions/current/login':
+                await self._login(True)
+            else:
+                path, conf_no = self._path(record)
+                await self._request(route, record['method'], path, self._body(record, conf_no))
+                if route == 'DELETE /sessions/<session_no>':
+                    self.session_no = None
+        if self.session_no is not None:
+            await self._request('DELETE /sessions/<session_no>', 'DELETE',
+                                '/{}/sessions/0'.format(self.args.server_id), None, False)
+        await self.http.close()
+
+
+def print_captured(records):
+    latencies = collections.defaultdict(list)
+    lyskom_calls = collections.Counter()
+    for r in records:
+        route = route_name(r['method'], r['route'])
+        latencies[route].append(r['ms'])
+        lyskom_calls[route] += r.get('lyskom_calls', 0)
+    print("Captured:")
+    print("{:<52} {:>7} {:>8} {:>8} {:>7}".format("Route", "Reqs", "p50 ms", "p99 ms", "LysKOM"))
+    for route, ms in sorted(latencies.items()):
+        ms.sort()
+        print("{:<52} {:>7} {:>8.2f} {:>8.2f} {:>7.2f}".format(
+            route, len(ms), bench_http.percentile(ms, 50), bench_http.percentile(ms, 99),
+            lyskom_calls[route] / len(ms)))
+    print()
+
+
+async def replay(args, records):
+    dataset = fakekom.Dataset(persons=args.persons, conferences=args.conferences,
+                              texts=args.texts, memberships=args.memberships, seed=args.seed)
+    fake_server = None
+    process = None
+    if args.target is None:
+        fake_server = fakekom.FakeKomServer(dataset, latency=args.latency)
+        lyskom_port = await fake_server.start(args.host)
+        args.httpkom_port = bench_http.free_port(args.host)
+        process, config_path = bench_http.start_httpkom(args, lyskom_port)
+        args.port = args.httpkom_port
+        args.server_id = bench_http.SERVER_ID
+
+    cpu_seconds = None
+    try:
+        if process is not None:
+            await bench_http.wait_for_httpkom(args.host, args.port, process)
+        by_conn = collections.OrderedDict()
+        for i, r in enumerate(records):
+            # Requests without a connection are replayed on their own.
+            by_conn.setdefault(r['conn'] or i, []).append(r)
+        results = bench_http.Results()
+        lag = []
+        connections = [ ReplayedConnection(conn, rs, dataset, args, fake_server, results, lag)
+                        for conn, rs in by_conn.items() ]
+        t0 = records[0]['t']
+        captured_seconds = records[-1]['t'] - t0
+        print("Replaying {} requests from {} connections ({:.0f} s captured) at {}x speed".format(
+            len(records), len(connections), captured_seconds, args.speed))
+        start = time.monotonic()
+        await asyncio.gather(*[ c.run(start, t0) for c in connections ])
+        seconds = time.monotonic() - start
+    finally:
+        if process is not None:
+            cpu_seconds = bench_http.stop_httpkom(process)
+            os.unlink(config_path)
+        if fake_server is not None:
+            await fake_server.stop()
+    summary = bench_http.summarize(results, seconds, cpu_seconds)
+    lag.sort()
+    summary['late_requests'] = len(lag)
+    summary['lag_p99_ms'] = 1000 * bench_http.percentile(lag, 99) if lag else 0
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('capture', nargs='+', help='Capture files (JSON lines)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How many times faster than captured to send the requests')
+    parser.add_argument('--target', default=None, metavar='HOST:PORT',
+                        help='A running httpkom to replay against')
+    parser.add_argument('--server-id', default=bench_http.SERVER_ID,
+                        help='The LysKOM server id in the running httpkom (with --target)')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Seconds that the fake LysKOM server delays each reply')
+    parser.add_argument('--passwd', default='test')
+    parser.add_argument('--persons', type=int, default=100)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--memberships', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='File to save the results in')
+    args = parser.parse_args()
+
+    args.host = '127.0.0.1'
+    if args.target is not None:
+        args.host, port = args.target.rsplit(':', 1)
+        args.port = int(port)
+
+    records = [ r for r in load_records(args.capture) if r.get('route') is not None ]
+    if len(records) == 0:
+        print("No requests to replay")
+        return
+    print_captured(records)
+    summary = asyncio.run(replay(args, records))
+    print()
+    bench_http.print_summary(summary)
+    print("{} requests were sent late, p99 {:.2f} ms late".format(
+        summary['late_requests'], summary['lag_p99_ms']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                meta=dict(commit=bench_http.git_commit(),
+                          date=datetime.datetime.now().isoformat(timespec='seconds'),
+                          captures=args.capture, speed=args.speed),
+                summary=summary), f, indent=2, sort_keys=True)
+        print("Results saved in {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
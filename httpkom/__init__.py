@@ -3,9 +3,10 @@
 
 import os
 import logging
+from types import MappingProxyType
 from logging.handlers import TimedRotatingFileHandler
 
-from quart import Quart, Blueprint, request, jsonify, g, abort, current_app, has_request_context, has_app_context
+from quart import Quart, Blueprint, request, g, abort, has_request_context, has_app_context
 import six
 
 
@@ -27,6 +28,89 @@ class default_settings:
         ('lyslyskom', 'LysKOM', 'kom.lysator.liu.se', 4894),
         ]
 
+    # Max number of conferences to keep local to global text number
+    # maps for (shared by all sessions).
+    HTTPKOM_TEXT_MAP_MAX_CONFERENCES = 1000
+
+    # Max number of texts in one page of the texts in a conference.
+    HTTPKOM_MAX_TEXTS_PER_PAGE = 255
+
+    # Seconds before the unread texts of a logged in person are
+    # calculated again, to catch read-markings made by other clients.
+    HTTPKOM_UNREAD_TRACKER_MAX_AGE = 120
+
+    # Seconds before the index of conference and person names is
+    # built again, to find new and deleted conferences.
+    HTTPKOM_NAME_INDEX_MAX_AGE = 600
+
+    # Seconds to keep conference status in the shared conference
+    # cache, and max number of entries in it.
+    HTTPKOM_CONFERENCE_CACHE_TTL = 10
+    HTTPKOM_CONFERENCE_CACHE_MAX_ENTRIES = 10000
+
+    # Compress responses of at least this many bytes (None to never
+    # compress), and max total size of the cache of compressed text
+    # bodies.
+    HTTPKOM_COMPRESSION_MIN_SIZE = 1024
+    HTTPKOM_COMPRESSION_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+    # File to write metadata about each request to (JSON lines, see
+    # capture.py), or None to not capture requests. "{pid}" is
+    # replaced with the process id. The fraction of the connections
+    # to capture.
+    HTTPKOM_CAPTURE_FILE = None
+    HTTPKOM_CAPTURE_SAMPLE_RATE = 1.0
+
+    # Let identical concurrent lookups (conference names, text bodies)
+    # from different sessions to the same server wait for one LysKOM
+    # request instead of making one each.
+    HTTPKOM_SINGLE_FLIGHT = True
+
+    # Max number of requests with a LysKOM session that may run at the
+    # same time for one connection id, and in total, and the max
+    # number of requests that may wait for them (None for no limit).
+    # Requests over that are rejected with 429 (connection id) or 503
+    # (total), with Retry-After in seconds. Seconds a request may wait
+    # before it is rejected.
+    HTTPKOM_MAX_REQUESTS_PER_CONNECTION = 8
+    HTTPKOM_MAX_QUEUED_REQUESTS_PER_CONNECTION = 32
+    HTTPKOM_MAX_REQUESTS = 500
+    HTTPKOM_MAX_QUEUED_REQUESTS = 2000
+    HTTPKOM_ADMISSION_RETRY_AFTER = 1
+    HTTPKOM_ADMISSION_QUEUE_TIMEOUT = 10
+
+    # Max number of connections to each LysKOM server, and max number
+    # of requests in flight to each LysKOM server (more requests wait).
+    # None for no limit. Seconds to wait for a new connection.
+    HTTPKOM_MAX_LYSKOM_CONNECTIONS_PER_SERVER = 2000
+    HTTPKOM_MAX_LYSKOM_REQUESTS_PER_SERVER = 1000
+    HTTPKOM_LYSKOM_CONNECT_TIMEOUT = 10
+
+    # Number of connection failures and timeouts in a row after which
+    # a LysKOM server is considered down (requests to it fail with
+    # 503), and seconds until a new connection is tried again.
+    HTTPKOM_CIRCUIT_BREAKER_FAILURES = 5
+    HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+    # Seconds to wait for the reply to a login, to other requests to
+    # the LysKOM server that change something, and to requests that
+    # only read. None to wait forever. Requests that time out fail
+    # with 504.
+    HTTPKOM_LYSKOM_LOGIN_TIMEOUT = 30
+    HTTPKOM_LYSKOM_WRITE_TIMEOUT = 30
+    HTTPKOM_LYSKOM_READ_TIMEOUT = 15
+
+    # Seconds to wait for running requests when httpkom is drained
+    # (on SIGTERM or POST /admin/drain) before the LysKOM sessions are
+    # logged out and disconnected anyway, and the number of sessions
+    # to disconnect at the same time.
+    HTTPKOM_DRAIN_TIMEOUT = 20
+    HTTPKOM_DRAIN_BATCH_SIZE = 50
+
+    # Token for the /admin/ endpoints (sent as "Authorization: Bearer
+    # <token>"). None disables them.
+    HTTPKOM_ADMIN_TOKEN = None
+
     HTTPKOM_CROSSDOMAIN_ALLOWED_ORIGINS = '*'
     HTTPKOM_CROSSDOMAIN_MAX_AGE = 0
     HTTPKOM_CROSSDOMAIN_ALLOW_HEADERS = [ 'Origin', 'Accept', 'Content-Type', 'X-Requested-With',
@@ -81,6 +165,13 @@ def init_app(app):
         app.logger.info("Finished setting up file logger.");
 
 
+    # Use our JSON backend (orjson if installed) for jsonify.
+    from .jsonbackend import JSONProvider
+    app.json_provider_class = JSONProvider
+    app.json = JSONProvider(app)
+
+    _init_from_config(app)
+
     # Load app parts
     from . import conferences
     from . import sessions
@@ -91,6 +182,10 @@ def init_app(app):
     from . import server
     from . import stats
     from . import ws
+    from . import compression
+    from . import capture
+    from . import backends
+    from . import drain
 
     # to avoid pyflakes errors
     dir(conferences)
@@ -102,11 +197,17 @@ def init_app(app):
     dir(server)
     dir(stats)
     dir(ws)
+    dir(compression)
+    dir(capture)
+    dir(backends)
+    dir(drain)
 
     app.register_blueprint(bp)
 
 
 class Server(object):
+    __slots__ = ('id', 'sort_order', 'name', 'host', 'port')
+
     def __init__(self, sid, sort_order, name, host, port=4894):
         self.id = sid
         self.sort_order = sort_order
@@ -119,6 +220,46 @@ class Server(object):
                  'name': self.name, 'host': self.host, 'port': self.port }
 
 
+class _Crossdomain(object):
+    """The CORS settings, with the response headers joined once."""
+
+    def __init__(self, config):
+        allowed_origins = config['HTTPKOM_CROSSDOMAIN_ALLOWED_ORIGINS']
+        if isinstance(allowed_origins, str):
+            allowed_origins = [ allowed_origins ]
+        self.allow_all = '*' in allowed_origins
+        self.allowed_origins = frozenset(allowed_origins)
+        self.headers = (
+            ('Access-Control-Allow-Methods',
+             ', '.join(config['HTTPKOM_CROSSDOMAIN_ALLOW_METHODS'])),
+            ('Access-Control-Max-Age',
+             str(config['HTTPKOM_CROSSDOMAIN_MAX_AGE'])),
+            ('Access-Control-Allow-Headers',
+             ', '.join(config['HTTPKOM_CROSSDOMAIN_ALLOW_HEADERS'])),
+            ('Access-Control-Expose-Headers',
+             ', '.join(config['HTTPKOM_CROSSDOMAIN_EXPOSE_HEADERS'])),
+            )
+        self.allow_all_headers = (('Access-Control-Allow-Origin', '*'),) + self.headers
+
+
+# Built from the config by init_app(), and never changed after that.
+_servers = MappingProxyType({}) # server id -> Server
+_crossdomain = None
+_index_json = None # the response body for /
+
+
+def _init_from_config(app):
+    global _servers, _crossdomain, _index_json
+    from .jsonbackend import dumps_bytes
+    servers = dict()
+    for i, server in enumerate(app.config['HTTPKOM_LYSKOM_SERVERS']):
+        servers[server[0]] = Server(server[0], i, server[1], server[2], server[3])
+    _servers = MappingProxyType(servers)
+    _crossdomain = _Crossdomain(app.config)
+    _index_json = dumps_bytes(dict([ (s.id, s.to_dict()) for s in _servers.values() ]),
+                              indent=app.debug)
+
+
 # http://flask.pocoo.org/docs/patterns/urlprocessors/
 @bp.url_value_preprocessor
 def pull_server_id(endpoint, values):
@@ -126,12 +267,10 @@ def pull_server_id(endpoint, values):
         return
     if not has_app_context():
         return
-    _servers = dict()
-    for i, server in enumerate(current_app.config['HTTPKOM_LYSKOM_SERVERS']):
-        _servers[server[0]] = Server(server[0], i, server[1], server[2], server[3])
     server_id = values.pop('server_id')
-    if server_id in _servers:
-        g.server = _servers[server_id]
+    server = _servers.get(server_id)
+    if server is not None:
+        g.server = server
     else:
         # No such server
         abort(404)
@@ -141,32 +280,18 @@ def pull_server_id(endpoint, values):
 def allow_crossdomain(resp):
     if not has_request_context():
         return
-    if 'Origin' in request.headers:
+    origin = request.headers.get('Origin')
+    if origin is not None:
         h = resp.headers
-        allowed_origins = app.config['HTTPKOM_CROSSDOMAIN_ALLOWED_ORIGINS']
-        origin = request.headers['Origin']
-        if (allowed_origins == '*') or ('*' in allowed_origins):
-            h['Access-Control-Allow-Origin'] = '*'
-            is_allowed = True
-        elif origin in allowed_origins:
-            h['Access-Control-Allow-Origin'] = origin
-            is_allowed = True
+        # The views never set any of these headers, so they can be
+        # added without looking for old values.
+        if _crossdomain.allow_all:
+            h.extend(_crossdomain.allow_all_headers)
+        elif origin in _crossdomain.allowed_origins:
+            h.add('Access-Control-Allow-Origin', origin)
+            h.extend(_crossdomain.headers)
         else:
-            h['Access-Control-Allow-Origin'] = 'null'
-            is_allowed = False
-
-        if is_allowed:
-            h['Access-Control-Allow-Methods'] = \
-                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_ALLOW_METHODS'])
-
-            h['Access-Control-Max-Age'] = \
-                str(app.config['HTTPKOM_CROSSDOMAIN_MAX_AGE'])
-
-            h['Access-Control-Allow-Headers'] = \
-                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_ALLOW_HEADERS'])
-
-            h['Access-Control-Expose-Headers'] = \
-                ', '.join(app.config['HTTPKOM_CROSSDOMAIN_EXPOSE_HEADERS'])
+            h.add('Access-Control-Allow-Origin', 'null')
 
     return resp
 
@@ -186,8 +311,4 @@ def ios6_cache_fix(resp):
 
 @app.route("/")
 async def index():
-    _servers = dict()
-    for i, server in enumerate(current_app.config['HTTPKOM_LYSKOM_SERVERS']):
-        _servers[server[0]] = Server(server[0], i, server[1], server[2], server[3])
-    servers = dict([ (s.id, s.to_dict()) for s in _servers.values() ])
-    return jsonify(servers)
+    return app.response_class(_index_json, mimetype='application/json')
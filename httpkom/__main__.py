@@ -2,6 +2,7 @@ import argparse
 import asyncio
 import logging
 import os
+import signal
 import sys
 
 from hypercorn.asyncio import serve
@@ -9,8 +10,9 @@ from hypercorn.config import Config
 
 from pylyskom import stats
 from pylyskom.stats import stats as pylyskom_stats
-from httpkom.stats import stats as httpkom_stats
+from httpkom.stats import StatsSender, stats as httpkom_stats
 from httpkom import app, init_app
+from httpkom import drain
 
 
 log = logging.getLogger("httpkom.main")
@@ -20,18 +22,122 @@ def start_stats_sender(graphite_host, graphite_port):
     if graphite_host and graphite_port:
         log.info("Sending stats to Graphite at {}:{}".format(graphite_host, graphite_port))
         conn = stats.GraphiteTcpConnection(graphite_host, graphite_port)
-        sender = stats.StatsSender([ pylyskom_stats, httpkom_stats ], conn, interval=10)
+        sender = StatsSender([ pylyskom_stats, httpkom_stats ], conn, interval=10)
         sender.start()
+
+        def flush():
+            # Stop the sender and send what has happened since it
+            # last sent.
+            sender.stop()
+            sender.flush()
+            conn.close()
+            log.info("Sent the stats to Graphite")
+        drain.on_drained(flush)
     else:
         log.info("No Graphite host and port specified, not sending stats")
 
 
+def use_event_loop(loop):
+    """Select the event loop implementation: 'asyncio', 'uvloop', or
+    'auto' for uvloop if it is installed. Returns the name of the
+    selected one.
+    """
+    if loop == 'asyncio':
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if loop == 'uvloop':
+            raise
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+async def drain_on_signal():
+    """Shutdown trigger for Hypercorn: on SIGTERM or SIGINT, drain
+    httpkom (see drain.py) and then shut down. Another signal while
+    draining shuts down right away.
+    """
+    loop = asyncio.get_running_loop()
+    signalled = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, signalled.set)
+    await signalled.wait()
+    signalled.clear()
+    log.info("Got signal, draining before shutting down")
+    drained = drain.start()
+    another_signal = asyncio.ensure_future(signalled.wait())
+    await asyncio.wait([ drained, another_signal ], return_when=asyncio.FIRST_COMPLETED)
+    another_signal.cancel()
+    if not drained.done():
+        log.warning("Got another signal, shutting down without waiting for the drain")
+    elif drained.exception() is not None:
+        log.error("Drain failed", exc_info=drained.exception())
+
+
+def make_hypercorn_config(args):
+    """Hypercorn config from the command line arguments, on top of
+    the Hypercorn config file (TOML) if one is given.
+    """
+    if args.hypercorn_config is not None:
+        config = Config.from_toml(args.hypercorn_config)
+    else:
+        config = Config()
+    config.bind = ["{}:{}".format(args.host, args.port)]
+    if args.keep_alive is not None:
+        config.keep_alive_timeout = args.keep_alive
+    if args.backlog is not None:
+        config.backlog = args.backlog
+    if args.http2_max_concurrent_streams is not None:
+        config.h2_max_concurrent_streams = args.http2_max_concurrent_streams
+    if args.certfile is not None:
+        config.certfile = args.certfile
+        config.keyfile = args.keyfile
+    if not args.http2:
+        # Only affects TLS (ALPN). Hypercorn always accepts h2c
+        # (HTTP/2 without TLS) from clients that ask for it.
+        config.alpn_protocols = [ 'http/1.1' ]
+    return config
+
+
 def run_http_server(args):
     os.environ['HTTPKOM_SETTINGS'] = args.config
     init_app(app)
-    config = Config()
-    config.bind = ["{}:{}".format(args.host, args.port)]
-    asyncio.run(serve(app, config))
+    config = make_hypercorn_config(args)
+    try:
+        loop = use_event_loop(args.loop)
+    except ImportError:
+        log.info("uvloop is not installed")
+        sys.exit(1)
+    log.info("Using event loop: %s, HTTP/2 max concurrent streams: %s, keep-alive: %s s, "
+             "backlog: %s", loop, config.h2_max_concurrent_streams, config.keep_alive_timeout,
+             config.backlog)
+    asyncio.run(serve(app, config, shutdown_trigger=drain_on_signal))
+
+
+def add_server_arguments(parser):
+    """Arguments for the HTTP server and event loop (also used by the
+    benchmarks).
+    """
+    parser.add_argument('--loop', help='Event loop: uvloop, asyncio, or auto for uvloop '
+                        'if it is installed (default: auto)',
+                        choices=[ 'auto', 'asyncio', 'uvloop' ], default='auto')
+    parser.add_argument('--no-http2', help='Don\'t offer HTTP/2 with TLS (ALPN). HTTP/2 '
+                        'without TLS (h2c) is always accepted from clients that ask for it',
+                        dest='http2', action='store_false')
+    parser.add_argument('--http2-max-concurrent-streams',
+                        help='Max concurrent requests on each HTTP/2 connection '
+                        '(Hypercorn default: 100)', type=int, default=None)
+    parser.add_argument('--keep-alive', help='Seconds to keep idle connections open '
+                        '(Hypercorn default: 5)', type=float, default=None)
+    parser.add_argument('--backlog', help='Listen backlog (Hypercorn default: 100)',
+                        type=int, default=None)
+    parser.add_argument('--certfile', help='TLS certificate file (enables HTTPS)',
+                        default=None)
+    parser.add_argument('--keyfile', help='TLS key file', default=None)
+    parser.add_argument('--hypercorn-config', help='Hypercorn config file (TOML), for '
+                        'other settings. The arguments above override it', default=None)
 
 
 def main():
@@ -52,6 +158,8 @@ def main():
     parser.add_argument('--graphite-port', help='Port for Graphite plaintext protocol',
                         type=int, default=2003)
 
+    add_server_arguments(parser)
+
     args = parser.parse_args()
 
     log.info("Using args: %s", args)
@@ -60,6 +168,9 @@ def main():
     if not os.path.exists(args.config):
         log.info("Config file does not exist: %s", args.config)
         sys.exit(1)
+    if (args.certfile is None) != (args.keyfile is None):
+        log.info("Both --certfile and --keyfile are needed for TLS")
+        sys.exit(1)
 
     start_stats_sender(args.graphite_host, args.graphite_port)
     run_http_server(args)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Admission control for requests that use a LysKOM session.
+
+All requests for a connection id are sent on the same LysKOM
+connection, so one client that makes hundreds of concurrent requests
+makes httpkom (and the LysKOM server) slow for everyone. Each
+connection id may have HTTPKOM_MAX_REQUESTS_PER_CONNECTION requests
+running at the same time, and there may be at most
+HTTPKOM_MAX_REQUESTS running in total. Requests over the limits wait
+in a queue, in order. If the queue is full, or if a request has
+waited for HTTPKOM_ADMISSION_QUEUE_TIMEOUT seconds, the request is
+rejected right away: with 429 Too Many Requests if it was the limit
+for its connection id, and with 503 Service Unavailable if it was the
+total limit. Both have a Retry-After header.
+
+A request is running until its view has returned, or for streamed
+responses, until the whole body has been sent.
+"""
+
+from __future__ import absolute_import
+import asyncio
+from collections import deque
+import weakref
+
+from quart import current_app, g
+
+from .errors import error_response
+from .stats import stats
+
+
+class _Limit(object):
+    """A number of slots, and a queue of futures waiting for one."""
+
+    __slots__ = ('active', 'waiters')
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+
+    def is_idle(self):
+        return self.active == 0 and len(self.waiters) == 0
+
+
+_global = _Limit()
+_connections = {} # connection id -> _Limit
+_queued = 0 # number of requests waiting, in all queues
+
+
+class _Rejected(Exception):
+    pass
+
+
+async def _acquire(limit, max_active, max_waiting, timeout):
+    global _queued
+    if max_active is None or (limit.active < max_active and len(limit.waiters) == 0):
+        limit.active += 1
+        return
+    if max_waiting is not None and len(limit.waiters) >= max_waiting:
+        raise _Rejected()
+
+    future = asyncio.get_running_loop().create_future()
+    limit.waiters.append(future)
+    _queued += 1
+    stats.set('admission.queued.last', _queued, agg='last')
+    stats.set('admission.queued.max', _queued, agg='max')
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        stats.set('admission.timeouts.last', 1, agg='sum')
+        raise _Rejected()
+    except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+            # We got the slot at the same time as we were cancelled.
+            _release(limit)
+        raise
+    finally:
+        _queued -= 1
+        stats.set('admission.queued.last', _queued, agg='last')
+        try:
+            limit.waiters.remove(future)
+        except ValueError:
+            pass
+    stats.set('admission.waited.last', 1, agg='sum')
+
+def _release(limit):
+    # The slot is handed over to the first waiter, without becoming
+    # free in between.
+    while len(limit.waiters) > 0:
+        future = limit.waiters.popleft()
+        if not future.done():
+            future.set_result(None)
+            return
+    limit.active -= 1
+
+
+def _rejection(status_code, error_msg, counter):
+    stats.set('admission.rejected.{}.last'.format(counter), 1, agg='sum')
+    response = error_response(status_code, error_msg=error_msg)
+    response.headers['Retry-After'] = str(current_app.config['HTTPKOM_ADMISSION_RETRY_AFTER'])
+    return response
+
+
+def _forget_if_idle(connection_id, limit):
+    if limit.is_idle() and _connections.get(connection_id) is limit:
+        del _connections[connection_id]
+
+
+class _Ticket(object):
+    __slots__ = ('connection_id', 'limit', 'released')
+
+    def __init__(self, connection_id, limit):
+        self.connection_id = connection_id
+        self.limit = limit
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        _release(self.limit)
+        _forget_if_idle(self.connection_id, self.limit)
+        _release(_global)
+        stats.set('admission.active.last', _global.active, agg='last')
+
+
+def active():
+    """The number of requests that are running."""
+    return _global.active
+
+
+def queued():
+    """The number of requests that are waiting to run."""
+    return _queued
+
+
+async def admit(connection_id):
+    """Wait until the current request may run. Returns None if it
+    may, and then release() must be called when it is done. Returns
+    an error response (429 or 503) if the request is rejected.
+    """
+    config = current_app.config
+    timeout = config['HTTPKOM_ADMISSION_QUEUE_TIMEOUT']
+
+    limit = _connections.get(connection_id)
+    if limit is None:
+        limit = _connections[connection_id] = _Limit()
+    try:
+        await _acquire(limit, config['HTTPKOM_MAX_REQUESTS_PER_CONNECTION'],
+                       config['HTTPKOM_MAX_QUEUED_REQUESTS_PER_CONNECTION'], timeout)
+    except BaseException as ex:
+        _forget_if_idle(connection_id, limit)
+        if isinstance(ex, _Rejected):
+            return _rejection(429, "Too many concurrent requests for this connection",
+                              'connection')
+        raise
+
+    try:
+        await _acquire(_global, config['HTTPKOM_MAX_REQUESTS'],
+                       config['HTTPKOM_MAX_QUEUED_REQUESTS'], timeout)
+    except BaseException as ex:
+        _release(limit)
+        _forget_if_idle(connection_id, limit)
+        if isinstance(ex, _Rejected):
+            return _rejection(503, "Too many concurrent requests", 'global')
+        raise
+
+    g.admission_ticket = _Ticket(connection_id, limit)
+    stats.set('admission.active.last', _global.active, agg='last')
+    return None
+
+
+def release():
+    """Release the slots of the current request, unless they have
+    been handed over to a streamed response body.
+    """
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        ticket.release()
+
+
+async def _release_after(ticket, iterator):
+    try:
+        async for item in iterator:
+            yield item
+    finally:
+        ticket.release()
+
+def release_after(iterator):
+    """Keep the slots of the current request (if any) until the async
+    iterator (a streamed response body) is done. Returns the iterator
+    to use instead.
+    """
+    ticket = g.pop('admission_ticket', None)
+    if ticket is None:
+        return iterator
+    body = _release_after(ticket, iterator)
+    # The finally in _release_after() is not run if the body is never
+    # started (for example if the client disconnected before the
+    # response was sent, or if the body was wrapped by compression),
+    # so release the ticket when the body is garbage collected too.
+    # Releasing a ticket twice does nothing.
+    finalizer = weakref.finalize(body, ticket.release)
+    finalizer.atexit = False
+    return body
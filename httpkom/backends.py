@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Budgets and circuit breakers for the LysKOM servers.
+
+Each LysKOM server may have at most
+HTTPKOM_MAX_LYSKOM_CONNECTIONS_PER_SERVER connections from httpkom,
+and at most HTTPKOM_MAX_LYSKOM_REQUESTS_PER_SERVER requests in flight
+on them (more requests wait for their turn).
+
+If connecting to a server fails (or takes longer than
+HTTPKOM_LYSKOM_CONNECT_TIMEOUT seconds), or requests to it fail with
+socket errors or time out, HTTPKOM_CIRCUIT_BREAKER_FAILURES times in
+a row, the circuit breaker for the server opens: new connections and
+requests on the existing ones fail right away with 503 Service
+Unavailable, instead of piling up. After
+HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT seconds the breaker is
+half-open, and the next new connection is let through as a probe. If
+it succeeds, the breaker is closed again, otherwise it stays open for
+another HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT seconds.
+
+Replies to requests are waited for at most
+HTTPKOM_LYSKOM_LOGIN_TIMEOUT seconds for logins,
+HTTPKOM_LYSKOM_WRITE_TIMEOUT seconds for requests that change
+something and HTTPKOM_LYSKOM_READ_TIMEOUT seconds for other requests.
+A request that times out fails with 504 Gateway Timeout, and counts as
+a failure for the circuit breaker. The session can still be used, the
+reply is thrown away when it comes. The same goes for requests that
+are cancelled, for example when the HTTP client disconnects (Quart
+cancels the request handler then).
+
+The state of each server is in /stats.
+"""
+
+from __future__ import absolute_import
+import asyncio
+import contextlib
+import contextvars
+import errno
+import logging
+import math
+import socket
+import time
+import weakref
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.aio import AioClient, AioConnection
+from pylyskom.komsession import KomSessionNotConnected
+
+from httpkom import app
+from .errors import error_response
+from .stats import stats
+from . import capture
+
+
+log = logging.getLogger("httpkom.backends")
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# For the stats sent to Graphite, which must be numbers.
+_STATE_NUMBERS = { CLOSED: 0, HALF_OPEN: 1, OPEN: 2 }
+
+# Requests that change something, for the timeouts.
+_WRITE_CALLS = frozenset(r.CALL_NO for r in (
+    requests.ReqAddComment, requests.ReqAddFootnote, requests.ReqAddMember,
+    requests.ReqAddRecipient, requests.ReqChangeConference, requests.ReqChangeName,
+    requests.ReqChangeWhatIAmDoing, requests.ReqCreateAnonymousText, requests.ReqCreateConf,
+    requests.ReqCreatePerson, requests.ReqCreateText, requests.ReqDeleteConf,
+    requests.ReqDeleteText, requests.ReqDisconnect, requests.ReqLogout, requests.ReqMarkAsRead,
+    requests.ReqMarkAsUnread, requests.ReqMarkText, requests.ReqModifyConfInfo,
+    requests.ReqModifyTextInfo, requests.ReqSendMessage, requests.ReqSetConfType,
+    requests.ReqSetExpire, requests.ReqSetGarbNice, requests.ReqSetKeepCommented,
+    requests.ReqSetLastRead, requests.ReqSetMembershipType, requests.ReqSetPasswd,
+    requests.ReqSetPermittedSubmitters, requests.ReqSetPersFlags, requests.ReqSetPresentation,
+    requests.ReqSetReadRanges, requests.ReqSetSuperConf, requests.ReqSetSupervisor,
+    requests.ReqSetUnread, requests.ReqSetUserArea, requests.ReqSubComment,
+    requests.ReqSubFootnote, requests.ReqSubMember, requests.ReqSubRecipient,
+    requests.ReqUnmarkText ))
+
+# True while connecting, so that the requests made when connecting a
+# probe are let through when the breaker is half-open.
+_connecting = contextvars.ContextVar('httpkom_lyskom_connecting', default=False)
+
+
+class LysKOMUnavailable(Exception):
+    """The LysKOM server can't be used right now (the circuit breaker
+    is open, or the connection budget is used up).
+    """
+
+    def __init__(self, server_id, reason, retry_after):
+        Exception.__init__(self, "LysKOM server {} is unavailable: {}".format(server_id, reason))
+        self.server_id = server_id
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LysKOMTimeout(Exception):
+    """The LysKOM server did not reply in time."""
+
+    def __init__(self, server_id, call_no, timeout):
+        Exception.__init__(self, "LysKOM server {} did not reply to request {} in {} s".format(
+            server_id, call_no, timeout))
+        self.server_id = server_id
+        self.call_no = call_no
+        self.timeout = timeout
+
+
+class _Backend(object):
+    """The connections to, and the circuit breaker for, one LysKOM
+    server.
+    """
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.sessions = weakref.WeakSet()
+        max_requests = app.config['HTTPKOM_MAX_LYSKOM_REQUESTS_PER_SERVER']
+        self.requests = asyncio.Semaphore(max_requests) if max_requests is not None else None
+        self.in_flight = 0
+        self.connecting = 0 # connections that have been let through by check_connect()
+        self.state = CLOSED
+        self.failures = 0 # in a row
+        self.opened_at = None
+        self.probing_since = None
+
+    def _stat(self, name, value, agg):
+        stats.set('backends.{}.{}.last'.format(self.server_id, name), value, agg=agg)
+
+    def no_of_connections(self):
+        return sum(1 for ksession in self.sessions if ksession.is_connected())
+
+    def _retry_after(self):
+        reset_timeout = app.config['HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT']
+        return max(1, math.ceil(self.opened_at + reset_timeout - time.monotonic()))
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warning("Circuit breaker for LysKOM server %s is %s (was %s)",
+                        self.server_id, state, self.state)
+            self.state = state
+        self._stat('state', _STATE_NUMBERS[state], 'last')
+
+    def check_request(self):
+        """Raise LysKOMUnavailable if requests should fail right
+        away. Only new connections are let through as probes.
+        """
+        if self.state != CLOSED and not (self.state == HALF_OPEN and _connecting.get()):
+            self._stat('rejected', 1, 'sum')
+            raise LysKOMUnavailable(self.server_id, "circuit breaker is " + self.state,
+                                    self._retry_after())
+
+    def check_connect(self):
+        """Raise LysKOMUnavailable if a new connection should not be
+        made. Otherwise a slot in the budget is reserved for it, and
+        connect_done() must be called when it has connected or
+        failed.
+        """
+        max_connections = app.config['HTTPKOM_MAX_LYSKOM_CONNECTIONS_PER_SERVER']
+        if max_connections is not None and \
+           self.no_of_connections() + self.connecting >= max_connections:
+            self._stat('connections.rejected', 1, 'sum')
+            raise LysKOMUnavailable(self.server_id, "too many connections",
+                                    app.config['HTTPKOM_ADMISSION_RETRY_AFTER'])
+
+        now = time.monotonic()
+        reset_timeout = app.config['HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT']
+        if self.state != CLOSED:
+            if now - self.opened_at < reset_timeout:
+                self._stat('rejected', 1, 'sum')
+                raise LysKOMUnavailable(self.server_id, "circuit breaker is open",
+                                        self._retry_after())
+            # Half-open: one probe at a time, but don't wait forever
+            # for a probe that hangs.
+            if self.probing_since is not None and now - self.probing_since < reset_timeout:
+                self._stat('rejected', 1, 'sum')
+                raise LysKOMUnavailable(self.server_id, "circuit breaker is half-open", 1)
+            self.probing_since = now
+            self._set_state(HALF_OPEN)
+        self.connecting += 1
+
+    def connect_done(self):
+        self.connecting -= 1
+
+    def success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            self.probing_since = None
+            self.opened_at = None
+            self._set_state(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        self._stat('failures', 1, 'sum')
+        if self.state == HALF_OPEN or \
+           self.failures >= app.config['HTTPKOM_CIRCUIT_BREAKER_FAILURES']:
+            if self.state == CLOSED:
+                self._stat('trips', 1, 'sum')
+            self.opened_at = time.monotonic()
+            self.probing_since = None
+            self._set_state(OPEN)
+
+    def health(self):
+        return dict(state=self.state, failures_in_a_row=self.failures,
+                    connections=self.no_of_connections(), connecting=self.connecting,
+                    requests_in_flight=self.in_flight)
+
+
+_backends = {} # server id -> _Backend
+
+
+def get_backend(server_id):
+    backend = _backends.get(server_id)
+    if backend is None:
+        backend = _backends[server_id] = _Backend(server_id)
+    return backend
+
+
+def record_failure(server_id):
+    """Count a failure (for example a timeout) for the circuit
+    breaker of the server.
+    """
+    get_backend(server_id).failure()
+
+
+def health():
+    """The state of each LysKOM server that has been used, for
+    /stats.
+    """
+    return dict(('httpkom.backends.{}.{}'.format(server_id, key), value)
+                for server_id, backend in _backends.items()
+                for key, value in backend.health().items())
+
+
+def _call_no(request):
+    if isinstance(request, bytes):
+        return int(request.split(b' ', 1)[0])
+    return request.CALL_NO
+
+def _timeout(call_no):
+    if call_no == requests.Requests.LOGIN:
+        return app.config['HTTPKOM_LYSKOM_LOGIN_TIMEOUT']
+    elif call_no in _WRITE_CALLS:
+        return app.config['HTTPKOM_LYSKOM_WRITE_TIMEOUT']
+    return app.config['HTTPKOM_LYSKOM_READ_TIMEOUT']
+
+
+class _Client(AioClient):
+    """AioClient that keeps to the budget, the circuit breaker and the
+    timeouts of the server, and counts the requests for capture.py.
+
+    This overrides private methods of AioClient and uses its private
+    attributes, so it is written for (and pylyskom is pinned to) the
+    exact pylyskom version in setup.py.
+    """
+
+    def __init__(self, conn, backend):
+        AioClient.__init__(self, conn)
+        self._backend = backend
+
+    def _reset_vars(self):
+        AioClient._reset_vars(self)
+        # Ref-nos of requests that timed out or were cancelled, whose
+        # replies should be thrown away.
+        self._abandoned = set()
+        # True when we have asked the server to disconnect us, so
+        # that the server closing the connection is expected.
+        self._disconnecting = False
+
+    async def _request(self, request, *, return_bytes=False):
+        capture.count_lyskom_request()
+        backend = self._backend
+        backend.check_request()
+        if _call_no(request) == requests.Requests.DISCONNECT:
+            self._disconnecting = True
+        async with backend.requests or contextlib.nullcontext():
+            backend.in_flight += 1
+            try:
+                reply = await self._send_and_wait(request, return_bytes)
+            except komerror.Error:
+                # The server answered.
+                backend.success()
+                raise
+            except (OSError, LysKOMTimeout):
+                backend.failure()
+                raise
+            finally:
+                backend.in_flight -= 1
+        backend.success()
+        return reply
+
+    async def _send_and_wait(self, request, return_bytes):
+        # Same as AioClient._request(), but with a timeout, and
+        # without leaving anything behind (or killing the response
+        # receiver, which expects a waiter for every reply) when
+        # cancelled.
+        async with self._send_lock:
+            try:
+                ref_no = await self._conn.send_request(request)
+            except asyncio.CancelledError:
+                # Cancelled when draining, the request has been
+                # written.
+                self._abandon(self._conn._ref_no)
+                raise
+            event = self._outstanding_requests_events[ref_no] = asyncio.Event()
+
+        call_no = _call_no(request)
+        timeout = _timeout(call_no)
+        try:
+            if timeout is None:
+                await event.wait()
+            else:
+                await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(ref_no)
+            stats.set('backends.{}.timeouts.last'.format(self._backend.server_id), 1, agg='sum')
+            raise LysKOMTimeout(self._backend.server_id, call_no, timeout)
+        except asyncio.CancelledError:
+            self._abandon(ref_no)
+            stats.set('backends.{}.cancelled.last'.format(self._backend.server_id), 1, agg='sum')
+            raise
+        del self._outstanding_requests_events[ref_no]
+        return self._handle_reply(ref_no, return_bytes=return_bytes)
+
+    def _handle_reply(self, ref_no, *, return_bytes=False):
+        ok_reply, error_reply, reply_bytes = self._reply_queue[ref_no]
+        if return_bytes and reply_bytes is None and error_reply is not None:
+            # Failed by _fail_waiting(), there is no reply from the
+            # server to return to raw_request().
+            del self._reply_queue[ref_no]
+            raise error_reply
+        return AioClient._handle_reply(self, ref_no, return_bytes=return_bytes)
+
+    def _abandon(self, ref_no):
+        event = self._outstanding_requests_events.pop(ref_no, None)
+        if event is not None and event.is_set():
+            # The reply came anyway.
+            self._reply_queue.pop(ref_no, None)
+        else:
+            self._abandoned.add(ref_no)
+
+    async def _receive_response(self, response):
+        ref_no = response[0]
+        if ref_no is not None and ref_no in self._abandoned:
+            self._abandoned.remove(ref_no)
+            return
+        await AioClient._receive_response(self, response)
+
+    async def _run_response_receiver(self):
+        # Same loop as AioClient._run_response_receiver(), but the
+        # connection being closed is not logged as an error.
+        try:
+            while self.is_connected():
+                response = await self._conn.read_response()
+                await self._receive_response(response)
+        except (komerror.ReceiveError, OSError) as ex:
+            if self._disconnecting:
+                log.debug("Disconnected from LysKOM server %s", self._backend.server_id)
+            else:
+                log.warning("Connection to LysKOM server %s lost: %s",
+                            self._backend.server_id, ex)
+        except Exception:
+            log.exception("Response receiver for LysKOM server %s failed",
+                          self._backend.server_id)
+        # The receiver stops (without being cancelled) when the
+        # connection is lost. Close it, so that it isn't counted as
+        # connected, and fail the requests that wait for replies
+        # instead of leaving them waiting forever.
+        if self._conn is None or not self._conn.is_connected():
+            return
+        lost = list(self._outstanding_requests_events.items())
+        if self._asyncmsg_receiver_task is not None:
+            self._asyncmsg_receiver_task.cancel()
+        with contextlib.suppress(Exception):
+            await self._conn.close()
+        self._fail_waiting(lost, lambda: ConnectionResetError(
+            errno.ECONNRESET, "Connection to LysKOM server lost"))
+
+    async def close(self):
+        # Requests that wait for replies when the session is closed by
+        # us (for example when httpkom is drained) would otherwise
+        # wait until they time out. It is not a failure of the server.
+        lost = list(self._outstanding_requests_events.items())
+        try:
+            await AioClient.close(self)
+        finally:
+            self._fail_waiting(lost, lambda: KomSessionNotConnected("LysKOM session closed"))
+
+    def _fail_waiting(self, lost, make_error):
+        for ref_no, event in lost:
+            self._reply_queue[ref_no] = (None, make_error(), None)
+            event.set()
+
+
+def create_client(server_id):
+    """Client (to be wrapped in a caching client for AioKomSession)
+    for the server server_id.
+    """
+    return _Client(AioConnection(), get_backend(server_id))
+
+
+async def connect(ksession, server, client_name, client_version):
+    """Connect ksession (made with a client from create_client()) to
+    server, if the budget and circuit breaker for it allow it.
+    Raises LysKOMUnavailable if not, or if the connection fails.
+    """
+    backend = get_backend(server.id)
+    backend.check_connect()
+    # wait_for() runs the connect in a new task, with a copy of the
+    # context.
+    token = _connecting.set(True)
+    try:
+        await asyncio.wait_for(
+            ksession.connect(server.host, server.port, "httpkom", socket.getfqdn(),
+                             client_name, client_version),
+            app.config['HTTPKOM_LYSKOM_CONNECT_TIMEOUT'])
+    except (OSError, EOFError, asyncio.TimeoutError, komerror.BadInitialResponse) as ex:
+        backend.failure()
+        log.warning("Failed to connect to LysKOM server %s: %r", server.id, ex)
+        with contextlib.suppress(Exception):
+            await ksession.close()
+        retry_after = backend._retry_after() if backend.state == OPEN else 1
+        raise LysKOMUnavailable(server.id, "failed to connect", retry_after) from ex
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await ksession.close()
+        raise
+    finally:
+        _connecting.reset(token)
+        # There is no await between this and adding the session, so
+        # the slot is handed over without becoming free in between.
+        backend.connect_done()
+    backend.success()
+    backend.sessions.add(ksession)
+
+
+@app.errorhandler(LysKOMTimeout)
+async def lyskom_timeout(error):
+    app.logger.warning("%s", error)
+    stats.set('http.errors.lyskomtimeout.last', 1, agg='sum')
+    return error_response(504, error_msg=str(error))
+
+
+@app.errorhandler(LysKOMUnavailable)
+async def lyskom_unavailable(error):
+    stats.set('http.errors.lyskomunavailable.last', 1, agg='sum')
+    response = error_response(503, error_msg=str(error))
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
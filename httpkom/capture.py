@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Capture of request metadata, for replaying the traffic later
+(benchmarks/replay.py).
+
+If HTTPKOM_CAPTURE_FILE is set, one JSON object per line is written to
+it for each request: when it started, the route and its arguments,
+the query parameters, a hash of the connection id, the status, how
+long it took (until the response was ready, streamed bodies are sent
+after that) and the number of LysKOM requests it made.
+
+Nothing that identifies a person is written. Person, conference, text
+and session numbers are replaced with hashes (with a key that is
+random for each process, so they can't be looked up), except that a
+person number that is the logged in person is written as "self".
+Request bodies are not written, only the keys with lists in them and
+the length of the lists, the numbers above and a few keys with
+numbers that say nothing about the user (for example no_of_unread).
+Only known query parameters are written with their values.
+
+HTTPKOM_CAPTURE_SAMPLE_RATE is the fraction of the connections to
+capture. All requests of a captured connection are captured.
+"""
+
+from __future__ import absolute_import
+import contextvars
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+from quart import g, request, has_request_context
+
+from httpkom import app, HTTPKOM_CONNECTION_HEADER
+from .stats import stats
+
+
+# Query parameters whose values are written.
+_QUERY_PARAMS = frozenset([
+    'unread', 'passive', 'first', 'no-of-memberships', 'no-of-texts', 'local-no', 'direction',
+    'full-text', 'micro', 'fields', 'want-pers', 'want-confs', 'since' ])
+
+# Keys in request bodies whose (number) values are written.
+_BODY_NUMBERS = frozenset([ 'no_of_unread', 'priority', 'where', 'type', 'invisible' ])
+
+# Keys in request bodies with person, conference or text numbers.
+_BODY_IDS = frozenset([ 'pers_no', 'conf_no', 'text_no' ])
+
+# Flush the file at least this often (seconds).
+_FLUSH_INTERVAL = 1.0
+
+_KEY = secrets.token_bytes(16)
+
+
+# The LysKOM requests made for the current HTTP request are counted in
+# a _CallCounter in a context variable. The view and the hooks run in
+# the same task, so they see the same counter. Tasks started by the
+# request get a copy of the context, so background tasks that go on
+# after the request must call detach_from_request().
+
+class _CallCounter(object):
+    __slots__ = ('calls',)
+
+    def __init__(self):
+        self.calls = 0
+
+_call_counter = contextvars.ContextVar('httpkom_lyskom_calls', default=None)
+
+
+def count_lyskom_request():
+    """Called by the LysKOM client (backends.py) for each request."""
+    counter = _call_counter.get()
+    if counter is not None:
+        counter.calls += 1
+
+
+def detach_from_request():
+    """Don't count the LysKOM requests made by the current task (a
+    background task started by an HTTP request) for that request.
+    """
+    _call_counter.set(None)
+
+
+def _pseudonym(value):
+    return hmac.new(_KEY, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+
+class _CaptureFile(object):
+    def __init__(self, path):
+        self.path = path.format(pid=os.getpid())
+        self._file = open(self.path, 'a', buffering=64 * 1024, encoding='utf-8')
+        self._last_flush = time.monotonic()
+
+    def write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        now = time.monotonic()
+        if now - self._last_flush > _FLUSH_INTERVAL:
+            self._file.flush()
+            self._last_flush = now
+
+    def close(self):
+        self._file.close()
+
+_capture_file = None
+
+
+def _get_capture_file():
+    global _capture_file
+    path = app.config['HTTPKOM_CAPTURE_FILE']
+    if path is None:
+        return None
+    if _capture_file is None:
+        _capture_file = _CaptureFile(path)
+    return _capture_file
+
+
+def _is_sampled(connection_id):
+    rate = app.config['HTTPKOM_CAPTURE_SAMPLE_RATE']
+    if rate >= 1:
+        return True
+    # The same connection id is always sampled, or never.
+    return int(_pseudonym(connection_id), 16) < rate * 16**12
+
+
+def _anonymize_id(name, value, logged_in_pers_no):
+    if value == 0:
+        # 0 is "current", "none" or "all", depending on the route.
+        return 0
+    elif name == 'pers_no' and value == logged_in_pers_no:
+        return 'self'
+    return _pseudonym(value)
+
+
+def _view_args(logged_in_pers_no):
+    return dict((name, _anonymize_id(name, value, logged_in_pers_no))
+                for name, value in (request.view_args or {}).items())
+
+
+async def _body_summary(logged_in_pers_no):
+    body = await request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return None
+    lists = {}
+    values = {}
+    for key, value in body.items():
+        if isinstance(value, list):
+            lists[key] = len(value)
+        elif key in _BODY_NUMBERS and isinstance(value, (int, float)):
+            values[key] = value
+        elif key in _BODY_IDS and value is not None:
+            values[key] = _anonymize_id(key, value, logged_in_pers_no)
+    return dict(lists=lists, values=values)
+
+
+@app.before_request
+async def start_capture():
+    if app.config['HTTPKOM_CAPTURE_FILE'] is None:
+        return
+    g.capture_start = time.time()
+    g.capture_t0 = time.perf_counter()
+    g.capture_calls = _CallCounter()
+    _call_counter.set(g.capture_calls)
+
+
+@app.after_request
+async def capture_request(response):
+    if not has_request_context() or 'capture_t0' not in g:
+        return response
+    seconds = time.perf_counter() - g.capture_t0
+    try:
+        connection_id = request.headers.get(HTTPKOM_CONNECTION_HEADER) or \
+            request.args.get(HTTPKOM_CONNECTION_HEADER) or \
+            response.headers.get(HTTPKOM_CONNECTION_HEADER)
+        if connection_id is not None and not _is_sampled(connection_id):
+            return response
+        ksession = g.get('ksession')
+        logged_in_pers_no = None
+        if ksession is not None and ksession.is_connected():
+            logged_in_pers_no = await ksession.get_current_person_no()
+        record = dict(
+            t=round(g.capture_start, 3),
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule is not None else None,
+            args=_view_args(logged_in_pers_no),
+            query=dict((k, v if k in _QUERY_PARAMS else None) for k, v in request.args.items()
+                       if k != HTTPKOM_CONNECTION_HEADER),
+            conn=None if connection_id is None else _pseudonym(connection_id),
+            status=response.status_code,
+            ms=round(seconds * 1000, 3),
+            lyskom_calls=g.capture_calls.calls)
+        if request.method in ('POST', 'PUT'):
+            record['body'] = await _body_summary(logged_in_pers_no)
+        _get_capture_file().write(record)
+        stats.set('capture.requests.last', 1, agg='sum')
+    except Exception:
+        app.logger.exception("Failed to capture request")
+    return response
+
+
+@app.after_serving
+async def close_capture_file():
+    global _capture_file
+    if _capture_file is not None:
+        _capture_file.close()
+        _capture_file = None
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Compression of responses.
+
+Responses with a compressible mimetype (JSON, text bodies, ...) are
+compressed with brotli or gzip, whichever the client prefers in
+Accept-Encoding. brotli is only used if the brotli module is installed
+(it is an optional dependency). Responses smaller than
+HTTPKOM_COMPRESSION_MIN_SIZE bytes are not compressed, it is not worth
+it. Streamed responses are compressed chunk by chunk.
+
+A view can set a cache key on its response with set_cache_key(), if
+the body is always the same for that key (text bodies can't be
+changed, for example). The compressed bodies are then kept in a cache
+shared by all sessions, so they are only compressed once. The cache
+is only used after the view has made the response, so the session
+must still be allowed to get the body.
+"""
+
+from __future__ import absolute_import
+import time
+import zlib
+from collections import OrderedDict
+
+from quart import request, has_request_context
+from quart.wrappers.response import DataBody, IOBody, IterableBody
+
+from httpkom import app
+from .stats import stats
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# In order of preference, when the client accepts more than one with
+# the same quality.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+_GZIP_LEVEL = 6
+_BROTLI_QUALITY = 5
+# Cached bodies are only compressed once, so spend more time on them.
+_CACHED_GZIP_LEVEL = 9
+_CACHED_BROTLI_QUALITY = 9
+
+_COMPRESSIBLE_MIMETYPES = frozenset([
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml' ])
+
+
+def _is_compressible(mimetype):
+    if mimetype is None:
+        return False
+    return mimetype.startswith('text/') or mimetype in _COMPRESSIBLE_MIMETYPES or \
+        mimetype.endswith('+json') or mimetype.endswith('+xml')
+
+
+def choose_encoding(accept_encodings):
+    """Return the encoding to use for a request with the parsed
+    Accept-Encoding header accept_encodings (request.accept_encodings),
+    or None for no compression.
+    """
+    best = None
+    best_quality = 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+class _Compressor(object):
+    def __init__(self, encoding, cached=False):
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(
+                quality=_CACHED_BROTLI_QUALITY if cached else _BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._brotli = None
+            # wbits 31 means a gzip header and trailer
+            self._zlib = zlib.compressobj(
+                _CACHED_GZIP_LEVEL if cached else _GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        if self._brotli is not None:
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self):
+        """Flush, so that the client can decompress everything so far."""
+        if self._brotli is not None:
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def compress(data, encoding, cached=False):
+    t0 = time.perf_counter()
+    compressor = _Compressor(encoding, cached)
+    compressed = compressor.process(data) + compressor.finish()
+    _record(encoding, len(data), len(compressed), time.perf_counter() - t0)
+    return compressed
+
+
+def _record(encoding, bytes_in, bytes_out, seconds):
+    stats.set('compression.{}.bytes.in.last'.format(encoding), bytes_in, agg='sum')
+    stats.set('compression.{}.bytes.out.last'.format(encoding), bytes_out, agg='sum')
+    stats.set('compression.{}.seconds.last'.format(encoding), seconds, agg='sum')
+
+
+_cache = OrderedDict() # (cache key, encoding) -> compressed bytes
+_cache_size = 0 # bytes
+
+def _get_cached(key, encoding, data):
+    global _cache_size
+    entry = _cache.get((key, encoding))
+    if entry is not None:
+        stats.set('compression.cache.hits.last', 1, agg='sum')
+        _cache.move_to_end((key, encoding))
+        return entry
+
+    stats.set('compression.cache.misses.last', 1, agg='sum')
+    compressed = compress(data, encoding, cached=True)
+    max_size = app.config['HTTPKOM_COMPRESSION_CACHE_MAX_BYTES']
+    if len(compressed) <= max_size:
+        _cache[(key, encoding)] = compressed
+        _cache_size += len(compressed)
+        while _cache_size > max_size:
+            _, evicted = _cache.popitem(last=False)
+            _cache_size -= len(evicted)
+    stats.set('compression.cache.bytes.last', _cache_size, agg='last')
+    return compressed
+
+
+def set_cache_key(response, key):
+    """Let the compressed body of response be cached with key (a
+    hashable). The body must always be the same for the same key.
+    """
+    response.compression_cache_key = key
+    return response
+
+
+async def _compress_stream(body, encoding):
+    compressor = _Compressor(encoding)
+    stats.set('compression.{}.streamed.last'.format(encoding), 1, agg='sum')
+    try:
+        async for chunk in body:
+            t0 = time.perf_counter()
+            compressed = compressor.process(chunk) + compressor.flush()
+            _record(encoding, len(chunk), len(compressed), time.perf_counter() - t0)
+            yield compressed
+        yield compressor.finish()
+    finally:
+        await body.aclose()
+
+
+@app.after_request
+async def compress_response(response):
+    if not has_request_context():
+        return response
+    min_size = app.config['HTTPKOM_COMPRESSION_MIN_SIZE']
+    if min_size is None or request.method == 'HEAD' or \
+       response.status_code < 200 or response.status_code in (204, 206, 304) or \
+       'Content-Encoding' in response.headers or not _is_compressible(response.mimetype):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if isinstance(response.response, IterableBody):
+        # Streamed, so we don't know the size. Assume that it is
+        # large.
+        response.response = response.iterable_body_class(
+            _compress_stream(response.response.iter, encoding))
+        response.content_length = None
+    elif isinstance(response.response, (DataBody, IOBody)):
+        data = await response.get_data()
+        if len(data) < min_size:
+            stats.set('compression.skipped.small.last', 1, agg='sum')
+            response.set_data(data) # get_data() has consumed an IOBody
+            return response
+        cache_key = getattr(response, 'compression_cache_key', None)
+        if cache_key is None:
+            response.set_data(compress(data, encoding))
+        else:
+            response.set_data(_get_cached(cache_key, encoding, data))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    stats.set('compression.{}.responses.last'.format(encoding), 1, agg='sum')
+    return response
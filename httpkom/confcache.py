@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Shared cache of serialized conference status.
+
+The same conferences (for example the news conferences) are asked for
+over and over again, by many sessions. The conference status is the
+same for every session that is allowed to see the conference, so we
+keep the serialized status (both the micro and the full variant) per
+(server id, conf_no) for a short time. Entries are removed when any
+of our sessions receives an async message that changes the
+conference.
+
+Secret conferences are never cached. Neither are full conferences
+that have secret aux items, or that refer to conferences (supervisor,
+super conference, ...) that are secret or that the session can't
+see, since those depend on who is asking.
+"""
+
+from __future__ import absolute_import
+import time
+from collections import OrderedDict
+
+from quart import current_app
+
+import pylyskom.errors as komerror
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komsession import KomPersonName
+
+from .komserialization import to_dict
+from .stats import stats
+
+
+_cache = OrderedDict() # (server_id, conf_no, micro) -> (expires_at, dict)
+
+
+def _get(key):
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.time():
+        del _cache[key]
+        return None
+    _cache.move_to_end(key)
+    return entry[1]
+
+def _put(key, d):
+    _cache[key] = (time.time() + current_app.config['HTTPKOM_CONFERENCE_CACHE_TTL'], d)
+    _cache.move_to_end(key)
+    while len(_cache) > current_app.config['HTTPKOM_CONFERENCE_CACHE_MAX_ENTRIES']:
+        _cache.popitem(last=False)
+        stats.set('confcache.evictions.last', 1, agg='sum')
+
+def invalidate(server_id, conf_no):
+    _cache.pop((server_id, conf_no, True), None)
+    _cache.pop((server_id, conf_no, False), None)
+
+
+async def _is_public(ksession, conf_no):
+    if conf_no == 0:
+        return True
+    try:
+        uconf = await ksession.get_conference(conf_no, micro=True)
+    except komerror.UndefinedConference:
+        return False
+    return not uconf.type.secret
+
+async def _is_cacheable(ksession, conf, micro):
+    if conf.type.secret:
+        return False
+    if micro:
+        return True
+    # KomPersonName, KomConferenceName or KomUConference
+    refs = [ conf.creator, conf.supervisor, conf.permitted_submitters, conf.super_conf ]
+    if conf.aux_items is not None:
+        # Secret aux items are only shown to some of the sessions.
+        if any(ai.flags.secret for ai in conf.aux_items):
+            return False
+        refs.extend(ai.creator for ai in conf.aux_items)
+    for ref in refs:
+        if ref is None:
+            continue
+        ref_no = ref.pers_no if isinstance(ref, KomPersonName) else ref.conf_no
+        if not await _is_public(ksession, ref_no):
+            return False
+    return True
+
+
+async def get_conference_dict(ksession, server_id, conf_no, micro=True, fields=None):
+    """Same as to_dict(await ksession.get_conference(conf_no, micro)),
+    but from the cache if possible. The returned dict must not be
+    modified.
+
+    Raises UndefinedConference if the conference does not exist (for
+    this session).
+    """
+    key = (server_id, conf_no, micro)
+    d = _get(key)
+    if d is None:
+        stats.set('confcache.misses.last', 1, agg='sum')
+        conf = await ksession.get_conference(conf_no, micro)
+        d = await to_dict(conf, ksession)
+        if await _is_cacheable(ksession, conf, micro):
+            _put(key, d)
+        else:
+            stats.set('confcache.uncacheable.last', 1, agg='sum')
+    else:
+        stats.set('confcache.hits.last', 1, agg='sum')
+    stats.set('confcache.entries.last', len(_cache), agg='last')
+
+    if fields is not None:
+        d = dict((k, v) for k, v in d.items() if k in fields)
+    return d
+
+
+async def register_async_handlers(ksession, server_id):
+    """Invalidate the cached conferences for server_id that are changed
+    by the async messages received by ksession.
+    """
+    async def invalidate_conf(msg):
+        invalidate(server_id, msg.conf_no)
+
+    async def invalidate_recipients(msg):
+        for rcpt in msg.text_stat.misc_info.recipient_list:
+            invalidate(server_id, rcpt.recpt)
+
+    # The caching client in pylyskom already accepts these async
+    # messages.
+    client = ksession._client
+    for msg_no in (AsyncMessages.NEW_NAME, AsyncMessages.LEAVE_CONF, AsyncMessages.NEW_RECIPIENT,
+                   AsyncMessages.SUB_RECIPIENT, AsyncMessages.NEW_MEMBERSHIP,
+                   AsyncMessages.NEW_PRESENTATION):
+        await client.register_async_handler(msg_no, invalidate_conf, skip_accept_async=True)
+    for msg_no in (AsyncMessages.NEW_TEXT, AsyncMessages.DELETED_TEXT):
+        await client.register_async_handler(msg_no, invalidate_recipients, skip_accept_async=True)
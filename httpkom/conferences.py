@@ -2,7 +2,7 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
-from quart import g, request, jsonify
+from quart import g, request, jsonify, current_app
 
 import pylyskom.errors as komerror
 
@@ -10,8 +10,20 @@ from .komserialization import to_dict
 
 from httpkom import bp
 from .errors import error_response
-from .misc import empty_response, get_bool_arg_with_default
-from .sessions import requires_session, requires_login
+from .jsonbackend import stream_response
+from .misc import empty_response, get_bool_arg_with_default, get_fields_arg, is_list_of_ints
+from .sessions import check_connected, requires_session, requires_login
+from . import confcache
+from . import names
+from . import readmarkings
+from . import unreads
+from .textmaps import cached_local_to_global, local_to_global
+from .texts import get_text_without_body
+
+
+# Fields that exist both in the micro (UConference) and the full
+# (Conference) conference information.
+_UCONFERENCE_FIELDS = frozenset(['conf_no', 'name', 'type', 'nice'])
 
 
 @bp.route('/conferences/')
@@ -69,7 +81,9 @@ async def conferences_list():
     want_confs = get_bool_arg_with_default(request.args, 'want-confs', True)
         
     try:
-        lookup = await g.ksession.lookup_name(name, want_pers, want_confs)
+        lookup = await names.lookup_name(
+            g.ksession, g.server, name, want_pers, want_confs,
+            current_app.config['HTTPKOM_NAME_INDEX_MAX_AGE'], await g.ksession.is_logged_in())
         confs = [ dict(conf_no=t[0], name=t[1]) for t in lookup ]
         return jsonify(dict(conferences=confs))
     except komerror.Error as ex:
@@ -88,6 +102,10 @@ async def conferences_get(conf_no):
     =======  =======  =================================================================
     micro    boolean  :true: (Default) Return micro conference information (`UConference <http://www.lysator.liu.se/lyskom/protocol/11.1/protocol-a.html#Conferences>`_) which causes less load on the server.
                       :false: Return full conference information.
+    fields   string   Comma separated list of the fields to include in the response,
+                      for example "conf_no,name". If all of the fields exist in the
+                      micro conference information, it will be used even if
+                      micro=false. Default: all fields.
     =======  =======  =================================================================
     
     .. rubric:: Request
@@ -179,8 +197,11 @@ async def conferences_get(conf_no):
     """
     try:
         micro = get_bool_arg_with_default(request.args, 'micro', True)
-        return jsonify(await to_dict(await g.ksession.get_conference(conf_no, micro),
-                                     g.ksession))
+        fields = get_fields_arg(request.args)
+        if fields is not None and fields <= _UCONFERENCE_FIELDS:
+            micro = True
+        return jsonify(await confcache.get_conference_dict(
+            g.ksession, g.server.id, conf_no, micro, fields))
     except komerror.UndefinedConference as ex:
         return error_response(404, kom_error=ex)
 
@@ -196,6 +217,54 @@ async def conferences_put_text_read_marking(conf_no, local_text_no):
     
       PUT /<server_id>/conferences/14506/texts/29/read-marking HTTP/1.1
     
+    .. rubric:: Responses
+    
+    Success::
+    
+      HTTP/1.1 201 Created
+    
+    Conference or text does not exist::
+    
+      HTTP/1.1 404 Not Found
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X PUT "http://localhost:5001/lyskom/conferences/14506/texts/29/read-marking"
+    
+    """
+    check_connected(g.ksession)
+    try:
+        await g.ksession._client.mark_as_read_local(conf_no, local_text_no)
+    except (komerror.UndefinedConference, komerror.NoSuchLocalText) as ex:
+        return error_response(404, kom_error=ex)
+    unreads.text_read_local(
+        g.ksession, conf_no, cached_local_to_global(g.server.id, conf_no, local_text_no))
+    return empty_response(201)
+
+
+@bp.route('/conferences/<int:conf_no>/texts/read-marking', methods=['POST'])
+@requires_login
+async def conferences_post_text_read_markings(conf_no):
+    """Mark many texts as read in the specified recipient conference
+    (only). The texts are given as a list of local text numbers and/or
+    as ranges of local text numbers (inclusive). They are sent to the
+    LysKOM server in as few requests as possible.
+    
+    .. rubric:: Request
+    
+    ::
+    
+      POST /<server_id>/conferences/14506/texts/read-marking HTTP/1.1
+      
+      {
+        "local_text_nos": [ 29, 31 ],
+        "ranges": [
+          { "first_local_no": 40, "last_local_no": 120 }
+        ]
+      }
+    
     .. rubric:: Response
     
     ::
@@ -206,35 +275,91 @@ async def conferences_put_text_read_marking(conf_no, local_text_no):
     
     ::
     
-      curl -v -X PUT "http://localhost:5001/lyskom/conferences/14506/texts/29/read-marking"
+      curl -v -X POST -H "Content-Type: application/json" \\
+           -d '{ "ranges": [ { "first_local_no": 1, "last_local_no": 120 } ] }' \\
+           "http://localhost:5001/lyskom/conferences/14506/texts/read-marking"
     
     """
-    # TODO: handle conferences/texts that doesn't exist (i.e. return 404).
-    await g.ksession.mark_as_read_local(local_text_no, conf_no)
+    request_json = await request.json
+    try:
+        local_text_nos = request_json.get('local_text_nos', [])
+        if not is_list_of_ints(local_text_nos):
+            return error_response(400, error_msg='"local_text_nos" must be a list of integers.')
+        request_ranges = request_json.get('ranges', [])
+        if not isinstance(request_ranges, list):
+            return error_response(400, error_msg='"ranges" must be a list.')
+        ranges = []
+        for r in request_ranges:
+            first, last = int(r['first_local_no']), int(r['last_local_no'])
+            if first < 1 or last < first:
+                return error_response(400, error_msg='Invalid range.')
+            ranges.append((first, last))
+        # Count the texts before making any sets of them, so that a
+        # large body can't make us build huge sets.
+        n = len(local_text_nos) + sum(last - first + 1 for first, last in ranges)
+        if n > readmarkings.MAX_TEXTS:
+            return error_response(400, error_msg='Too many texts.')
+        local_nos = set(local_text_nos)
+        if any(local_no < 1 for local_no in local_nos):
+            return error_response(400, error_msg='Invalid local text number.')
+        for first, last in ranges:
+            local_nos.update(range(first, last + 1))
+    except (AttributeError, TypeError, KeyError, ValueError):
+        return error_response(400, error_msg='Invalid "local_text_nos" or "ranges".')
+
+    try:
+        uconf = await g.ksession.get_conference(conf_no, micro=True)
+    except komerror.UndefinedConference as ex:
+        return error_response(404, kom_error=ex)
+    # Ranges may go past the last text in the conference.
+    local_nos = [ local_no for local_no in local_nos if local_no <= uconf.highest_local_no ]
+
+    await readmarkings.mark_as_read_locals(g.ksession, { conf_no: local_nos })
+    for local_no in local_nos:
+        unreads.text_read_local(
+            g.ksession, conf_no, cached_local_to_global(g.server.id, conf_no, local_no))
     return empty_response(201)
 
 
 @bp.route('/conferences/<int:conf_no>/texts/')
 @requires_session
 async def conferences_get_texts(conf_no):
-    """Get the last created texts in the conference. Returns all text
-    stats, but not the subject or body.
+    """Get texts in the conference, one page at a time. By default the
+    last created texts are returned. Returns all text stats, but not
+    the subject or body (unless full-text=true).
     
-    TODO: Query parameters for pagination.
+    The texts are paginated by local text number. Texts are returned
+    in ascending local text number order, and the response contains
+    the first and last local text number of the page. To get the
+    previous page, use direction=backwards and local-no set to
+    first_local_no - 1. To get the next page, use direction=forwards
+    and local-no set to last_local_no + 1.
     
     Query parameters:
     
     ===========  =======  =================================================================
     Key          Type     Values
     ===========  =======  =================================================================
-    no-of-texts  integer  Number of text numbers to return. Default: 10
+    no-of-texts  integer  Number of texts to return, at least 1. Default: 10. At most
+                          HTTPKOM_MAX_TEXTS_PER_PAGE texts are returned.
+    local-no     integer  The local text number to start from (inclusive). Default: The
+                          last text when going backwards, and the first text when going
+                          forwards.
+    direction    string   :backwards: (Default) Return texts with local text numbers at or
+                                      below local-no.
+                          :forwards: Return texts with local text numbers at or above
+                                     local-no.
+    full-text    boolean  :true: Also return subject and body for each text.
+                          :false: (Default) Only return the text stats.
+    fields       string   Comma separated list of the fields to include for each text,
+                          for example "text_no,subject,author". Default: all fields.
     ===========  =======  =================================================================
     
     .. rubric:: Request
     
     ::
     
-      GET /<server_id>/conferences/texts/ HTTP/1.0
+      GET /<server_id>/conferences/14506/texts/?no-of-texts=10&local-no=28 HTTP/1.0
     
     .. rubric:: Response
     
@@ -243,6 +368,9 @@ async def conferences_get_texts(conf_no):
       HTTP/1.0 200 OK
       
       {
+        "first_local_no": 19,
+        "last_local_no": 28,
+        "has_more": true,
         "texts": [
           {
             "recipient_list": [
@@ -252,7 +380,7 @@ async def conferences_get_texts(conf_no):
                   "name": "Oskars Testperson",
                 },
                 "type": "to",
-                "loc_no": 29,
+                "loc_no": 19,
               }
             ],
             "author": {
@@ -270,14 +398,66 @@ async def conferences_get_texts(conf_no):
         ]
       }
     
+    "has_more" tells if there are more texts in the requested
+    direction. If there are no texts in the page, "first_local_no" and
+    "last_local_no" will be null.
+    
+    Conference does not exist::
+    
+      HTTP/1.0 404 NOT FOUND
+    
     .. rubric:: Example
     
     ::
     
       curl -v -X GET -H "Content-Type: application/json" \\
-           "http://localhost:5001/lyskom/conferences/texts/?no-of-texts=3"
+           "http://localhost:5001/lyskom/conferences/14506/texts/?no-of-texts=3"
     
     """
-    no_of_texts = int(request.args.get('no-of-texts', 10))
-    texts = await g.ksession.get_last_texts(conf_no, no_of_texts)
-    return jsonify(texts=await to_dict(texts, g.ksession))
+    try:
+        no_of_texts = int(request.args.get('no-of-texts', 10))
+        local_no = request.args.get('local-no', None)
+        if local_no is not None:
+            local_no = int(local_no)
+    except ValueError:
+        return error_response(400, error_msg='Invalid "no-of-texts" or "local-no".')
+    if no_of_texts < 1:
+        return error_response(400, error_msg='Invalid "no-of-texts".')
+    no_of_texts = min(no_of_texts, current_app.config['HTTPKOM_MAX_TEXTS_PER_PAGE'])
+    direction = request.args.get('direction', 'backwards')
+    if direction not in ('backwards', 'forwards'):
+        return error_response(400, error_msg='Invalid "direction".')
+    full_text = get_bool_arg_with_default(request.args, 'full-text', False)
+    fields = get_fields_arg(request.args)
+
+    try:
+        mapping, has_more = await local_to_global(
+            g.ksession, g.server.id, conf_no, local_no, no_of_texts, direction == 'backwards')
+    except komerror.UndefinedConference as ex:
+        return error_response(404, kom_error=ex)
+
+    if len(mapping) > 0:
+        first_local_no = mapping[0][0]
+        last_local_no = mapping[-1][0]
+    else:
+        first_local_no = None
+        last_local_no = None
+
+    ksession = g.ksession
+
+    async def texts():
+        for _, text_no in mapping:
+            try:
+                if full_text:
+                    text = await ksession.get_text(text_no)
+                else:
+                    text = await get_text_without_body(ksession, text_no, fields)
+            except (komerror.NoSuchText, komerror.TextZero):
+                # The text has been deleted since we got the mapping.
+                continue
+            yield await to_dict(text, ksession, fields)
+
+    return await stream_response(
+        dict(first_local_no=first_local_no, last_local_no=last_local_no, has_more=has_more),
+        'texts', texts())
+
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Graceful drain, so that httpkom can be stopped (for example in a
+rolling deploy) without losing requests that are running.
+
+When httpkom is drained, on SIGTERM or SIGINT (see __main__) or with
+POST /admin/drain:
+
+1. New sessions, and new requests in the existing sessions, are
+   rejected with 503 Service Unavailable and Retry-After. Requests
+   that are already running (or waiting in the admission queue) go
+   on.
+
+2. httpkom waits until those requests are done, for at most
+   HTTPKOM_DRAIN_TIMEOUT seconds.
+
+3. All LysKOM sessions are logged out and disconnected,
+   HTTPKOM_DRAIN_BATCH_SIZE sessions at a time.
+
+4. The functions registered with on_drained() are called, for
+   example to send the stats to Graphite a last time.
+
+The admin endpoint is only enabled if HTTPKOM_ADMIN_TOKEN is set, and
+requests to it must have the header::
+
+  Authorization: Bearer <token>
+"""
+
+from __future__ import absolute_import
+import asyncio
+import hmac
+import logging
+import time
+
+from quart import current_app, jsonify, request
+
+from httpkom import app
+from .errors import error_response
+from .misc import empty_response
+from .stats import stats
+from . import admission, capture
+
+
+log = logging.getLogger("httpkom.drain")
+
+SERVING = 'serving'
+DRAINING = 'draining'
+DRAINED = 'drained'
+
+_state = SERVING
+_task = None # the drain, once it has been started
+_started_at = None
+_result = None # dict with what the drain did, when it is done
+_on_drained = [] # functions to call when drained
+
+
+def is_draining():
+    """True from the moment the drain has been started (also when it
+    is done).
+    """
+    return _state != SERVING
+
+
+def rejection():
+    """The response for requests that are rejected because httpkom is
+    being drained.
+    """
+    stats.set('drain.rejected.last', 1, agg='sum')
+    response = error_response(503, error_msg="Shutting down")
+    response.headers['Retry-After'] = str(current_app.config['HTTPKOM_ADMISSION_RETRY_AFTER'])
+    return response
+
+
+def on_drained(f):
+    """Register a function (without arguments) to call when httpkom
+    has been drained. It is run in a thread, so it may block.
+    """
+    _on_drained.append(f)
+
+
+def start():
+    """Start draining, unless it has already been started. Returns a
+    task that is done when httpkom has been drained.
+    """
+    global _state, _task, _started_at
+    if _task is None:
+        log.info("Draining")
+        _state = DRAINING
+        _started_at = time.monotonic()
+        _task = asyncio.ensure_future(_drain(app.config['HTTPKOM_DRAIN_TIMEOUT'],
+                                             app.config['HTTPKOM_DRAIN_BATCH_SIZE']))
+    return _task
+
+
+async def drain():
+    """Start draining (unless it has already been started), and wait
+    until httpkom has been drained.
+    """
+    # Don't let a cancelled caller (for example an HTTP client that
+    # disconnected) stop the drain.
+    await asyncio.shield(start())
+
+
+def _requests_left():
+    from .sessions import opening_komsessions
+    # Requests waiting in the admission queue were accepted before
+    # the drain, so they are let through and waited for too.
+    return admission.active() + admission.queued() + opening_komsessions()
+
+
+async def _wait_for_requests(timeout):
+    deadline = time.monotonic() + timeout
+    while _requests_left() > 0:
+        if time.monotonic() >= deadline:
+            return _requests_left()
+        await asyncio.sleep(0.05)
+    return 0
+
+
+async def _drain(timeout, batch_size):
+    global _state, _result
+    from .sessions import close_all_komsessions
+    capture.detach_from_request() # if started with POST /admin/drain
+
+    abandoned = await _wait_for_requests(timeout)
+    if abandoned > 0:
+        log.warning("%d requests still running after %s s, disconnecting anyway",
+                    abandoned, timeout)
+        stats.set('drain.requests.abandoned.last', abandoned, agg='sum')
+
+    closed, failed = await close_all_komsessions(batch_size)
+    stats.set('drain.komsessions.closed.last', closed, agg='sum')
+    stats.set('drain.komsessions.failed.last', failed, agg='sum')
+
+    loop = asyncio.get_running_loop()
+    for f in _on_drained:
+        try:
+            await loop.run_in_executor(None, f)
+        except Exception:
+            log.exception("Failed to run %r after drain", f)
+
+    _result = dict(requests_abandoned=abandoned, komsessions_closed=closed,
+                   komsessions_failed=failed,
+                   seconds=round(time.monotonic() - _started_at, 3))
+    _state = DRAINED
+    log.info("Drained: %s", _result)
+
+
+def _is_authorized():
+    token = current_app.config['HTTPKOM_ADMIN_TOKEN']
+    if not token:
+        return False
+    authorization = request.headers.get('Authorization', '')
+    return hmac.compare_digest(authorization.encode('utf-8'),
+                               ('Bearer ' + token).encode('utf-8'))
+
+
+def _status():
+    from .sessions import count_komsessions
+    return dict(state=_state, requests_running=admission.active(),
+                requests_queued=admission.queued(),
+                komsessions=count_komsessions(), result=_result)
+
+
+@app.route("/admin/drain", methods=['GET', 'POST'])
+async def admin_drain():
+    """Start draining httpkom (POST), or get how far it has come
+    (GET). With ?wait=1, a POST waits until httpkom has been drained.
+
+    .. rubric:: Request
+
+    ::
+
+      POST /admin/drain?wait=1 HTTP/1.1
+      Authorization: Bearer <token>
+
+    .. rubric:: Responses
+
+    Drained (or, without wait, draining)::
+
+      HTTP/1.0 200 OK
+
+      {
+        "state": "drained",
+        "requests_running": 0,
+        "requests_queued": 0,
+        "komsessions": 0,
+        "result": {
+          "requests_abandoned": 0,
+          "komsessions_closed": 120,
+          "komsessions_failed": 0,
+          "seconds": 0.532
+        }
+      }
+
+    If HTTPKOM_ADMIN_TOKEN is not set::
+
+      HTTP/1.0 404 Not Found
+
+    If the token is wrong or missing::
+
+      HTTP/1.0 403 Forbidden
+
+    .. rubric:: Example
+
+    ::
+
+      curl -v -X POST -H "Authorization: Bearer secret" \\
+           "http://localhost:5001/admin/drain?wait=1"
+
+    """
+    if not current_app.config['HTTPKOM_ADMIN_TOKEN']:
+        return empty_response(404)
+    if not _is_authorized():
+        return empty_response(403)
+    if request.method == 'POST':
+        if request.args.get('wait') in ('1', 'true'):
+            await drain()
+        else:
+            start()
+    return jsonify(_status())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Cached serialized sub-objects ("fragments").
+
+The same sub-objects (person names, conference names, conference
+types, ...) are serialized over and over again. Their dicts are made
+once, kept here, and the same dict is put in the results of to_dict()
+every time. Since they are shared, they are made read-only: dicts are
+stored as MappingProxyType and lists as tuples (the JSON backend
+serializes them as objects and arrays).
+
+Fragments for immutable values are content-addressed: the key is the
+values that the dict is made from, so they never need to be
+invalidated.
+"""
+
+from __future__ import absolute_import
+import weakref
+from collections import OrderedDict
+from types import MappingProxyType
+
+from pylyskom.asyncmsg import AsyncMessages
+
+from .stats import stats
+
+
+# Max number of content-addressed fragments to keep.
+MAX_FRAGMENTS = 20000
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType(dict((k, _freeze(v)) for k, v in value.items()))
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+_fragments = OrderedDict() # key -> serialized object
+
+def get_fragment(key, build):
+    """Return the content-addressed fragment for key, or build it
+    with build().
+    """
+    fragment = _fragments.get(key)
+    if fragment is None:
+        stats.set('fragments.misses.last', 1, agg='sum')
+        fragment = _freeze(build())
+        _fragments[key] = fragment
+        if len(_fragments) > MAX_FRAGMENTS:
+            _fragments.popitem(last=False)
+    else:
+        _fragments.move_to_end(key)
+    return fragment
+
+
+_session_fragments = weakref.WeakKeyDictionary() # session -> OrderedDict
+
+# Max number of fragments to keep per session.
+MAX_SESSION_FRAGMENTS = 1000
+
+async def get_session_fragment(session, key, source, build):
+    """Return the fragment for key in session, if it was made from the
+    same source object, or build it by awaiting build().
+
+    This is for values that depend on what the session is allowed to
+    see (for example conference names), and that are made from
+    objects in pylyskom's caches: they are replaced, not changed, when
+    they get invalid, so the same source object means the same
+    fragment.
+    """
+    fragments = _session_fragments.get(session)
+    if fragments is None:
+        fragments = OrderedDict()
+        _session_fragments[session] = fragments
+    entry = fragments.get(key)
+    if entry is not None and entry[0] is source:
+        fragments.move_to_end(key)
+        return entry[1]
+    stats.set('fragments.session.misses.last', 1, agg='sum')
+    fragment = _freeze(await build())
+    fragments[key] = (source, fragment)
+    fragments.move_to_end(key)
+    if len(fragments) > MAX_SESSION_FRAGMENTS:
+        fragments.popitem(last=False)
+    return fragment
+
+def clear_session_fragments(session):
+    _session_fragments.pop(session, None)
+
+
+async def register_async_handlers(ksession):
+    """Clear the fragments for ksession when names are changed."""
+    ksession_ref = weakref.ref(ksession)
+
+    async def new_name(msg):
+        ks = ksession_ref()
+        if ks is not None:
+            clear_session_fragments(ks)
+
+    # The caching client in pylyskom already accepts this async
+    # message.
+    await ksession._client.register_async_handler(
+        AsyncMessages.NEW_NAME, new_name, skip_accept_async=True)
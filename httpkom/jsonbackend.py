@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+JSON encoding and decoding for responses and WebSocket messages.
+
+orjson is used if it is installed (it is an optional dependency),
+otherwise the json module in the standard library. orjson encodes
+directly to UTF-8 bytes, which is what we send, so the responses are
+made from bytes without going through str.
+
+Both backends sort the keys in objects, so the output is the same
+except for whitespace and the escaping of non-ASCII characters.
+"""
+
+from __future__ import absolute_import
+import json
+import logging
+from types import MappingProxyType
+
+from quart import current_app
+from quart.json.provider import DefaultJSONProvider
+
+from . import admission
+from .stats import stats
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Values that JSON has no type for (dates, Decimal, UUID, ...) are
+# serialized the same way as by Quart, with both backends. The
+# read-only dicts from fragments.py are objects.
+def _default(obj):
+    if isinstance(obj, MappingProxyType):
+        return dict(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+def _json_dumps(obj, indent=False):
+    if indent:
+        return json.dumps(obj, sort_keys=True, indent=2, default=_default)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=_default)
+
+def _json_dumps_bytes(obj, indent=False):
+    return _json_dumps(obj, indent).encode('utf-8')
+
+
+if orjson is not None:
+    # orjson serializes dates and dataclasses itself, in other ways
+    # than Quart, unless they are passed through to the default
+    # function.
+    _ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | \
+        orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_PASSTHROUGH_DATETIME | \
+        orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def _orjson_default(obj):
+        # With OPT_PASSTHROUGH_SUBCLASS we get all subclasses of the
+        # built-in types (pylyskom's bitstrings are lists, for example).
+        for base in (str, int, float, list, tuple, dict):
+            if isinstance(obj, base):
+                return base(obj)
+        return _default(obj)
+
+    def _orjson_dumps_bytes(obj, indent=False):
+        option = _ORJSON_OPTIONS | orjson.OPT_INDENT_2 if indent else _ORJSON_OPTIONS
+        return orjson.dumps(obj, default=_orjson_default, option=option)
+
+    def _orjson_dumps(obj, indent=False):
+        return _orjson_dumps_bytes(obj, indent).decode('utf-8')
+
+    dumps = _orjson_dumps
+    dumps_bytes = _orjson_dumps_bytes
+    loads = orjson.loads
+
+    backend = 'orjson'
+
+else:
+    dumps = _json_dumps
+    dumps_bytes = _json_dumps_bytes
+    loads = json.loads
+
+    backend = 'json'
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Quart JSON provider (used by jsonify) that uses the JSON backend."""
+
+    def dumps(self, object_, **kwargs):
+        if kwargs:
+            # Someone wants something special, so let the standard
+            # library do it.
+            return super().dumps(object_, **kwargs)
+        return dumps(object_)
+
+    def loads(self, object_, **kwargs):
+        if kwargs:
+            return super().loads(object_, **kwargs)
+        return loads(object_)
+
+    def response(self, *args, **kwargs):
+        object_ = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(dumps_bytes(object_, indent), mimetype=self.mimetype)
+
+
+log = logging.getLogger("httpkom.jsonbackend")
+
+# Streamed responses are sent in chunks of at least this many bytes
+# (except the first and the last chunk).
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+async def _iter_json_object(fields, list_key, first_item, items):
+    # The list is put last in the object, so that the other fields can
+    # be sent before the elements are known.
+    head = dumps_bytes(fields)[:-1] # without the closing brace
+    if len(fields) > 0:
+        head += b','
+    yield head + dumps_bytes(list_key) + b':['
+
+    buf = bytearray()
+    if first_item is not None:
+        buf += dumps_bytes(first_item[0])
+    try:
+        async for item in items:
+            buf += b','
+            buf += dumps_bytes(item)
+            if len(buf) >= STREAM_CHUNK_SIZE:
+                yield bytes(buf)
+                buf.clear()
+    except Exception:
+        # Too late for an error response, the status has been sent.
+        # The client will get truncated (invalid) JSON.
+        log.exception("Failed to stream %r", list_key)
+        stats.set('http.errors.streaming.last', 1, agg='sum')
+        raise
+    buf += b']}'
+    yield bytes(buf)
+
+
+async def stream_response(fields, list_key, items):
+    """Make a JSON response with the object fields, plus the key
+    list_key with a list of the elements from the async iterator
+    items. The elements are serialized and sent as they are produced,
+    so the whole list never has to be in memory.
+
+    The first element is produced before the response is made, so
+    errors that happen right away (which is the common case) still
+    give an error response.
+    """
+    stats.set('http.responses.streamed.last', 1, agg='sum')
+    try:
+        first_item = (await items.__anext__(),)
+    except StopAsyncIteration:
+        first_item = None
+    return current_app.response_class(
+        admission.release_after(_iter_json_object(fields, list_key, first_item, items)),
+        mimetype=current_app.json.mimetype)
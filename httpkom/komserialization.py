@@ -17,6 +17,8 @@ from pylyskom.komsession import (
     KomServerInfo,
 )
 
+from .fragments import get_fragment, get_session_fragment
+
 
 _ALLOWED_KOMTEXT_AUXITEMS = [
     komauxitems.AI_FAST_REPLY,
@@ -54,67 +56,101 @@ MICommentIn_str_to_type = { 'comment': datatypes.MIC_COMMENT,
 
 
 
-async def to_dict(obj, session=None):
+def _wants_field(fields, name):
+    return fields is None or name in fields
+
+def _select_fields(d, fields):
+    if fields is None:
+        return d
+    return dict((k, v) for k, v in d.items() if k in fields)
+
+
+# Kinds of serializers, see _serializers at the end of the module.
+_IDENTITY = 0
+_SYNC = 1
+_SYNC_FIELDS = 2
+_ASYNC = 3
+_ASYNC_FIELDS = 4
+_LIST = 5
+
+def _get_serializer(cls):
+    """Return the (kind, function) serializer for objects of type
+    cls. Subclasses of registered types use the serializer of the
+    first registered type in their MRO.
+    """
+    serializer = _serializers.get(cls)
+    if serializer is None:
+        serializer = (_IDENTITY, None)
+        for base in cls.__mro__[1:]:
+            if base in _serializers:
+                serializer = _serializers[base]
+                break
+        _serializers[cls] = serializer
+    return serializer
+
+async def to_dict(obj, session=None, fields=None):
+    """Serialize obj to something that can be JSON encoded.
+
+    If fields is not None, it should be a set of top-level field
+    names. Only those fields will be included for objects that
+    support sparse fieldsets (texts and conferences), and the
+    sub-objects for fields that are not included will not be looked
+    up at all.
+    """
     if obj is None:
         return None
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        return [ await to_dict(el, session) for el in obj ]
-    elif isinstance(obj, KomPerson):
-        return KomPerson_to_dict(obj)
-    elif isinstance(obj, KomPersonName):
-        return KomPersonName_to_dict(obj)
-    elif isinstance(obj, KomText):
-        return await KomText_to_dict(obj, session)
-    elif isinstance(obj, datatypes.MIRecipient):
-        return await MIRecipient_to_dict(obj, session)
-    elif isinstance(obj, datatypes.MICommentTo):
-        return await MICommentTo_to_dict(obj, session)
-    elif isinstance(obj, datatypes.MICommentIn):
-        return await MICommentIn_to_dict(obj, session)
-    elif isinstance(obj, KomConferenceName):
-        return KomConferenceName_to_dict(obj)
-    elif isinstance(obj, KomConference):
-        return KomConference_to_dict(obj)
-    elif isinstance(obj, KomUConference):
-        return KomUConference_to_dict(obj)
-    elif isinstance(obj, datatypes.ConfType):
-        return ConfType_to_dict(obj)
-    elif isinstance(obj, KomMembership):
-        return KomMembership_to_dict(obj)
-    elif isinstance(obj, KomMembershipUnread):
-        return KomMembershipUnread_to_dict(obj)
-    elif isinstance(obj, datatypes.MembershipType):
-        return MembershipType_to_dict(obj)
-    elif isinstance(obj, datatypes.AuxItem):
-        raise RuntimeError("Should use KomAuxItem")
-    elif isinstance(obj, KomAuxItem):
-        return KomAuxItem_to_dict(obj)
-    elif isinstance(obj, datatypes.Mark):
-        return Mark_to_dict(obj)
-    elif isinstance(obj, datatypes.Time):
-        return Time_to_dict(obj)
-    elif isinstance(obj, KomServerInfo):
-        return KomServerInfo_to_dict(obj)
+    kind, serializer = _get_serializer(type(obj))
+    if kind == _SYNC:
+        return serializer(obj)
+    elif kind == _SYNC_FIELDS:
+        return serializer(obj, fields)
+    elif kind == _ASYNC:
+        return await serializer(obj, session)
+    elif kind == _ASYNC_FIELDS:
+        return await serializer(obj, session, fields)
+    elif kind == _LIST:
+        # Elements with synchronous serializers (the common case, for
+        # example memberships) are serialized without creating a
+        # coroutine for each of them.
+        result = []
+        for el in obj:
+            if el is None:
+                result.append(None)
+                continue
+            kind, serializer = _get_serializer(type(el))
+            if kind == _SYNC:
+                result.append(serializer(el))
+            elif kind == _SYNC_FIELDS:
+                result.append(serializer(el, fields))
+            elif kind == _IDENTITY:
+                result.append(el)
+            else:
+                result.append(await to_dict(el, session, fields))
+        return result
     else:
         #raise NotImplementedError("to_dict is not implemented for: %s" % type(obj))
         return obj
 
+def _person_name_fragment(pers_no, username):
+    return get_fragment(('person-name', pers_no, username),
+                        lambda: dict(pers_no=pers_no, pers_name=username))
+
 def KomPerson_to_dict(kom_person):
     if kom_person is None:
         return None
-    return dict(pers_no=kom_person.pers_no, pers_name=kom_person.username)
+    return _person_name_fragment(kom_person.pers_no, kom_person.username)
 
 def KomPersonName_to_dict(kom_person_name):
     if kom_person_name is None:
         return None
-    return dict(pers_no=kom_person_name.pers_no, pers_name=kom_person_name.username)
+    return _person_name_fragment(kom_person_name.pers_no, kom_person_name.username)
 
 # TODO: Replace usage of pers_to_dict with KomPersonName_to_dict
 async def pers_to_dict(pers_no, session):
     if pers_no is None:
         return None
     person = await session.get_person_name(pers_no)
-    return dict(pers_no=person.pers_no, pers_name=person.username)
+    return _person_name_fragment(person.pers_no, person.username)
 
 def KomMembership_to_dict(membership):
     return dict(
@@ -135,14 +171,19 @@ def KomMembershipUnread_to_dict(membership_unread):
         unread_texts=membership_unread.unread_texts)
 
 def MembershipType_to_dict(m_type):
-    return dict(
+    key = ('membership-type', m_type.invitation, m_type.passive, m_type.secret,
+           m_type.passive_message_invert)
+    return get_fragment(key, lambda: dict(
         invitation=m_type.invitation,
         passive=m_type.passive,
         secret=m_type.secret,
-        passive_message_invert=m_type.passive_message_invert)
+        passive_message_invert=m_type.passive_message_invert))
 
 def ConfType_to_dict(conf_type):
-    return dict(
+    key = ('conf-type', conf_type.rd_prot, conf_type.original, conf_type.secret,
+           conf_type.letterbox, conf_type.allow_anonymous, conf_type.forbid_secret,
+           conf_type.reserved2, conf_type.reserved3)
+    return get_fragment(key, lambda: dict(
         rd_prot=conf_type.rd_prot,
         original=conf_type.original,
         secret=conf_type.secret,
@@ -150,18 +191,18 @@ def ConfType_to_dict(conf_type):
         allow_anonymous=conf_type.allow_anonymous,
         forbid_secret=conf_type.forbid_secret,
         reserved2=conf_type.reserved2,
-        reserved3=conf_type.reserved3)
+        reserved3=conf_type.reserved3))
 
 def KomConferenceName_to_dict(conf):
     if conf is None:
         return None
-    return dict(
+    return get_fragment(('conference-name', conf.conf_no, conf.name), lambda: dict(
         conf_no=conf.conf_no,
         name=conf.name,
-    )
+    ))
 
-def KomConference_to_dict(conf):
-    d = dict(
+def KomConference_to_dict(conf, fields=None):
+    d = _select_fields(dict(
         conf_no=conf.conf_no,
         name=conf.name,
         type=ConfType_to_dict(conf.type),
@@ -179,77 +220,95 @@ def KomConference_to_dict(conf):
         first_local_no=conf.first_local_no,
         no_of_texts=conf.no_of_texts,
         expire=conf.expire
-        )
+        ), fields)
 
-    if conf.aux_items is None:
-        d['aux_items'] = None
-    else:
-        aux_items = []
-        for ai in [ai for ai in conf.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
-            aux_items.append(KomAuxItem_to_dict(ai))
-        d['aux_items'] = aux_items
+    if _wants_field(fields, 'aux_items'):
+        if conf.aux_items is None:
+            d['aux_items'] = None
+        else:
+            aux_items = []
+            for ai in [ai for ai in conf.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
+                aux_items.append(KomAuxItem_to_dict(ai))
+            d['aux_items'] = aux_items
 
     return d
 
-def KomUConference_to_dict(conf):
+def KomUConference_to_dict(conf, fields=None):
     if conf is None:
         return None
-    return dict(
+    return _select_fields(dict(
         conf_no=conf.conf_no,
         name=conf.name,
         type=ConfType_to_dict(conf.type),
         highest_local_no=conf.highest_local_no,
         nice=conf.nice
-    )
+    ), fields)
 
-async def KomText_to_dict(komtext, session):
-    d = dict(
+async def KomText_to_dict(komtext, session, fields=None):
+    # Recipients and comments are the expensive parts (each of them
+    # can cause lookups in the LysKOM server), so they are only
+    # serialized if they are wanted.
+    d = _select_fields(dict(
         text_no=komtext.text_no,
         author=KomPerson_to_dict(komtext.author),
         no_of_marks=komtext.no_of_marks,
         content_type=komtext.content_type,
-        subject=komtext.subject)
-
-    mime_type, encoding = parse_content_type(komtext.content_type)
-    # Only add body if text
-    if mime_type[0] == 'text':
-        d['body'] = komtext.body
-    elif mime_type[0] == 'x-kom' and mime_type[1] == 'user-area':
-        d['body'] = komtext.body
+        subject=komtext.subject), fields)
+
+    if _wants_field(fields, 'body'):
+        mime_type, encoding = parse_content_type(komtext.content_type)
+        # Only add body if text
+        if mime_type[0] == 'text':
+            d['body'] = komtext.body
+        elif mime_type[0] == 'x-kom' and mime_type[1] == 'user-area':
+            d['body'] = komtext.body
     
-    if komtext.recipient_list is None:
-        d['recipient_list'] = None
-    else:
-        d['recipient_list'] = [ await MIRecipient_to_dict(r, session)
-                                for r in komtext.recipient_list ]
+    # The serialized lists are kept for the session as long as the
+    # text stat in pylyskom's cache is the same.
+    if _wants_field(fields, 'recipient_list'):
+        if komtext.recipient_list is None:
+            d['recipient_list'] = None
+        else:
+            d['recipient_list'] = await get_session_fragment(
+                session, ('recipient_list', komtext.text_no), komtext.recipient_list,
+                lambda: _list_to_dict(MIRecipient_to_dict, komtext.recipient_list, session))
     
-    if komtext.comment_to_list is None:
-        d['comment_to_list'] = None
-    else:
-        d['comment_to_list'] = [ await MICommentTo_to_dict(ct, session)
-                                 for ct in komtext.comment_to_list ]
+    if _wants_field(fields, 'comment_to_list'):
+        if komtext.comment_to_list is None:
+            d['comment_to_list'] = None
+        else:
+            d['comment_to_list'] = await get_session_fragment(
+                session, ('comment_to_list', komtext.text_no), komtext.comment_to_list,
+                lambda: _list_to_dict(MICommentTo_to_dict, komtext.comment_to_list, session))
     
-    if komtext.comment_in_list is None:
-        d['comment_in_list'] = None
-    else:
-        d['comment_in_list'] = [ await MICommentIn_to_dict(ci, session)
-                                 for ci in komtext.comment_in_list ]
+    if _wants_field(fields, 'comment_in_list'):
+        if komtext.comment_in_list is None:
+            d['comment_in_list'] = None
+        else:
+            d['comment_in_list'] = await get_session_fragment(
+                session, ('comment_in_list', komtext.text_no), komtext.comment_in_list,
+                lambda: _list_to_dict(MICommentIn_to_dict, komtext.comment_in_list, session))
     
-    if komtext.aux_items is None:
-        d['aux_items'] = None
-    else:
-        aux_items = []
-        for ai in [ai for ai in komtext.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
-            aux_items.append(KomAuxItem_to_dict(ai))
-        d['aux_items'] = aux_items
+    if _wants_field(fields, 'aux_items'):
+        if komtext.aux_items is None:
+            d['aux_items'] = None
+        else:
+            aux_items = []
+            for ai in [ai for ai in komtext.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
+                aux_items.append(KomAuxItem_to_dict(ai))
+            d['aux_items'] = aux_items
     
-    if komtext.creation_time is None:
-        d['creation_time'] = None
-    else:
-        d['creation_time'] = Time_to_dict(komtext.creation_time)
+    if _wants_field(fields, 'creation_time'):
+        if komtext.creation_time is None:
+            d['creation_time'] = None
+        else:
+            d['creation_time'] = Time_to_dict(komtext.creation_time)
     
     return d
 
+async def _list_to_dict(el_to_dict, l, session):
+    return [ await el_to_dict(el, session) for el in l ]
+
 async def MIRecipient_to_dict(mir, session):
     if not mir.type in MIRecipient_type_to_str:
         raise KeyError("Unknown MIRecipient type: %s" % mir.type)
@@ -336,3 +395,35 @@ def KomServerInfo_to_dict(info):
         motd_of_lyskom=info.motd_of_lyskom,
         #aux_item_list=info.aux_item_list #(ArrayAuxItem)
     )
+
+
+def _AuxItem_to_dict(aux_item):
+    raise RuntimeError("Should use KomAuxItem")
+
+# Serializers by exact type, filled in with subclasses as they are
+# looked up by _get_serializer().
+#
+# ConfType and MembershipType are not here: they are lists (bitstrings)
+# and to_dict() has always serialized them as lists of bits. As parts
+# of conferences and memberships they are serialized with
+# ConfType_to_dict() and MembershipType_to_dict().
+_serializers = {
+    list: (_LIST, None),
+    tuple: (_LIST, None),
+    KomPerson: (_SYNC, KomPerson_to_dict),
+    KomPersonName: (_SYNC, KomPersonName_to_dict),
+    KomText: (_ASYNC_FIELDS, KomText_to_dict),
+    datatypes.MIRecipient: (_ASYNC, MIRecipient_to_dict),
+    datatypes.MICommentTo: (_ASYNC, MICommentTo_to_dict),
+    datatypes.MICommentIn: (_ASYNC, MICommentIn_to_dict),
+    KomConferenceName: (_SYNC, KomConferenceName_to_dict),
+    KomConference: (_SYNC_FIELDS, KomConference_to_dict),
+    KomUConference: (_SYNC_FIELDS, KomUConference_to_dict),
+    KomMembership: (_SYNC, KomMembership_to_dict),
+    KomMembershipUnread: (_SYNC, KomMembershipUnread_to_dict),
+    datatypes.AuxItem: (_SYNC, _AuxItem_to_dict),
+    KomAuxItem: (_SYNC, KomAuxItem_to_dict),
+    datatypes.Mark: (_SYNC, Mark_to_dict),
+    datatypes.Time: (_SYNC, Time_to_dict),
+    KomServerInfo: (_SYNC, KomServerInfo_to_dict),
+}
@@ -5,13 +5,20 @@ from __future__ import absolute_import
 from quart import g, request, jsonify
 
 import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.komsession import KomMembership
 
 from .komserialization import to_dict
 
 from httpkom import bp
 from .errors import error_response
+from .jsonbackend import stream_response
 from .misc import empty_response, get_bool_arg_with_default
-from .sessions import requires_login
+from .sessions import check_connected, requires_login
+from . import confcache
+from . import names
+from . import unreads
+from .stats import stats
 
 
 @bp.route('/persons/<int:pers_no>/memberships/<int:conf_no>', methods=['PUT'])
@@ -69,6 +76,9 @@ async def persons_put_membership(pers_no, conf_no):
     where = int(request_json.get('where', 0))
     try:
         await g.ksession.add_membership(pers_no, conf_no, priority, where)
+        unreads.membership_changed(g.ksession, pers_no, conf_no)
+        names.membership_changed(g.ksession)
+        confcache.invalidate(g.server.id, conf_no)
         return empty_response(201)
     except (komerror.UndefinedPerson, komerror.UndefinedConference) as ex:
         return error_response(404, kom_error=ex)
@@ -110,6 +120,9 @@ async def persons_delete_membership(pers_no, conf_no):
     """
     try:
         await g.ksession.delete_membership(pers_no, conf_no)
+        unreads.membership_changed(g.ksession, pers_no, conf_no)
+        names.membership_changed(g.ksession)
+        confcache.invalidate(g.server.id, conf_no)
         return empty_response(204)
     except (komerror.UndefinedPerson, komerror.UndefinedConference, komerror.NotMember) as ex:
         return error_response(404, kom_error=ex)
@@ -159,6 +172,7 @@ async def persons_set_unread(conf_no):
         return error_response(400, error_msg='Missing "no_of_unread".')
     
     await g.ksession.set_unread(conf_no, no_of_unread)
+    unreads.conference_changed(g.ksession, conf_no)
     return empty_response(204)
 
 
@@ -267,7 +281,12 @@ async def persons_get_membership_unread(pers_no, conf_no):
     
     """
     try:
-        return jsonify(await to_dict(await g.ksession.get_membership_unread(pers_no, conf_no),
+        tracker = unreads.get_tracker(g.ksession, pers_no)
+        if tracker is None:
+            membership_unread = await g.ksession.get_membership_unread(pers_no, conf_no)
+        else:
+            membership_unread = await tracker.get_membership_unread(g.ksession, conf_no)
+        return jsonify(await to_dict(membership_unread,
                                      g.ksession))
     except komerror.NotMember as ex:
         return error_response(404, kom_error=ex)
@@ -356,9 +375,49 @@ async def persons_list_memberships(pers_no):
     passive = get_bool_arg_with_default(request.args, 'passive', False)
     first = int(request.args.get('first', 0))
     no_of_memberships = int(request.args.get('no-of-memberships', 100))
-    memberships, has_more = await g.ksession.get_memberships(
-        pers_no, first, no_of_memberships, unread, passive)
-    return jsonify(has_more=has_more, memberships=await to_dict(memberships, g.ksession))
+    if unread and passive:
+        # ReqGetUnreadConfs never returns passive memberships.
+        return error_response(400, error_msg='"unread" and "passive" can not be combined.')
+    ksession = g.ksession
+    check_connected(ksession)
+    if unread:
+        conf_nos = await ksession._client.request(requests.ReqGetUnreadConfs(pers_no))
+        has_more = False
+    else:
+        ms_list = await ksession._client.get_memberships(
+            pers_no, first, no_of_memberships, want_read_ranges=False)
+        # Whether there are more memberships must be decided before
+        # the passive memberships are filtered out.
+        has_more = len(ms_list) >= no_of_memberships
+
+    async def memberships():
+        # Same as AioKomSession.get_memberships(), but each membership
+        # is made and serialized when it is sent. The methods of the
+        # session check that it is still connected.
+        if unread:
+            for conf_no in conf_nos:
+                yield await to_dict(await ksession.get_membership(pers_no, conf_no), ksession)
+        else:
+            for membership in ms_list:
+                if passive or not membership.type.passive:
+                    yield await to_dict(
+                        await _get_kom_membership(ksession, pers_no, membership), ksession)
+
+    return await stream_response(dict(has_more=has_more), 'memberships', memberships())
+
+
+async def _get_kom_membership(ksession, pers_no, membership):
+    """Make a KomMembership from a membership from the membership
+    list, like AioKomSession does.
+    """
+    if membership.added_by == 0:
+        # The membership was created before protocol 10.
+        added_by = None
+    else:
+        added_by = await ksession.get_person_name(membership.added_by)
+    conference = await ksession.get_conference(membership.conference, micro=True)
+    return KomMembership(pers_no, added_by=added_by, conference=conference,
+                         membership=membership)
 
 
 @bp.route('/persons/<int:pers_no>/memberships/unread/')
@@ -403,5 +462,128 @@ async def persons_list_membership_unreads(pers_no):
       curl -v -X GET "http://localhost:5001/lyskom/persons/14506/memberships/unread/"
     
     """
-    membership_unreads = await g.ksession.get_membership_unreads(pers_no)
-    return jsonify(list=await to_dict(membership_unreads, g.ksession))
+    tracker = unreads.get_tracker(g.ksession, pers_no)
+    ksession = g.ksession
+    if tracker is None:
+        check_connected(ksession)
+        conf_nos = await ksession._client.request(requests.ReqGetUnreadConfs(pers_no))
+    else:
+        tracked_unreads = await tracker.get_membership_unreads(ksession)
+
+    async def membership_unreads():
+        if tracker is None:
+            # Same as AioKomSession.get_membership_unreads(), one
+            # conference at a time.
+            for conf_no in conf_nos:
+                membership_unread = await ksession.get_membership_unread(pers_no, conf_no)
+                if membership_unread.no_of_unread > 0:
+                    yield await to_dict(membership_unread, ksession)
+        else:
+            for membership_unread in tracked_unreads:
+                yield await to_dict(membership_unread, ksession)
+
+    return await stream_response({}, 'list', membership_unreads())
+
+
+@bp.route('/persons/current/memberships/changes/')
+@requires_login
+async def persons_list_membership_changes():
+    """Get the memberships and membership unreads of the current
+    person that have changed since a version. This makes it possible
+    for a client to poll for changes without fetching all memberships
+    and unread texts every time.
+
+    Start without a version, which returns all membership unreads
+    with unread texts in them, and then pass the returned version to
+    the next request. If "full" is true in the response, the version
+    was not valid any more (for example if the person has logged in
+    again) and the client must fetch the full lists again. Removed
+    memberships are listed in "removed_memberships". A membership
+    unread with no_of_unread 0 means that there are no unread texts
+    left in that conference.
+
+    Query parameters:
+    
+    =======  =======  =================================================================
+    Key      Type     Values
+    =======  =======  =================================================================
+    since    string   The version returned by the previous request.
+    =======  =======  =================================================================
+
+    .. rubric:: Request
+    
+    ::
+    
+      GET /<server_id>/persons/current/memberships/changes/?since=<version> HTTP/1.1
+    
+    .. rubric:: Response
+    
+    ::
+    
+      HTTP/1.1 200 OK
+      
+      {
+        "version": "<version>",
+        "full": false,
+        "memberships": [
+          {
+            "pers_no": <pers_no>,
+            "conference": { ... },
+            ...
+          },
+          ...
+        ],
+        "removed_memberships": [ 6 ],
+        "membership_unreads": [
+          {
+            "pers_no": <pers_no>,
+            "conf_no": <conf_no>,
+            "no_of_unread": 2,
+            "unread_texts": [
+              19831603,
+              19831620
+            ]
+          },
+          ...
+        ]
+      }
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X GET "http://localhost:5001/lyskom/persons/current/memberships/changes/?since=<version>"
+    
+    """
+    tracker = unreads.get_tracker(g.ksession)
+    if tracker is None:
+        return error_response(400, error_msg='Not logged in through httpkom.')
+
+    membership_changes = None
+    since = request.args.get('since', None)
+    if since is not None:
+        try:
+            version, membership_changes, unread_changes = await tracker.get_changes(
+                g.ksession, since)
+        except unreads.InvalidVersion:
+            return error_response(400, error_msg='Invalid "since".')
+
+    if membership_changes is None:
+        stats.set('unreads.changes.full.last', 1, agg='sum')
+        membership_unreads = await tracker.get_membership_unreads(g.ksession)
+        return jsonify(version=tracker.get_version_token(), full=True,
+                       memberships=[], removed_memberships=[],
+                       membership_unreads=await to_dict(membership_unreads, g.ksession))
+
+    stats.set('unreads.changes.delta.last', 1, agg='sum')
+    memberships = []
+    removed_memberships = []
+    for conf_no in membership_changes:
+        try:
+            memberships.append(await g.ksession.get_membership(tracker.pers_no, conf_no))
+        except komerror.NotMember:
+            removed_memberships.append(conf_no)
+    return jsonify(version=version, full=False,
+                   memberships=await to_dict(memberships, g.ksession),
+                   removed_memberships=removed_memberships,
+                   membership_unreads=await to_dict(unread_changes, g.ksession))
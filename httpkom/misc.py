@@ -17,6 +17,20 @@ def get_bool_arg_with_default(args, arg, default):
         val = default
     return val
 
+def get_fields_arg(args):
+    """Get the sparse fieldset from the "fields" query parameter, as
+    a set of field names. Returns None if the parameter is not
+    specified (i.e. all fields are wanted).
+    """
+    if 'fields' not in args:
+        return None
+    return frozenset(f.strip() for f in args['fields'].split(',') if f.strip())
+
+def is_list_of_ints(value):
+    """True if value (from a JSON body) is a list of integers."""
+    return isinstance(value, list) and \
+        all(isinstance(v, int) and not isinstance(v, bool) for v in value)
+
 def empty_response(status, headers=None):
     response = Response("", status=status, headers=headers)
     del response.headers['Content-Type'] # text/html by default in Flask
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+In-memory index of conference and person names, used to answer name
+lookups (for example recipient autocompletion) without asking the
+LysKOM server.
+
+The index for a server is built from a dump of all names
+(lookup-z-name with an empty name) made with a separate connection
+that is not logged in, so secret conferences are never included. It
+is kept up to date with the new-name async messages that our sessions
+receive, and built again when it is older than
+HTTPKOM_NAME_INDEX_MAX_AGE seconds (there are no async messages for
+new or deleted conferences). Matches are returned in the order of the
+dump, which is the order the LysKOM server returns them in.
+
+A logged in person may also see the secret conferences that the
+person is a member of, which are not in the index. For logged in
+sessions, the memberships that are not public in the index are kept
+in a small index per session, which is searched together with the
+index for the server. It is made again when the memberships change.
+
+Names of read protected conferences are only answered from the index
+for their members. If a lookup matches any other read protected
+conference, the lookup is made by the session, so the LysKOM server
+decides what the session may see.
+"""
+
+from __future__ import absolute_import
+import asyncio
+import bisect
+import logging
+import re
+import time
+import weakref
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.aio import AioCachingPersonClient, AioKomSession
+from pylyskom.asyncmsg import AsyncMessages
+
+from .stats import stats
+from .version import __version__
+from . import backends, capture
+
+
+log = logging.getLogger("httpkom.names")
+
+_PARENTHESES_RE = re.compile(br'\([^)]*\)?')
+
+# Max number of memberships of a logged in person to look up names
+# in.
+_MAX_MEMBERSHIPS = 10000
+
+
+class NameIndex(object):
+    """Names of the conferences and persons on one LysKOM server.
+
+    Matching follows the KOM name expansion rules: parenthesized parts
+    are ignored, and each word in the pattern must be a prefix of the
+    corresponding word in the name. Case is folded with the server's
+    collate table. The names are kept in sorted lists of (words,
+    conf_no), so the candidates for a pattern can be found with bisect
+    on the first word. The order of the names from the server is kept
+    too, for the results.
+    """
+
+    def __init__(self, collate_table):
+        if len(collate_table) == 256:
+            self._collate_table = collate_table
+        else:
+            self._collate_table = None
+        self.built_at = time.time()
+        self._entries = {} # conf_no -> (name, words, letterbox, hidden)
+        self._order = {} # conf_no -> position in the server's order
+        self._public = [] # sorted list of (words, conf_no)
+        self._hidden = [] # sorted list of (words, conf_no), read protected
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, conf_no):
+        return conf_no in self._entries
+
+    def is_public(self, conf_no):
+        entry = self._entries.get(conf_no)
+        return entry is not None and not entry[3]
+
+    def new_index(self):
+        """Return a new, empty, index with the same collate table."""
+        return NameIndex(self._collate_table or b'')
+
+    def _words(self, name):
+        """Split a name (bytes, in latin1) into folded words."""
+        if self._collate_table is None:
+            name = name.lower()
+        else:
+            name = name.translate(self._collate_table)
+        return tuple(_PARENTHESES_RE.sub(b' ', name).split())
+
+    def add(self, conf_no, name, letterbox, hidden):
+        self.remove(conf_no)
+        self._order.setdefault(conf_no, len(self._order))
+        words = self._words(name)
+        self._entries[conf_no] = (name.decode('latin1'), words, letterbox, hidden)
+        bisect.insort(self._hidden if hidden else self._public, (words, conf_no))
+
+    def remove(self, conf_no):
+        entry = self._entries.pop(conf_no, None)
+        if entry is None:
+            return
+        keys = self._hidden if entry[3] else self._public
+        i = bisect.bisect_left(keys, (entry[1], conf_no))
+        if i < len(keys) and keys[i] == (entry[1], conf_no):
+            del keys[i]
+
+    def rename(self, conf_no, new_name):
+        """Rename a conference. Returns False if the conference is not in
+        the index.
+        """
+        entry = self._entries.get(conf_no)
+        if entry is None:
+            return False
+        self.add(conf_no, new_name, entry[2], entry[3])
+        return True
+
+    def _matches(self, keys, pattern):
+        if len(pattern) == 0:
+            candidates = keys
+        else:
+            first = pattern[0]
+            lo = bisect.bisect_left(keys, ((first,),))
+            hi = lo
+            while hi < len(keys) and len(keys[hi][0]) > 0 and keys[hi][0][0].startswith(first):
+                hi += 1
+            candidates = keys[lo:hi]
+        for words, conf_no in candidates:
+            if len(words) >= len(pattern) and \
+               all(w.startswith(p) for w, p in zip(words[1:], pattern[1:])):
+                yield conf_no
+
+    def _wanted(self, conf_no, want_pers, want_confs):
+        letterbox = self._entries[conf_no][2]
+        return (want_pers and letterbox) or (want_confs and not letterbox)
+
+    def lookup(self, name, want_pers, want_confs, members=None):
+        """Same as AioKomSession.lookup_name(), but returns None if the
+        lookup must be made by the LysKOM server.
+
+        members is an index of the memberships of the logged in person
+        that are not public in this index, or None if the session is
+        not logged in. They are matched too. Memberships that are not
+        in this index come after the other matches.
+        """
+        pattern = self._words(name.encode('latin1', 'replace'))
+        for conf_no in self._matches(self._hidden, pattern):
+            if self._wanted(conf_no, want_pers, want_confs) and \
+               (members is None or conf_no not in members):
+                return None
+        matches = dict((conf_no, self._entries[conf_no][0])
+                       for conf_no in self._matches(self._public, pattern)
+                       if self._wanted(conf_no, want_pers, want_confs))
+        if members is not None:
+            for conf_no in members._matches(members._public, pattern):
+                if members._wanted(conf_no, want_pers, want_confs):
+                    matches[conf_no] = members._entries[conf_no][0]
+
+        def server_order(conf_no):
+            if conf_no in self._order:
+                return (0, self._order[conf_no])
+            return (1, conf_no)
+
+        return [ (conf_no, matches[conf_no]) for conf_no in sorted(matches, key=server_order) ]
+
+
+async def _build_index(server):
+    ksession = AioKomSession(
+        client_factory=lambda: AioCachingPersonClient(backends.create_client(server.id)))
+    await backends.connect(ksession, server, "httpkom", __version__)
+    try:
+        collate_table = await ksession._client.request(requests.ReqGetCollateTable())
+        conf_z_infos = await ksession._client.request(
+            requests.ReqLookupZName("", want_pers=1, want_confs=1))
+    finally:
+        await ksession.disconnect()
+
+    index = NameIndex(collate_table)
+    for czi in conf_z_infos:
+        if czi.type.secret:
+            continue
+        index.add(czi.conf_no, czi.name, bool(czi.type.letterbox), bool(czi.type.rd_prot))
+    return index
+
+
+_indexes = {} # server id -> NameIndex
+_building = {} # server id -> asyncio.Task
+
+
+def _start_build(server):
+    if server.id in _building:
+        return
+
+    async def build():
+        capture.detach_from_request()
+        try:
+            t0 = time.time()
+            index = await _build_index(server)
+            _indexes[server.id] = index
+            stats.set('names.builds.last', 1, agg='sum')
+            stats.set('names.size.last', len(index), agg='last')
+            log.info("Built name index for %s with %d names in %.2f s",
+                     server.id, len(index), time.time() - t0)
+        except Exception:
+            log.exception("Failed to build name index for %s", server.id)
+            stats.set('names.builds.failed.last', 1, agg='sum')
+        finally:
+            del _building[server.id]
+
+    _building[server.id] = asyncio.create_task(build())
+
+
+_member_indexes = weakref.WeakKeyDictionary() # ksession -> (pers_no, NameIndex, NameIndex)
+
+
+async def _get_member_index(ksession, index):
+    """Return an index of the memberships of the person logged in on
+    ksession that are not public in index.
+    """
+    pers_no = await ksession.get_current_person_no()
+    cached = _member_indexes.get(ksession)
+    if cached is not None and cached[0] == pers_no and cached[1] is index:
+        return cached[2]
+
+    members = index.new_index()
+    ms_list = await ksession._client.get_memberships(
+        pers_no, 0, _MAX_MEMBERSHIPS, want_read_ranges=False)
+    for membership in ms_list:
+        conf_no = membership.conference
+        if index.is_public(conf_no):
+            continue
+        try:
+            uconf = await ksession.get_conference(conf_no, micro=True)
+        except komerror.UndefinedConference:
+            continue
+        members.add(conf_no, uconf.name.encode('latin1', 'replace'),
+                    bool(uconf.type.letterbox), False)
+    _member_indexes[ksession] = (pers_no, index, members)
+    stats.set('names.member-indexes.builds.last', 1, agg='sum')
+    return members
+
+
+def membership_changed(ksession):
+    """The memberships of the person logged in on ksession have
+    changed.
+    """
+    _member_indexes.pop(ksession, None)
+
+
+async def lookup_name(ksession, server, name, want_pers, want_confs, max_age, logged_in):
+    """Look up a name with the index for server, if there is one, or
+    with ksession. If ksession is logged in (logged_in is True), the
+    memberships of the person are looked up too. An index older than
+    max_age seconds is used, but is also built again in the
+    background.
+    """
+    index = _indexes.get(server.id)
+    if index is None or time.time() - index.built_at > max_age:
+        _start_build(server)
+
+    matches = None
+    if index is not None and not name.startswith("#"):
+        members = await _get_member_index(ksession, index) if logged_in else None
+        matches = index.lookup(name, want_pers, want_confs, members)
+    if matches is None:
+        stats.set('names.lookups.server.last', 1, agg='sum')
+        matches = await ksession.lookup_name(name, want_pers, want_confs)
+    else:
+        stats.set('names.lookups.index.last', 1, agg='sum')
+    return matches
+
+
+async def register_async_handlers(ksession, server_id):
+    """Keep the index for server_id up to date with the new-name async
+    messages received by ksession, and the index of the memberships of
+    ksession with its membership async messages.
+    """
+    # The handlers only keep a weak reference to the session, so they
+    # don't keep it alive.
+    ksession_ref = weakref.ref(ksession)
+
+    async def new_name(msg):
+        index = _indexes.get(server_id)
+        if index is not None:
+            index.rename(msg.conf_no, msg.new_name)
+        ks = ksession_ref()
+        cached = _member_indexes.get(ks) if ks is not None else None
+        if cached is not None:
+            cached[2].rename(msg.conf_no, msg.new_name)
+
+    async def membership(msg):
+        ks = ksession_ref()
+        if ks is not None:
+            membership_changed(ks)
+
+    # The caching client in pylyskom already accepts these async
+    # messages.
+    client = ksession._client
+    await client.register_async_handler(AsyncMessages.NEW_NAME, new_name, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.NEW_MEMBERSHIP, membership, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.LEAVE_CONF, membership, skip_accept_async=True)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Marking many texts as read at once.
+
+Marking texts as read one at a time means one HTTP request and at
+least one protocol A request per text and recipient. Here we group
+the texts by recipient conference, so that each conference gets as
+few mark-as-read requests as possible, and send all of them without
+waiting for the replies in between (they are pipelined on the
+session's connection).
+"""
+
+from __future__ import absolute_import
+import asyncio
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+
+from .stats import stats
+from . import unreads
+
+
+# Max number of local text numbers in one mark-as-read request.
+_MAX_TEXTS_PER_REQUEST = 255
+
+# Max number of texts that can be marked as read in one HTTP request.
+MAX_TEXTS = 10000
+
+# Max number of protocol A requests that one HTTP request has in
+# flight at the same time, so that it doesn't use up the requests
+# budget for the LysKOM server (HTTPKOM_MAX_LYSKOM_REQUESTS_PER_SERVER).
+_MAX_PIPELINED_REQUESTS = 20
+
+
+async def _gather(coros):
+    """Like asyncio.gather(), but with at most
+    _MAX_PIPELINED_REQUESTS of the coroutines running at a time.
+    """
+    semaphore = asyncio.Semaphore(_MAX_PIPELINED_REQUESTS)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[ run(coro) for coro in coros ])
+
+
+async def _mark_as_read(ksession, conf_no, local_nos):
+    try:
+        await ksession._client.request(requests.ReqMarkAsRead(conf_no, local_nos))
+    except komerror.NotMember:
+        # Same as AioKomSession.mark_as_read(): it's not an error to
+        # read a text in a conference you are not a member of.
+        pass
+
+async def mark_as_read_locals(ksession, local_nos_by_conf):
+    """Mark local text numbers as read. local_nos_by_conf is a dict
+    from conf_no to an iterable of local text numbers.
+    """
+    calls = []
+    for conf_no, local_nos in local_nos_by_conf.items():
+        local_nos = sorted(set(local_nos))
+        for i in range(0, len(local_nos), _MAX_TEXTS_PER_REQUEST):
+            calls.append(_mark_as_read(ksession, conf_no,
+                                       local_nos[i:i + _MAX_TEXTS_PER_REQUEST]))
+    await _gather(calls)
+    stats.set('readmarkings.batches.last', 1, agg='sum')
+    stats.set('readmarkings.requests.last', len(calls), agg='sum')
+
+async def mark_as_read(ksession, text_nos):
+    """Mark texts as read in all their recipient conferences. Texts
+    that do not exist are ignored. Returns the list of text numbers
+    that did not exist.
+    """
+    text_nos = sorted(set(text_nos))
+
+    async def get_text_stat(text_no):
+        try:
+            return await ksession.get_text_stat(text_no)
+        except (komerror.NoSuchText, komerror.TextZero):
+            return None
+
+    text_stats = await _gather([ get_text_stat(text_no) for text_no in text_nos ])
+
+    local_nos_by_conf = {}
+    no_such_texts = []
+    for text_no, text_stat in zip(text_nos, text_stats):
+        if text_stat is None:
+            no_such_texts.append(text_no)
+            continue
+        for mi in text_stat.misc_info.recipient_list:
+            local_nos_by_conf.setdefault(mi.recpt, []).append(mi.loc_no)
+
+    await mark_as_read_locals(ksession, local_nos_by_conf)
+    for text_no, text_stat in zip(text_nos, text_stats):
+        if text_stat is not None:
+            unreads.text_read(ksession, text_no)
+    return no_such_texts
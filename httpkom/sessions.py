@@ -80,6 +80,22 @@ Httpkom-Connection specifies a working connection, but to another
 server than <server_id>, httpkom might close the connection before
 returning 403.
 
+If there are too many concurrent requests for the same
+Httpkom-Connection, the request may be rejected without being run,
+and the response will be::
+
+  HTTP/1.0 429 Too Many Requests
+  Retry-After: 1
+
+If httpkom as a whole has too many concurrent requests, the response
+will be 503 Service Unavailable instead. The response is also 503 if
+the LysKOM server is unavailable (if httpkom can't connect to it, if
+it has failed too many times in a row, or if httpkom has too many
+connections to it). In all these cases, the request can be made again
+after the number of seconds in Retry-After. When httpkom is shutting
+down (see drain.py), new sessions and new requests are also rejected
+with 503 and Retry-After, and the sessions are closed shortly after.
+
 It is up to the client to keep track of opened connection and to use
 them with the correct <server_id>. The /<server_id> prefix to all
 resources could be seen as redundant, since the Httpkom-Connection
@@ -92,16 +108,19 @@ perspective to have them different resources (i.e. different
 """
 
 from __future__ import absolute_import
+import asyncio
 import errno
 import functools
+import logging
 import socket
 import uuid
+import weakref
 
-from quart import g, request, jsonify, websocket, has_request_context, has_websocket_context
+from quart import current_app, g, request, jsonify, websocket, has_request_context, has_websocket_context
 
 import pylyskom.errors as komerror
-from pylyskom.komsession import KomPerson, KomSessionNotConnected
-from pylyskom.aio import AioKomSession
+from pylyskom.komsession import KomSessionNotConnected
+from pylyskom.aio import AioCachingPersonClient, AioKomSession
 
 from .komserialization import to_dict
 
@@ -109,19 +128,50 @@ from httpkom import HTTPKOM_CONNECTION_HEADER, bp
 from .errors import error_response
 from .misc import empty_response
 from .stats import stats
+from . import admission
+from . import backends
+from . import confcache
+from . import drain
+from . import fragments
+from . import names
+from . import singleflight
+from . import textmaps
+from . import unreads
+
+
+log = logging.getLogger("httpkom.sessions")
 
 
 # These komsessions methods are the only ones that should access the
 # _komsessions object
 
 _komsessions = {}
+_opening = 0 # number of sessions being opened, not saved yet
 
-async def _open_komsession(host, port, client_name, client_version):
-    komsession = AioKomSession()
-    await komsession.connect(
-        host, port,
-        "httpkom", socket.getfqdn(),
-        client_name, client_version)
+def _create_client(server_id):
+    client = backends.create_client(server_id)
+    if current_app.config['HTTPKOM_SINGLE_FLIGHT']:
+        return singleflight.SingleFlightClient(server_id, client)
+    return AioCachingPersonClient(client)
+
+async def _open_komsession(server, client_name, client_version):
+    komsession = AioKomSession(client_factory=functools.partial(_create_client, server.id))
+    await backends.connect(komsession, server, client_name, client_version)
+    try:
+        await textmaps.register_async_handlers(komsession, server.id)
+        await unreads.register_async_handlers(komsession)
+        await names.register_async_handlers(komsession, server.id)
+        await confcache.register_async_handlers(komsession, server.id)
+        await singleflight.register_async_handlers(komsession, server.id)
+        await fragments.register_async_handlers(komsession)
+        # The session number never changes, so this is the only time
+        # we need to ask for it.
+        _session_nos[komsession] = await komsession.who_am_i()
+    except BaseException:
+        # Don't leave the connection open if we fail (or the HTTP
+        # client disconnects) before the session has been saved.
+        await komsession.close()
+        raise
     stats.set('sessions.komsessions.connected.last', 1, agg='sum')
     return komsession
 
@@ -146,6 +196,57 @@ def _get_komsession(connection_id):
 def _new_connection_id():
     return str(uuid.uuid4())
 
+def count_komsessions():
+    return len(_komsessions)
+
+def opening_komsessions():
+    return _opening
+
+async def _close_komsession(ksession):
+    try:
+        if ksession.is_connected():
+            if await ksession.is_logged_in():
+                unreads.stop_tracking(ksession)
+                await ksession.logout()
+            await ksession.disconnect(0)
+        return True
+    except Exception:
+        log.warning("Failed to log out and disconnect session", exc_info=True)
+        return False
+    finally:
+        await ksession.close()
+
+async def close_all_komsessions(batch_size):
+    """Log out and disconnect all sessions, batch_size sessions at a
+    time. Returns the number of sessions that were closed cleanly and
+    the number that failed (they are closed anyway).
+    """
+    closed = failed = 0
+    while len(_komsessions) > 0:
+        batch = list(_komsessions.items())[:batch_size]
+        for connection_id, _ in batch:
+            _delete_komsession(connection_id)
+        results = await asyncio.gather(*[ _close_komsession(ksession)
+                                          for _, ksession in batch ])
+        closed += results.count(True)
+        failed += results.count(False)
+    return closed, failed
+
+
+# The session number of our sessions, so that who-am-i doesn't have
+# to ask the LysKOM server for it.
+_session_nos = weakref.WeakKeyDictionary() # ksession -> session number
+
+def check_connected(ksession):
+    """Raise KomSessionNotConnected (403) if ksession is no longer
+    connected.
+
+    For code that uses the client of the session directly. That skips
+    the check that the methods of AioKomSession make, so a session
+    that has been closed would fail with AttributeError (500) instead.
+    """
+    if not ksession.is_connected():
+        raise KomSessionNotConnected()
 
 def _get_connection_id_from_request():
     if HTTPKOM_CONNECTION_HEADER in request.headers:
@@ -193,6 +294,11 @@ def requires_session(f):
         g.ksession = _get_komsession(g.connection_id)
         if g.ksession is None:
             return empty_response(403)
+        if drain.is_draining():
+            return drain.rejection()
+        rejection = await admission.admit(g.connection_id)
+        if rejection is not None:
+            return rejection
         try:
             return await f(*args, **kwargs)
         except KomSessionNotConnected:
@@ -205,6 +311,8 @@ def requires_session(f):
                 return empty_response(403)
             else:
                 raise
+        finally:
+            admission.release()
     return decorated
 
 
@@ -230,15 +338,16 @@ def requires_login(f):
 async def sessions_who_am_i():
     """TODO
     """
+    # Neither the session number nor the logged in person needs a
+    # request to the LysKOM server. The person may be fetched though.
     try:
-        session_no = await g.ksession.who_am_i()
         if await g.ksession.is_logged_in():
             pers_no = await g.ksession.get_current_person_no()
-            person = await to_dict(KomPerson(pers_no), g.ksession)
+            person = await to_dict(await g.ksession.get_person(pers_no), g.ksession)
         else:
             person = None
 
-        return jsonify(dict(person=person, session_no=session_no))
+        return jsonify(dict(person=person, session_no=_session_nos[g.ksession]))
     except komerror.Error as ex:
         return error_response(400, kom_error=ex)
 
@@ -296,9 +405,17 @@ async def sessions_create():
 
       HTTP/1.0 409 CONFLICT
     
+    If httpkom is shutting down::
+
+      HTTP/1.0 503 SERVICE UNAVAILABLE
+      Retry-After: 1
+    
     """
+    global _opening
     if HTTPKOM_CONNECTION_HEADER in request.headers:
         return empty_response(409)
+    if drain.is_draining():
+        return drain.rejection()
     
     try:
         request_json = await request.json
@@ -319,10 +436,14 @@ async def sessions_create():
         # todo: perhaps we should also check if the session is connected?
 
         if not has_existing_ksession:
-            ksession = await _open_komsession(
-                g.server.host, g.server.port, client_name, client_version)
-            connection_id = _save_komsession(ksession)
-            response = jsonify(session_no=await ksession.who_am_i(), connection_id=connection_id)
+            _opening += 1
+            try:
+                ksession = await _open_komsession(g.server, client_name, client_version)
+                connection_id = _save_komsession(ksession)
+            finally:
+                _opening -= 1
+            response = jsonify(session_no=_session_nos[ksession],
+                               connection_id=connection_id)
             response.headers[HTTPKOM_CONNECTION_HEADER] = connection_id
             return response, 201
         else:
@@ -405,7 +526,10 @@ async def sessions_login():
         return error_response(400, error_msg='Missing "passwd".')
 
     try:
-        kom_person = await g.ksession.login(pers_no=pers_no, pers_name=pers_name, passwd=passwd)
+        kom_person = await g.ksession.login(pers_no=pers_no, pers_name=pers_name,
+                                            passwd=passwd)
+        unreads.start_tracking(g.ksession, kom_person.pers_no)
+        names.membership_changed(g.ksession)
         return jsonify(await to_dict(kom_person, g.ksession)), 201
     except (komerror.InvalidPassword, komerror.UndefinedPerson, komerror.LoginDisallowed,
             komerror.ConferenceZero) as ex:
@@ -439,6 +563,7 @@ async def sessions_logout():
     
     """
 
+    unreads.stop_tracking(g.ksession)
     await g.ksession.logout()
     return empty_response(204)
 
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Coalescing of identical concurrent LysKOM lookups (single-flight).
+
+When a new text is created in a big conference, many sessions ask for
+the same text, and for the names of the same author and recipients,
+at the same time. Instead of each of them sending its own request to
+the LysKOM server, the first one sends it and the others wait for its
+reply. Nothing is kept after the reply has been received, the caches
+in each session work as before.
+
+Only replies that are the same for every session that is allowed to
+get them are shared between sessions:
+
+* Conference status (micro), which is what the names come from, for
+  conferences that are not secret. If the status that was fetched is
+  for a secret conference, or the lookup failed (the conference may
+  only be invisible to the session that fetched it), the waiting
+  sessions make their own lookups.
+
+* Text bodies, but only with sessions that have already got the text
+  status themselves, which the LysKOM server only gives to sessions
+  that may read the text. (AioKomSession.get_text() gets the text
+  status first.)
+
+Text status lookups are only coalesced within a session, since what a
+session gets depends on what it may read.
+
+A lookup that was started before an async message that changes its
+reply (for example a new text, which changes the highest local text
+number of the recipients) is not waited for by lookups started after
+the message.
+"""
+
+from __future__ import absolute_import
+import asyncio
+
+from pylyskom import requests
+from pylyskom.aio import AioCachingPersonClient
+from pylyskom.asyncmsg import AsyncMessages
+
+from .stats import stats
+
+
+_inflight = {} # (server_id or session, kind, args) -> asyncio.Future
+
+
+async def _fetch_once(key, kind, fetch, shareable):
+    future = _inflight.get(key)
+    if future is not None:
+        # Don't let a cancelled waiter cancel the fetch for the
+        # others.
+        await asyncio.wait([ future ])
+        ok, result = future.result()
+        if ok and shareable(result):
+            stats.set('singleflight.{}.coalesced.last'.format(kind), 1, agg='sum')
+            return result
+        stats.set('singleflight.{}.unshared.last'.format(kind), 1, agg='sum')
+        return await fetch()
+
+    stats.set('singleflight.{}.fetches.last'.format(kind), 1, agg='sum')
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    ok, result = False, None
+    try:
+        result = await fetch()
+        ok = True
+        return result
+    finally:
+        future.set_result((ok, result))
+        # The entry may have been forgotten, and replaced by a newer
+        # fetch, while we waited.
+        if _inflight.get(key) is future:
+            del _inflight[key]
+        stats.set('singleflight.inflight.last', len(_inflight), agg='last')
+
+
+def forget(owner, kind, *args):
+    """Make lookups started from now on not wait for a lookup that is
+    in flight, because its reply may be out of date. owner is the
+    server id, or the client for lookups that are only coalesced
+    within a session.
+    """
+    _inflight.pop((owner, kind, args), None)
+
+
+class SingleFlightClient(AioCachingPersonClient):
+    """AioCachingPersonClient that coalesces identical concurrent
+    lookups with the other sessions for server_id.
+    """
+
+    def __init__(self, server_id, client):
+        AioCachingPersonClient.__init__(self, client)
+        self._server_id = server_id
+
+    async def _fetch_uconference(self, no):
+        return await _fetch_once(
+            (self._server_id, 'uconference', (no,)), 'uconference',
+            lambda: AioCachingPersonClient._fetch_uconference(self, no),
+            lambda uconf: not uconf.type.secret)
+
+    async def _fetch_textstat(self, no):
+        return await _fetch_once(
+            (self, 'textstat', (no,)), 'textstat',
+            lambda: AioCachingPersonClient._fetch_textstat(self, no),
+            lambda text_stat: True)
+
+    async def request(self, request):
+        if isinstance(request, requests.ReqGetText) and request.args[0] in self.textstats.dict:
+            return await _fetch_once(
+                (self._server_id, 'text', tuple(request.args)), 'text',
+                lambda: AioCachingPersonClient.request(self, request),
+                lambda text: True)
+        return await AioCachingPersonClient.request(self, request)
+
+
+async def register_async_handlers(ksession, server_id):
+    """Don't let lookups started after an async message has made the
+    caches of ksession out of date wait for a lookup that was started
+    before it. Otherwise the old reply would be cached again, for
+    example a conference status with an old highest local text number.
+    """
+    client = ksession._client
+
+    async def new_name(msg):
+        forget(server_id, 'uconference', msg.conf_no)
+
+    async def new_text(msg):
+        misc_info = msg.text_stat.misc_info
+        for rcpt in misc_info.recipient_list:
+            forget(server_id, 'uconference', rcpt.recpt)
+        for ct in misc_info.comment_to_list:
+            forget(client, 'textstat', ct.text_no)
+
+    async def deleted_text(msg):
+        misc_info = msg.text_stat.misc_info
+        forget(client, 'textstat', msg.text_no)
+        for ct in misc_info.comment_to_list:
+            forget(client, 'textstat', ct.text_no)
+        for ci in misc_info.comment_in_list:
+            forget(client, 'textstat', ci.text_no)
+
+    async def new_recipient(msg):
+        forget(server_id, 'uconference', msg.conf_no)
+        forget(client, 'textstat', msg.text_no)
+
+    async def sub_recipient(msg):
+        forget(client, 'textstat', msg.text_no)
+
+    # The caching client in pylyskom already accepts these async
+    # messages.
+    await client.register_async_handler(AsyncMessages.NEW_NAME, new_name, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.NEW_TEXT, new_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.DELETED_TEXT, deleted_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.NEW_RECIPIENT, new_recipient, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.SUB_RECIPIENT, sub_recipient, skip_accept_async=True)
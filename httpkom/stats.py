@@ -1,6 +1,9 @@
+import threading
+import time
+
 from quart import jsonify
 
-from pylyskom.stats import Stats
+from pylyskom.stats import Stats, merge_dicts
 from pylyskom.stats import stats as pylyskom_stats
 
 from httpkom import app
@@ -11,7 +14,9 @@ stats = Stats(prefix='httpkom.')
 
 @app.route("/stats")
 async def get_stats():
+    from .backends import health
     s = _merge_two_dicts(stats.dump(), pylyskom_stats.dump())
+    s.update(health())
     return jsonify(s)
 
 
@@ -32,6 +37,48 @@ def stats_response_status(response):
     return response
 
 
+class StatsSender(threading.Thread):
+    """Send the stats in statslist (Stats objects) with conn (for
+    example a pylyskom.stats.GraphiteTcpConnection) every interval
+    seconds, like pylyskom.stats.StatsSender, but it can also be
+    stopped and flushed, for example when httpkom is drained.
+    """
+
+    def __init__(self, statslist, conn, interval):
+        threading.Thread.__init__(self, name='StatsSender', daemon=True)
+        self._statslist = statslist
+        self._conn = conn
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock() # one send at a time
+
+    def run(self):
+        # At even multiples of the interval, like pylyskom.
+        while not self._stopped.wait(self._interval - time.time() % self._interval):
+            try:
+                self._send(unless_stopped=True)
+            except Exception:
+                app.logger.exception("Failed to send stats")
+
+    def _send(self, unless_stopped):
+        with self._lock:
+            if unless_stopped and self._stopped.is_set():
+                return
+            now = time.time()
+            dump = merge_dicts([ s.dump() for s in self._statslist ])
+            self._conn.send([ (m, value, now) for m, value in dump.items() ])
+
+    def flush(self):
+        """Send the stats now."""
+        self._send(unless_stopped=False)
+
+    def stop(self):
+        """Stop sending the stats every interval. Doesn't wait for the
+        thread, but no more sends are started by it.
+        """
+        self._stopped.set()
+
+
 # http://stackoverflow.com/questions/38987/how-can-i-merge-two-python-dictionaries-in-a-single-expression
 def _merge_two_dicts(x, y):
     '''Given two dicts, merge them into a new dict as a shallow copy.'''
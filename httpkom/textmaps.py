@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+Shared cache of the local to global text number mapping for
+conferences.
+
+The mapping for a conference is the same for every session that is
+allowed to read it, so we keep one map per (server id, conf_no) for
+all sessions instead of fetching the mapping over and over again. The
+map is filled in on demand with local-to-global requests, and is then
+kept up to date with the new-text and deleted-text async messages
+that any of our sessions receive.
+
+Only conferences that are not read protected (and not secret) are
+cached. For the other conferences the mapping depends on who is
+asking, so they are always fetched from the LysKOM server.
+"""
+
+from __future__ import absolute_import
+import asyncio
+from array import array
+from collections import OrderedDict
+
+from quart import current_app
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.asyncmsg import AsyncMessages
+
+from .stats import stats
+
+
+# Number of local text numbers per block in a map.
+BLOCK_SIZE = 1024
+
+# Max number of texts in one local-to-global request.
+_MAX_LOCAL_TO_GLOBAL_TEXTS = 255
+
+
+class LocalTextMap(object):
+    """Local to global text number map for one conference.
+
+    The map is stored in blocks of BLOCK_SIZE local text numbers. Each
+    block is an array('I') of global text numbers (0 for texts that
+    don't exist), together with the range of local text numbers in
+    the block that are known. Blocks without any texts are not
+    allocated.
+    """
+
+    def __init__(self, conf_no):
+        self.conf_no = conf_no
+        self.lock = asyncio.Lock()
+        self._blocks = {} # block index -> array('I') or None if only zeros
+        self._ranges = {} # block index -> (lo, hi) known local text numbers
+        self._first_local_no = None # No texts exist below this, if not None
+
+    def lookup(self, local_no):
+        """Return the global text number for local_no, 0 if there is no
+        such text, or None if the mapping is not known.
+        """
+        if self._first_local_no is not None and local_no < self._first_local_no:
+            return 0
+        idx = local_no // BLOCK_SIZE
+        r = self._ranges.get(idx)
+        if r is None or not (r[0] <= local_no < r[1]):
+            return None
+        block = self._blocks[idx]
+        if block is None:
+            return 0
+        return block[local_no - idx * BLOCK_SIZE]
+
+    def known_range(self, local_no):
+        """Return the (lo, hi) range of known local text numbers that
+        contains local_no, or None. The range never extends outside
+        the block of local_no.
+        """
+        r = self._ranges.get(local_no // BLOCK_SIZE)
+        if r is None or not (r[0] <= local_no < r[1]):
+            return None
+        return r
+
+    def texts_in_range(self, lo, hi):
+        """Return the (local_no, text_no) pairs for the existing texts
+        with local_no in [lo, hi). The range must be known and inside
+        one block.
+        """
+        idx = lo // BLOCK_SIZE
+        block = self._blocks[idx]
+        if block is None:
+            return []
+        start = idx * BLOCK_SIZE
+        return [ (start + i, text_no)
+                 for i, text_no in enumerate(block[lo - start:hi - start], lo - start)
+                 if text_no != 0 ]
+
+    def store(self, range_begin, range_end, pairs):
+        """Store a mapping for all local text numbers in [range_begin,
+        range_end). Local text numbers that are not in pairs do not
+        exist.
+        """
+        if range_end <= range_begin:
+            return
+        by_block = {}
+        for local_no, text_no in pairs:
+            if text_no != 0 and range_begin <= local_no < range_end:
+                by_block.setdefault(local_no // BLOCK_SIZE, []).append((local_no, text_no))
+
+        for idx in range(range_begin // BLOCK_SIZE, (range_end - 1) // BLOCK_SIZE + 1):
+            start = idx * BLOCK_SIZE
+            lo = max(range_begin, start)
+            hi = min(range_end, start + BLOCK_SIZE)
+            old = self._ranges.get(idx)
+            if old is None or hi < old[0] or lo > old[1]:
+                # Not overlapping or adjacent to what we know, so
+                # replace the block.
+                self._blocks[idx] = None
+                self._ranges[idx] = (lo, hi)
+            else:
+                self._ranges[idx] = (min(lo, old[0]), max(hi, old[1]))
+                block = self._blocks[idx]
+                if block is not None:
+                    block[lo - start:hi - start] = array('I', bytes(4 * (hi - lo)))
+
+            block_pairs = by_block.get(idx)
+            if block_pairs:
+                block = self._blocks[idx]
+                if block is None:
+                    block = array('I', bytes(4 * BLOCK_SIZE))
+                    self._blocks[idx] = block
+                for local_no, text_no in block_pairs:
+                    block[local_no - start] = text_no
+
+    def store_text_mapping(self, text_mapping, first_is_known=False, highest_local_no=None):
+        """Store a TextMapping from a local-to-global(-reverse)
+        request. If first_is_known is True, there are no texts before
+        the range in the mapping. If highest_local_no is not None,
+        nothing after it is stored: the range may end after the last
+        text, and texts created there later must not look deleted.
+        """
+        range_end = text_mapping.range_end
+        if highest_local_no is not None:
+            range_end = min(range_end, highest_local_no + 1)
+        self.store(text_mapping.range_begin, range_end, text_mapping.list)
+        if first_is_known:
+            self._first_local_no = text_mapping.range_begin
+
+    def add_text(self, local_no, text_no):
+        """Add a new text, if it directly follows the known texts at the
+        end. New texts after a gap are ignored, since we don't know
+        what is in the gap; they are fetched when needed instead.
+        """
+        idx = local_no // BLOCK_SIZE
+        start = idx * BLOCK_SIZE
+        r = self._ranges.get(idx)
+        if r is not None and r[1] == local_no:
+            self.store(local_no, local_no + 1, [(local_no, text_no)])
+        elif r is None and local_no == start:
+            prev = self._ranges.get(idx - 1)
+            if prev is not None and prev[1] == start:
+                self.store(local_no, local_no + 1, [(local_no, text_no)])
+
+    def remove_text(self, text_no, local_no=None):
+        """Remove a text (it has been deleted or removed from the
+        conference). If local_no is not known, all blocks are searched.
+        """
+        if local_no is not None:
+            if self.lookup(local_no) == text_no:
+                self._blocks[local_no // BLOCK_SIZE][local_no % BLOCK_SIZE] = 0
+            return
+        for block in self._blocks.values():
+            if block is not None and text_no in block:
+                block[block.index(text_no)] = 0
+
+
+_maps = OrderedDict() # (server_id, conf_no) -> LocalTextMap
+
+def _get_map(server_id, conf_no):
+    key = (server_id, conf_no)
+    textmap = _maps.get(key)
+    if textmap is None:
+        textmap = LocalTextMap(conf_no)
+        _maps[key] = textmap
+        while len(_maps) > current_app.config['HTTPKOM_TEXT_MAP_MAX_CONFERENCES']:
+            _maps.popitem(last=False)
+            stats.set('textmaps.evictions.last', 1, agg='sum')
+    else:
+        _maps.move_to_end(key)
+    stats.set('textmaps.conferences.last', len(_maps), agg='last')
+    return textmap
+
+
+def cached_local_to_global(server_id, conf_no, local_no):
+    """Return the global text number for local_no in conf_no if it is
+    in the cache, otherwise None. Never makes any requests.
+    """
+    textmap = _maps.get((server_id, conf_no))
+    if textmap is None:
+        return None
+    return textmap.lookup(local_no) or None
+
+
+async def _fetch_forwards(ksession, conf_no, local_no, n):
+    # pylyskom does not have an API for this, so we make the
+    # requests ourselves.
+    try:
+        return await ksession._client.request(
+            requests.ReqLocalToGlobal(conf_no, local_no, n))
+    except komerror.NoSuchLocalText:
+        return None
+
+async def _fetch_backwards(ksession, conf_no, ceiling, n):
+    return await ksession._client.request(
+        requests.ReqLocalToGlobalReverse(conf_no, ceiling, n))
+
+
+async def local_to_global(ksession, server_id, conf_no, local_no, no_of_texts, backwards):
+    """Map local text numbers in a conference to global text numbers,
+    starting at local_no (inclusive) and going backwards or forwards
+    until no_of_texts existing texts have been found. If local_no is
+    None, start at the end (backwards) or the beginning (forwards).
+
+    Returns a list of (local_no, text_no) tuples in ascending local
+    text number order, and whether there are more texts in the
+    requested direction.
+
+    Raises UndefinedConference if the conference does not exist (for
+    this session).
+    """
+    uconf = await ksession.get_conference(conf_no, micro=True)
+    if uconf.type.rd_prot or uconf.type.secret:
+        stats.set('textmaps.uncached.last', 1, agg='sum')
+        return await _local_to_global_uncached(
+            ksession, conf_no, local_no, no_of_texts, backwards)
+
+    textmap = _get_map(server_id, conf_no)
+    highest = uconf.highest_local_no
+    if local_no is None:
+        local_no = highest if backwards else 1
+
+    # We look for one text more than we want, to know if there are
+    # more texts in that direction.
+    wanted = no_of_texts + 1
+    mapping = []
+    fetches = 0
+    async with textmap.lock:
+        if backwards:
+            local_no = min(local_no, highest)
+            while local_no >= 1 and len(mapping) < wanted:
+                r = textmap.known_range(local_no)
+                if r is None:
+                    if textmap.lookup(local_no) == 0:
+                        # Before the first text.
+                        break
+                    tm = await _fetch_backwards(
+                        ksession, conf_no, local_no + 1, _MAX_LOCAL_TO_GLOBAL_TEXTS)
+                    textmap.store_text_mapping(tm, first_is_known=not tm.later_texts_exists,
+                                               highest_local_no=highest)
+                    fetches += 1
+                    if textmap.known_range(local_no) is None and textmap.lookup(local_no) != 0:
+                        # Should not happen, but make sure we don't loop forever.
+                        break
+                    continue
+                texts = textmap.texts_in_range(r[0], local_no + 1)
+                texts.reverse()
+                mapping.extend(texts[:wanted - len(mapping)])
+                local_no = r[0] - 1
+        else:
+            # There is no local text number 0.
+            local_no = max(local_no, 1)
+            while local_no <= highest and len(mapping) < wanted:
+                r = textmap.known_range(local_no)
+                if r is None:
+                    tm = await _fetch_forwards(
+                        ksession, conf_no, local_no, _MAX_LOCAL_TO_GLOBAL_TEXTS)
+                    fetches += 1
+                    if tm is None:
+                        break
+                    # There are no texts between local_no and the
+                    # start of the returned range.
+                    textmap.store(local_no, min(tm.range_begin, highest + 1), [])
+                    textmap.store_text_mapping(tm, highest_local_no=highest)
+                    if textmap.known_range(local_no) is None:
+                        # Should not happen, but make sure we don't loop forever.
+                        break
+                    continue
+                hi = min(r[1], highest + 1)
+                texts = textmap.texts_in_range(local_no, hi)
+                mapping.extend(texts[:wanted - len(mapping)])
+                local_no = hi
+
+    if fetches > 0:
+        stats.set('textmaps.misses.last', 1, agg='sum')
+        stats.set('textmaps.fetches.last', fetches, agg='sum')
+    else:
+        stats.set('textmaps.hits.last', 1, agg='sum')
+
+    has_more = len(mapping) > no_of_texts
+    mapping = mapping[:no_of_texts]
+    mapping.sort()
+    return mapping, has_more
+
+
+async def _local_to_global_uncached(ksession, conf_no, local_no, no_of_texts, backwards):
+    if backwards:
+        if local_no is None:
+            ceiling = 0 # 0 means after the last text
+        else:
+            ceiling = max(local_no + 1, 1)
+    else:
+        if local_no is None:
+            local_no = 1
+        else:
+            # There is no local text number 0.
+            local_no = max(local_no, 1)
+
+    mapping = []
+    has_more = True
+    while has_more and len(mapping) < no_of_texts:
+        n = min(no_of_texts - len(mapping), _MAX_LOCAL_TO_GLOBAL_TEXTS)
+        if backwards:
+            if ceiling == 1:
+                has_more = False
+                break
+            tm = await _fetch_backwards(ksession, conf_no, ceiling, n)
+            ceiling = tm.range_begin
+        else:
+            tm = await _fetch_forwards(ksession, conf_no, local_no, n)
+            if tm is None:
+                has_more = False
+                break
+            local_no = tm.range_end
+        has_more = bool(tm.later_texts_exists)
+        mapping.extend(m for m in tm.list if m[1] != 0)
+
+    mapping.sort()
+    return mapping, has_more
+
+
+async def register_async_handlers(ksession, server_id):
+    """Keep the maps for server_id up to date with the async messages
+    received by ksession.
+    """
+    async def new_text(msg):
+        for rcpt in msg.text_stat.misc_info.recipient_list:
+            textmap = _maps.get((server_id, rcpt.recpt))
+            if textmap is not None:
+                textmap.add_text(rcpt.loc_no, msg.text_no)
+
+    async def deleted_text(msg):
+        for rcpt in msg.text_stat.misc_info.recipient_list:
+            textmap = _maps.get((server_id, rcpt.recpt))
+            if textmap is not None:
+                textmap.remove_text(msg.text_no, rcpt.loc_no)
+
+    async def sub_recipient(msg):
+        textmap = _maps.get((server_id, msg.conf_no))
+        if textmap is not None:
+            textmap.remove_text(msg.text_no)
+
+    # The caching client in pylyskom already accepts these async
+    # messages.
+    client = ksession._client
+    await client.register_async_handler(AsyncMessages.NEW_TEXT, new_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.DELETED_TEXT, deleted_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.SUB_RECIPIENT, sub_recipient, skip_accept_async=True)
@@ -8,14 +8,18 @@ from io import BytesIO
 from quart import g, request, jsonify, send_file, url_for
 
 import pylyskom.errors as komerror
+from pylyskom.komsession import KomAuxItem, KomText
 from pylyskom.utils import parse_content_type
 
 from .komserialization import to_dict
 
 from httpkom import bp
 from .errors import error_response
-from .misc import empty_response
+from .misc import empty_response, get_fields_arg, is_list_of_ints
 from .sessions import requires_login
+from . import compression
+from . import readmarkings
+from . import unreads
 
 
 @bp.route('/texts/<int:text_no>')
@@ -25,6 +29,17 @@ async def texts_get(text_no):
     
     Note: The body will only be included in the response if the content type is text.
     
+    Query parameters:
+    
+    ======  ======  =================================================================
+    Key     Type    Values
+    ======  ======  =================================================================
+    fields  string  Comma separated list of the fields to include in the
+                    response, for example "text_no,subject,author". Fields that
+                    are not included are not looked up at all, which saves
+                    requests to the LysKOM server. Default: all fields.
+    ======  ======  =================================================================
+    
     .. rubric:: Request
     
     ::
@@ -75,12 +90,39 @@ async def texts_get(text_no):
            "http://localhost:5001/lyskom/texts/19680717"
     
     """
+    fields = get_fields_arg(request.args)
     try:
-        return jsonify(await to_dict(await g.ksession.get_text(text_no), g.ksession))
+        return jsonify(await to_dict(await get_text(g.ksession, text_no, fields), g.ksession, fields))
     except komerror.NoSuchText as ex:
         return error_response(404, kom_error=ex)
 
 
+async def get_text(ksession, text_no, fields):
+    """Get a text with the fields in fields (all if None). The text
+    itself (subject and body) is only fetched if it is wanted.
+    """
+    if fields is None or 'subject' in fields or 'body' in fields:
+        return await ksession.get_text(text_no)
+    return await get_text_without_body(ksession, text_no, fields)
+
+
+async def get_text_without_body(ksession, text_no, fields):
+    """Get a text from the text stat only, without fetching the text
+    itself (subject and body). The author and aux-items are only
+    looked up if they are wanted.
+    """
+    text_stat = await ksession.get_text_stat(text_no)
+    author = None
+    if fields is None or 'author' in fields:
+        author = await ksession.get_person_name(text_stat.author)
+    aux_items = None
+    if fields is None or 'aux_items' in fields:
+        aux_items = [ KomAuxItem(ai, await ksession.get_person_name(ai.creator))
+                      for ai in text_stat.aux_items ]
+    return KomText(text_no=text_no, text=None, text_stat=text_stat,
+                   aux_items=aux_items, author=author)
+
+
 @bp.route('/texts/<int:text_no>/body')
 @requires_login
 async def texts_get_body(text_no):
@@ -130,7 +172,9 @@ async def texts_get_body(text_no):
         response = await send_file(data,
                                    mimetype=text.content_type,
                                    as_attachment=False)
-            
+        # Texts can't be changed and text numbers are never reused,
+        # so the compressed body can be shared.
+        compression.set_cache_key(response, ('text-body', g.server.id, text_no))
         return response
     except komerror.NoSuchText as ex:
         return error_response(404, kom_error=ex)
@@ -341,9 +385,61 @@ async def texts_put_read_marking(text_no):
     
     """
     await g.ksession.mark_as_read(text_no)
+    unreads.text_read(g.ksession, text_no)
     return empty_response(201)
 
 
+@bp.route('/texts/read-marking', methods=['POST'])
+@requires_login
+async def texts_post_read_markings():
+    """Mark many texts as read in all recipient conferences. The
+    read-markings are grouped by conference and sent to the LysKOM
+    server in as few requests as possible. Texts that do not exist
+    are ignored, and returned in the response.
+    
+    .. rubric:: Request
+    
+    ::
+    
+      POST /<server_id>/texts/read-marking HTTP/1.0
+      
+      {
+        "text_nos": [ 19680717, 19680718, 19680720 ]
+      }
+    
+    .. rubric:: Responses
+    
+    Texts were marked as read::
+    
+      HTTP/1.0 201 Created
+      
+      {
+        "no_such_texts": [ 19680718 ]
+      }
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X POST -H "Content-Type: application/json" \\
+           -d '{ "text_nos": [ 19680717, 19680718 ] }' \\
+           "http://localhost:5001/lyskom/texts/read-marking"
+    
+    """
+    request_json = await request.json
+    try:
+        text_nos = request_json['text_nos']
+    except (TypeError, KeyError):
+        return error_response(400, error_msg='Missing or invalid "text_nos".')
+    if not is_list_of_ints(text_nos):
+        return error_response(400, error_msg='Missing or invalid "text_nos".')
+    if len(text_nos) > readmarkings.MAX_TEXTS:
+        return error_response(400, error_msg='Too many texts.')
+    
+    no_such_texts = await readmarkings.mark_as_read(g.ksession, text_nos)
+    return jsonify(no_such_texts=no_such_texts), 201
+
+
 @bp.route('/texts/<int:text_no>/read-marking', methods=['DELETE'])
 @requires_login
 async def texts_delete_read_marking(text_no):
@@ -369,4 +465,5 @@ async def texts_delete_read_marking(text_no):
     
     """
     await g.ksession.mark_as_unread(text_no)
+    await unreads.text_unread(g.ksession, text_no)
     return empty_response(204)
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""
+In-memory tracking of unread texts for the logged in person of a
+session.
+
+Calculating the unread texts for a person is expensive (one request
+for the conferences with unread texts, and then the read ranges and
+local-to-global mapping for each of them). Clients poll for unread
+texts all the time, so we calculate them once when the person logs in
+and then keep them up to date with the async messages we receive and
+the read-markings that are made through httpkom.
+
+Read-markings made by other clients for the same person are not
+visible to us, so the tracker is rebuilt when it is older than
+HTTPKOM_UNREAD_TRACKER_MAX_AGE seconds.
+
+Every change to the unread texts or memberships that the tracker sees
+gets a new version number, so clients can ask for only what has
+changed since the version they have.
+"""
+
+from __future__ import absolute_import
+import asyncio
+import bisect
+import logging
+import time
+import uuid
+import weakref
+from array import array
+
+from quart import current_app
+
+import pylyskom.errors as komerror
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komsession import KomMembershipUnread
+
+from .stats import stats
+from . import capture
+
+
+log = logging.getLogger("httpkom.unreads")
+
+_NO_TEXTS = array('I')
+
+
+class InvalidVersion(Exception):
+    pass
+
+
+class UnreadTracker(object):
+    """Unread texts for one person, as a sorted array('I') of text
+    numbers per conference. Conferences that we are uncertain about
+    are marked as stale and are fetched again before they are used.
+
+    Changes are recorded in a change log with the version of the last
+    change for each conference. Versions are only comparable within
+    one tracker, so the version tokens include a random epoch.
+    """
+
+    def __init__(self, pers_no, max_age):
+        self.pers_no = pers_no
+        self.max_age = max_age
+        self.built_at = None
+        self._lock = asyncio.Lock()
+        self._building = False
+        self._build_task = None # the background build from start_tracking()
+        self._unread = {} # conf_no -> array('I') of unread text numbers
+        self._stale = set() # conf_nos that must be fetched again
+        self._passive = set() # conf_nos of fetched passive memberships
+        self._not_member = set() # conf_nos that are known not to be memberships
+        self._fetching = set() # conf_nos being fetched right now
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self._unread_changes = {} # conf_no -> version of last unread change
+        self._membership_changes = {} # conf_no -> version of last membership change
+
+    def _is_outdated(self):
+        return self.built_at is None or time.time() - self.built_at > self.max_age
+
+    async def _ensure_built(self, ksession):
+        async with self._lock:
+            if self._is_outdated():
+                await self._build(ksession)
+            for conf_no in list(self._stale):
+                try:
+                    await self._fetch_conference(ksession, conf_no)
+                except komerror.NotMember:
+                    pass
+
+    async def _build(self, ksession):
+        self._building = True
+        self._stale = set()
+        self._passive = set()
+        self._not_member = set()
+        try:
+            membership_unreads = await ksession.get_membership_unreads(self.pers_no)
+        finally:
+            self._building = False
+        old_unread = self._unread
+        self._unread = dict((mu.conf_no, array('I', sorted(mu.unread_texts)))
+                            for mu in membership_unreads)
+        for conf_no in set(old_unread) | set(self._unread):
+            if old_unread.get(conf_no, _NO_TEXTS) != self._unread.get(conf_no, _NO_TEXTS):
+                self._unread_changed(conf_no)
+        self.built_at = time.time()
+        stats.set('unreads.trackers.builds.last', 1, agg='sum')
+
+    async def _fetch_conference(self, ksession, conf_no):
+        self._stale.discard(conf_no)
+        # Same as AioKomSession.get_membership_unread(), but we also
+        # need to know if the membership is passive.
+        client = ksession._client
+        self._fetching.add(conf_no)
+        try:
+            membership = await client.get_membership(self.pers_no, conf_no, want_read_ranges=True)
+            unread_texts = await client.get_unread_texts_from_membership(membership)
+        except komerror.NotMember:
+            self.forget_conference(conf_no)
+            self._not_member.add(conf_no)
+            raise
+        finally:
+            self._fetching.discard(conf_no)
+        unread = array('I', sorted(unread_texts))
+        if self._unread.get(conf_no, _NO_TEXTS) != unread:
+            self._unread_changed(conf_no)
+        self._unread[conf_no] = unread
+        if membership.type.passive:
+            self._passive.add(conf_no)
+        else:
+            self._passive.discard(conf_no)
+        stats.set('unreads.trackers.conference-fetches.last', 1, agg='sum')
+
+    def _to_membership_unread(self, conf_no):
+        unread_texts = list(self._unread.get(conf_no, _NO_TEXTS))
+        return KomMembershipUnread(self.pers_no, conf_no, len(unread_texts), unread_texts)
+
+    async def get_membership_unreads(self, ksession):
+        """Same as AioKomSession.get_membership_unreads(), for the
+        tracked person.
+        """
+        await self._ensure_built(ksession)
+        stats.set('unreads.trackers.hits.last', 1, agg='sum')
+        # Passive memberships are not included, just like
+        # ReqGetUnreadConfs does not return them.
+        return [ self._to_membership_unread(conf_no)
+                 for conf_no, unread in self._unread.items()
+                 if len(unread) > 0 and conf_no not in self._passive ]
+
+    async def get_membership_unread(self, ksession, conf_no):
+        """Same as AioKomSession.get_membership_unread(), for the
+        tracked person.
+        """
+        await self._ensure_built(ksession)
+        if conf_no not in self._unread:
+            # Either a membership without unread texts, or not a
+            # membership at all (then NotMember is raised).
+            async with self._lock:
+                await self._fetch_conference(ksession, conf_no)
+        else:
+            stats.set('unreads.trackers.hits.last', 1, agg='sum')
+        return self._to_membership_unread(conf_no)
+
+    def _unread_changed(self, conf_no):
+        self.version += 1
+        self._unread_changes[conf_no] = self.version
+
+    def get_version_token(self):
+        return "{}.{}".format(self.epoch, self.version)
+
+    def _parse_version_token(self, token):
+        """Return the version in token, or None if it is from another
+        tracker. Raises InvalidVersion if the token is malformed.
+        """
+        epoch, sep, version = token.partition('.')
+        if not sep or not version.isdigit():
+            raise InvalidVersion(token)
+        if epoch != self.epoch or int(version) > self.version:
+            return None
+        return int(version)
+
+    async def get_changes(self, ksession, since):
+        """Return the conferences whose memberships and unread texts
+        have changed since the version token since, as (version token,
+        membership changes, unread changes). Returns None for the
+        changes if since is not a version from this tracker; then the
+        client must start over without a version.
+        """
+        await self._ensure_built(ksession)
+        version = self._parse_version_token(since)
+        if version is None:
+            return self.get_version_token(), None, None
+        membership_changes = sorted(conf_no for conf_no, v in self._membership_changes.items()
+                                    if v > version)
+        unread_changes = [ self._to_membership_unread(conf_no)
+                           for conf_no, v in sorted(self._unread_changes.items()) if v > version ]
+        return self.get_version_token(), membership_changes, unread_changes
+
+    def mark_stale(self, conf_no):
+        self._stale.add(conf_no)
+
+    def membership_changed(self, conf_no):
+        self._not_member.discard(conf_no)
+        self.version += 1
+        self._membership_changes[conf_no] = self.version
+        self.mark_stale(conf_no)
+
+    def forget_conference(self, conf_no):
+        if len(self._unread.pop(conf_no, _NO_TEXTS)) > 0:
+            self._unread_changed(conf_no)
+        self._stale.discard(conf_no)
+        self._passive.discard(conf_no)
+
+    def add_text(self, conf_no, text_no):
+        if conf_no in self._not_member:
+            # Until the membership changes, there is nothing to fetch.
+            return
+        if self._building or conf_no in self._fetching or conf_no not in self._unread:
+            # We don't know if this is a membership, or the unread
+            # texts are being fetched right now.
+            self._stale.add(conf_no)
+            return
+        unread = self._unread[conf_no]
+        i = bisect.bisect_left(unread, text_no)
+        if i == len(unread) or unread[i] != text_no:
+            unread.insert(i, text_no)
+            self._unread_changed(conf_no)
+
+    def remove_text(self, text_no, conf_no=None):
+        """Remove text_no from the unread texts in conf_no, or in all
+        conferences if conf_no is None.
+        """
+        if self._building:
+            if conf_no is not None:
+                self._stale.add(conf_no)
+            else:
+                # We don't know where the text is, so build again.
+                self.built_at = None
+            return
+        if conf_no in self._fetching:
+            self._stale.add(conf_no)
+            return
+        if conf_no is None:
+            unreads = self._unread.items()
+        elif conf_no in self._unread:
+            unreads = [ (conf_no, self._unread[conf_no]) ]
+        else:
+            return
+        for unread_conf_no, unread in unreads:
+            i = bisect.bisect_left(unread, text_no)
+            if i < len(unread) and unread[i] == text_no:
+                del unread[i]
+                self._unread_changed(unread_conf_no)
+
+
+_trackers = weakref.WeakKeyDictionary() # AioKomSession -> UnreadTracker
+
+
+def get_tracker(ksession, pers_no=None):
+    """Return the unread tracker for ksession if pers_no is the
+    logged in person (or None), otherwise None.
+    """
+    tracker = _trackers.get(ksession)
+    if tracker is None or (pers_no is not None and tracker.pers_no != pers_no):
+        return None
+    return tracker
+
+def start_tracking(ksession, pers_no):
+    """Start tracking unread texts for pers_no, which has just logged
+    in on ksession. The unread texts are calculated in the background.
+    """
+    stop_tracking(ksession)
+    tracker = UnreadTracker(pers_no, current_app.config['HTTPKOM_UNREAD_TRACKER_MAX_AGE'])
+    _trackers[ksession] = tracker
+    stats.set('unreads.trackers.started.last', 1, agg='sum')
+
+    async def build():
+        capture.detach_from_request()
+        try:
+            await tracker._ensure_built(ksession)
+        except Exception:
+            log.exception("Failed to build unread tracker for person %d", pers_no)
+
+    # Keep a reference to the task, the event loop only has a weak
+    # one.
+    tracker._build_task = asyncio.create_task(build())
+
+def stop_tracking(ksession):
+    tracker = _trackers.pop(ksession, None)
+    if tracker is not None and tracker._build_task is not None:
+        tracker._build_task.cancel()
+        tracker._build_task = None
+
+
+def text_read(ksession, text_no, conf_no=None):
+    """Text has been marked as read in conf_no, or in all recipient
+    conferences if conf_no is None.
+    """
+    tracker = _trackers.get(ksession)
+    if tracker is not None:
+        tracker.remove_text(text_no, conf_no)
+
+def text_read_local(ksession, conf_no, text_no):
+    """A text in conf_no has been marked as read, but we only know its
+    global text number if text_no is not None.
+    """
+    tracker = _trackers.get(ksession)
+    if tracker is not None:
+        if text_no is None:
+            tracker.mark_stale(conf_no)
+        else:
+            tracker.remove_text(text_no, conf_no)
+
+def conference_changed(ksession, conf_no):
+    """The unread texts in conf_no (or the membership) have been
+    changed in a way we can't follow, so fetch them again when
+    needed.
+    """
+    tracker = _trackers.get(ksession)
+    if tracker is not None:
+        tracker.mark_stale(conf_no)
+
+def rebuild(ksession):
+    """The unread texts may have been changed in ways we can't follow,
+    so calculate all of them again when needed.
+    """
+    tracker = _trackers.get(ksession)
+    if tracker is not None:
+        tracker.built_at = None
+
+def membership_changed(ksession, pers_no, conf_no):
+    """The membership for pers_no in conf_no has been added, changed or
+    removed.
+    """
+    tracker = get_tracker(ksession, pers_no)
+    if tracker is not None:
+        tracker.membership_changed(conf_no)
+
+async def text_unread(ksession, text_no):
+    """Text has been marked as unread in all recipient conferences."""
+    tracker = _trackers.get(ksession)
+    if tracker is not None:
+        text_stat = await ksession.get_text_stat(text_no)
+        for rcpt in text_stat.misc_info.recipient_list:
+            tracker.add_text(rcpt.recpt, text_no)
+
+
+async def register_async_handlers(ksession):
+    """Keep the unread tracker for ksession (if any) up to date with
+    the async messages received by ksession.
+    """
+    # The handlers only keep a weak reference to the session, so they
+    # don't keep it alive.
+    ksession_ref = weakref.ref(ksession)
+
+    def tracker():
+        ks = ksession_ref()
+        if ks is None:
+            return None
+        return _trackers.get(ks)
+
+    async def new_text(msg):
+        t = tracker()
+        # The server marks new texts as read for their author.
+        if t is not None and msg.text_stat.author != t.pers_no:
+            for rcpt in msg.text_stat.misc_info.recipient_list:
+                t.add_text(rcpt.recpt, msg.text_no)
+
+    async def deleted_text(msg):
+        t = tracker()
+        if t is not None:
+            t.remove_text(msg.text_no)
+
+    async def new_recipient(msg):
+        t = tracker()
+        if t is not None:
+            t.add_text(msg.conf_no, msg.text_no)
+
+    async def sub_recipient(msg):
+        t = tracker()
+        if t is not None:
+            t.remove_text(msg.text_no, msg.conf_no)
+
+    async def leave_conf(msg):
+        t = tracker()
+        if t is not None:
+            t.membership_changed(msg.conf_no)
+
+    async def new_membership(msg):
+        t = tracker()
+        if t is not None and msg.person_no == t.pers_no:
+            t.membership_changed(msg.conf_no)
+
+    # The caching client in pylyskom already accepts these async
+    # messages.
+    client = ksession._client
+    await client.register_async_handler(AsyncMessages.NEW_TEXT, new_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.DELETED_TEXT, deleted_text, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.NEW_RECIPIENT, new_recipient, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.SUB_RECIPIENT, sub_recipient, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.LEAVE_CONF, leave_conf, skip_accept_async=True)
+    await client.register_async_handler(AsyncMessages.NEW_MEMBERSHIP, new_membership, skip_accept_async=True)
@@ -5,8 +5,53 @@ from typing import Dict, Optional
 
 from quart import g, jsonify, websocket
 
+from pylyskom import requests
+
 from httpkom import HTTPKOM_CONNECTION_HEADER, app
 from .sessions import _get_komsession
+from . import jsonbackend
+from . import names
+from . import unreads
+
+
+# Raw protocol A requests that change the read texts in the conference
+# in their first argument.
+_READ_MARKING_CALLS = frozenset(r.CALL_NO for r in (
+    requests.ReqMarkAsRead, requests.ReqMarkAsUnread, requests.ReqSetLastRead,
+    requests.ReqSetReadRanges, requests.ReqSetUnread ))
+
+# Raw protocol A requests that change a membership, and the positions
+# of the conference and person arguments.
+_MEMBERSHIP_CALLS = {
+    requests.ReqAddMember.CALL_NO: (1, 2),
+    requests.ReqSubMember.CALL_NO: (1, 2),
+    requests.ReqSetMembershipType.CALL_NO: (2, 1),
+}
+
+
+def _raw_request_made(komsession, request):
+    """Tell the unread tracker (and the name index) about the changes
+    that a raw protocol A request (without ref_no) may have made, since
+    they don't go through our views.
+    """
+    args = request.split()
+    try:
+        call_no = int(args[0])
+    except (IndexError, ValueError):
+        return
+    if call_no not in _READ_MARKING_CALLS and call_no not in _MEMBERSHIP_CALLS:
+        return
+    try:
+        if call_no in _READ_MARKING_CALLS:
+            unreads.conference_changed(komsession, int(args[1]))
+        else:
+            conf_arg, pers_arg = _MEMBERSHIP_CALLS[call_no]
+            unreads.membership_changed(komsession, int(args[pers_arg]), int(args[conf_arg]))
+            names.membership_changed(komsession)
+    except (IndexError, ValueError):
+        # We don't know which conference it was, so calculate all
+        # unread texts again.
+        unreads.rebuild(komsession)
 
 
 def _get_connection_id_from_websocket():
@@ -62,15 +107,18 @@ class WebSocketConnection:
                     'ref_no': ref_no,
                     'reply': request,
                 }
-                await self.ws.send(json.dumps(rep_msg))
+                await self.ws.send(jsonbackend.dumps(rep_msg))
             elif protocol == 'a':
-                reply = await self.komsession.raw_request(request.encode('utf-8'))
+                try:
+                    reply = await self.komsession.raw_request(request.encode('utf-8'))
+                finally:
+                    _raw_request_made(self.komsession, request)
                 rep_msg = {
                     'protocol': protocol,
                     'ref_no': ref_no,
                     'reply': reply.decode('utf-8')
                 }
-                await self.ws.send(json.dumps(rep_msg))
+                await self.ws.send(jsonbackend.dumps(rep_msg))
             else:
                 # ignore invalid
                 app.logger.debug(f"Websocket recieved: invalid, unknown protocol: {protocol}")
@@ -86,7 +134,7 @@ class WebSocketConnection:
             'ref_no': ref_no,
             'error': error
         }
-        await self.ws.send(json.dumps(error_response))
+        await self.ws.send(jsonbackend.dumps(error_response))
 
 
     async def handle_connection(self):
@@ -97,7 +145,7 @@ class WebSocketConnection:
                 app.logger.debug(f"Websocket received: {data!r}")
 
                 try:
-                    req_msg = json.loads(data)
+                    req_msg = jsonbackend.loads(data)
                 except json.JSONDecodeError:
                     app.logger.error(f"Failed to json decode {data!r}: {de}")
                     continue
@@ -21,10 +21,16 @@ setuptools.setup(
     zip_safe=False,
     python_requires='>=3.7',
     install_requires=[
-        'pylyskom>=0.8',
+        # httpkom.backends uses private parts of pylyskom.aio.
+        'pylyskom==0.9',
         'Flask>=2.2.2',
         'Hypercorn>=0.14.3',
         'six>=1.14.0',
         'Quart>=0.18.0',
-    ]
+    ],
+    extras_require={
+        'orjson': ['orjson'],
+        'brotli': ['brotli'],
+        'uvloop': ['uvloop'],
+    },
 )
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from httpkom import HTTPKOM_CONNECTION_HEADER, app, default_settings, init_app
+from httpkom import sessions
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """The default settings, in app.config. Tests may change them."""
+    saved = dict(app.config)
+    app.config.from_object(default_settings)
+    yield app.config
+    app.config.clear()
+    app.config.update(saved)
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine in a new event loop, with an app context (for
+    current_app).
+    """
+    def run(coro):
+        async def main():
+            async with app.app_context():
+                return await coro
+        return asyncio.run(main())
+    return run
+
+
+@pytest.fixture(scope='session')
+def http_app():
+    """The app with all views, for requests with the test client."""
+    if 'frontend' not in app.blueprints:
+        init_app(app)
+    return app
+
+
+@pytest.fixture
+def client(http_app):
+    return http_app.test_client()
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """Make a (fake) session the session of a connection. Returns the
+    headers to send in requests that use the session.
+    """
+    def connect(ksession, connection_id='test-connection'):
+        monkeypatch.setitem(sessions._komsessions, connection_id, ksession)
+        return { HTTPKOM_CONNECTION_HEADER: connection_id }
+    return connect
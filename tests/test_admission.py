@@ -0,0 +1,160 @@
+import asyncio
+import gc
+
+import pytest
+
+from quart import g
+
+from httpkom import admission
+from httpkom.admission import _Limit, _Rejected
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    admission._global = _Limit()
+    admission._connections.clear()
+    admission._queued = 0
+    yield
+    admission._global = _Limit()
+    admission._connections.clear()
+    admission._queued = 0
+
+
+def test_acquire_and_release(run):
+    async def main():
+        limit = _Limit()
+        await admission._acquire(limit, 2, 0, 1)
+        await admission._acquire(limit, 2, 0, 1)
+        assert limit.active == 2
+        with pytest.raises(_Rejected): # the queue is full
+            await admission._acquire(limit, 2, 0, 1)
+        admission._release(limit)
+        admission._release(limit)
+        assert limit.is_idle()
+
+    run(main())
+
+
+def test_release_hands_over_the_slot(run):
+    async def main():
+        limit = _Limit()
+        await admission._acquire(limit, 1, 1, 1)
+        waiter = asyncio.ensure_future(admission._acquire(limit, 1, 1, 1))
+        await asyncio.sleep(0)
+        assert admission.queued() == 1
+        admission._release(limit)
+        # The slot is not free in between, so a new request has to wait.
+        assert limit.active == 1
+        with pytest.raises(_Rejected):
+            await admission._acquire(limit, 1, 0, 1)
+        await waiter
+        assert limit.active == 1
+        assert admission.queued() == 0
+        admission._release(limit)
+        assert limit.is_idle()
+
+    run(main())
+
+
+def test_queue_timeout(run):
+    async def main():
+        limit = _Limit()
+        await admission._acquire(limit, 1, 1, 1)
+        with pytest.raises(_Rejected):
+            await admission._acquire(limit, 1, 1, 0.01)
+        assert len(limit.waiters) == 0
+        assert admission.queued() == 0
+
+    run(main())
+
+
+def test_cancelled_waiter(run):
+    async def main():
+        limit = _Limit()
+        await admission._acquire(limit, 1, 1, 1)
+        waiter = asyncio.ensure_future(admission._acquire(limit, 1, 1, 1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        admission._release(limit)
+        assert limit.is_idle()
+
+    run(main())
+
+
+def test_admit_and_release(run, config):
+    config['HTTPKOM_MAX_REQUESTS_PER_CONNECTION'] = 1
+    config['HTTPKOM_MAX_QUEUED_REQUESTS_PER_CONNECTION'] = 0
+
+    async def main():
+        assert await admission.admit('a') is None
+        assert admission.active() == 1
+        ticket = g.admission_ticket
+        response = await admission.admit('a')
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == str(config['HTTPKOM_ADMISSION_RETRY_AFTER'])
+        admission.release()
+        assert admission.active() == 0
+        assert admission._connections == {}
+        # Releasing twice does nothing.
+        ticket.release()
+        assert admission.active() == 0
+
+    run(main())
+
+
+def test_admit_global_limit(run, config):
+    config['HTTPKOM_MAX_REQUESTS'] = 1
+    config['HTTPKOM_MAX_QUEUED_REQUESTS'] = 0
+
+    async def main():
+        assert await admission.admit('a') is None
+        response = await admission.admit('b')
+        assert response.status_code == 503
+        assert 'b' not in admission._connections
+        admission.release()
+        assert admission.active() == 0
+
+    run(main())
+
+
+def test_release_after_body_is_sent(run):
+    async def body():
+        yield b'a'
+        yield b'b'
+
+    async def main():
+        await admission.admit('a')
+        iterator = admission.release_after(body())
+        # The slots are kept by the body, not by the request.
+        admission.release()
+        assert admission.active() == 1
+        assert [ item async for item in iterator ] == [ b'a', b'b' ]
+        assert admission.active() == 0
+
+    run(main())
+
+
+def test_release_after_body_is_never_started(run):
+    async def body():
+        yield b'a'
+
+    async def main():
+        await admission.admit('a')
+        iterator = admission.release_after(body())
+        assert admission.active() == 1
+        del iterator
+        gc.collect()
+        assert admission.active() == 0
+        assert admission._connections == {}
+
+    run(main())
+
+
+def test_release_after_without_ticket(run):
+    async def main():
+        iterator = object()
+        assert admission.release_after(iterator) is iterator
+
+    run(main())
@@ -0,0 +1,244 @@
+import asyncio
+import contextvars
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.komsession import KomSessionNotConnected
+
+from httpkom import backends
+from httpkom.backends import CLOSED, HALF_OPEN, OPEN, LysKOMTimeout, LysKOMUnavailable, \
+    _Backend, _Client
+
+
+class FakeSession(object):
+    def is_connected(self):
+        return True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time for the circuit breakers. Set clock[0] to move it."""
+    clock = [ 1000.0 ]
+    # Not time.monotonic() itself, which the event loop uses.
+    monkeypatch.setattr(backends, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    return clock
+
+
+@pytest.fixture
+def backend(config, clock):
+    config['HTTPKOM_CIRCUIT_BREAKER_FAILURES'] = 2
+    config['HTTPKOM_CIRCUIT_BREAKER_RESET_TIMEOUT'] = 30
+    return _Backend('test')
+
+
+def connect(backend, succeed):
+    backend.check_connect()
+    backend.connect_done()
+    if succeed:
+        backend.success()
+    else:
+        backend.failure()
+
+
+def probe_request(backend):
+    # Requests made while connecting a probe.
+    def check():
+        backends._connecting.set(True)
+        backend.check_request()
+    contextvars.copy_context().run(check)
+
+
+def test_opens_after_failures_in_a_row(backend):
+    backend.failure()
+    backend.success()
+    backend.failure()
+    assert backend.state == CLOSED
+    backend.failure()
+    assert backend.state == OPEN
+
+    with pytest.raises(LysKOMUnavailable) as excinfo:
+        backend.check_request()
+    assert excinfo.value.retry_after == 30
+    with pytest.raises(LysKOMUnavailable):
+        backend.check_connect()
+    assert backend.connecting == 0
+
+
+def test_half_open_probe_succeeds(backend, clock):
+    backend.failure()
+    backend.failure()
+    clock[0] += 30
+    backend.check_connect()
+    assert backend.state == HALF_OPEN
+    probe_request(backend)
+    # Only the probe is let through.
+    with pytest.raises(LysKOMUnavailable):
+        backend.check_request()
+    with pytest.raises(LysKOMUnavailable):
+        backend.check_connect()
+    backend.connect_done()
+    backend.success()
+    assert backend.state == CLOSED
+    assert backend.failures == 0
+    backend.check_request()
+
+
+def test_half_open_probe_fails(backend, clock):
+    backend.failure()
+    backend.failure()
+    clock[0] += 30
+    connect(backend, succeed=False)
+    assert backend.state == OPEN
+    clock[0] += 29
+    with pytest.raises(LysKOMUnavailable) as excinfo:
+        backend.check_connect()
+    assert excinfo.value.retry_after == 1
+
+
+def test_hanging_probe(backend, clock):
+    backend.failure()
+    backend.failure()
+    clock[0] += 30
+    backend.check_connect()
+    # The probe never finishes, another one is let through later.
+    clock[0] += 30
+    backend.check_connect()
+    assert backend.connecting == 2
+
+
+def test_connection_budget(backend, config):
+    config['HTTPKOM_MAX_LYSKOM_CONNECTIONS_PER_SERVER'] = 2
+    ksession = FakeSession()
+    backend.sessions.add(ksession)
+    backend.check_connect()
+    assert backend.connecting == 1
+    # Connections that are being made count too.
+    with pytest.raises(LysKOMUnavailable) as excinfo:
+        backend.check_connect()
+    assert excinfo.value.retry_after == config['HTTPKOM_ADMISSION_RETRY_AFTER']
+    backend.connect_done()
+    assert backend.connecting == 0
+    backend.check_connect()
+    backend.connect_done()
+
+
+def test_health(backend):
+    ksession = FakeSession()
+    backend.sessions.add(ksession)
+    backend.check_connect()
+    backend.failure()
+    assert backend.health() == dict(state=CLOSED, failures_in_a_row=1, connections=1,
+                                    connecting=1, requests_in_flight=0)
+
+
+class FakeConnection(object):
+    """The parts of AioConnection that the client uses. Replies are
+    put in self.responses.
+    """
+
+    def __init__(self):
+        self._ref_no = 0
+        self.connected = True
+        self.responses = asyncio.Queue()
+
+    def is_connected(self):
+        return self.connected
+
+    async def send_request(self, request):
+        self._ref_no += 1
+        return self._ref_no
+
+    async def read_response(self):
+        response = await self.responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def close(self):
+        self.connected = False
+
+
+def start_client(backend):
+    conn = FakeConnection()
+    client = _Client(conn, backend)
+    client._response_receiver_task = asyncio.ensure_future(client._run_response_receiver())
+    return client, conn
+
+
+def test_request(backend, run):
+    async def main():
+        client, conn = start_client(backend)
+        request = asyncio.ensure_future(client.request(requests.ReqGetTime()))
+        await asyncio.sleep(0)
+        assert backend.in_flight == 1
+        conn.responses.put_nowait((1, 'reply', None, None, b'reply'))
+        assert await request == 'reply'
+        assert backend.in_flight == 0
+        await client.close()
+
+    run(main())
+
+
+def test_request_timeout(backend, config, run):
+    config['HTTPKOM_LYSKOM_READ_TIMEOUT'] = 0.01
+
+    async def main():
+        client, conn = start_client(backend)
+        with pytest.raises(LysKOMTimeout):
+            await client.request(requests.ReqGetTime())
+        assert backend.failures == 1
+        # The late reply is thrown away.
+        conn.responses.put_nowait((1, 'late', None, None, b'late'))
+        await asyncio.sleep(0)
+        assert client._reply_queue == {}
+        assert client._abandoned == set()
+        await client.close()
+
+    run(main())
+
+
+def test_connection_lost(backend, run, caplog):
+    async def main():
+        client, conn = start_client(backend)
+        request = asyncio.ensure_future(client.request(requests.ReqGetTime()))
+        await asyncio.sleep(0)
+        conn.responses.put_nowait(komerror.ReceiveError())
+        with pytest.raises(ConnectionResetError):
+            await request
+        assert not client.is_connected()
+        assert backend.failures == 1
+
+    run(main())
+    assert "Connection to LysKOM server test lost" in caplog.text
+
+
+def test_disconnect_is_not_logged(backend, run, caplog):
+    async def main():
+        client, conn = start_client(backend)
+        request = asyncio.ensure_future(client.request(requests.ReqDisconnect(0)))
+        await asyncio.sleep(0)
+        conn.responses.put_nowait(komerror.ReceiveError())
+        with pytest.raises(ConnectionResetError):
+            await request
+
+    with caplog.at_level(logging.DEBUG, logger="httpkom.backends"):
+        run(main())
+    assert [ r.levelno for r in caplog.records ] == [ logging.DEBUG ]
+
+
+def test_raw_request_when_closed(backend, run):
+    async def main():
+        client, conn = start_client(backend)
+        request = asyncio.ensure_future(client.raw_request(b'35'))
+        await asyncio.sleep(0)
+        await client.close()
+        with pytest.raises(KomSessionNotConnected):
+            await request
+        # Closing the session is not a failure of the server.
+        assert backend.failures == 0
+
+    run(main())
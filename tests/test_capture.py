@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from httpkom import capture
+
+
+PERS_NO = 14506 # logged in
+OTHER_PERS_NO = 1234
+CONF_NO = 6
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.calls = []
+
+    def is_connected(self):
+        return True
+
+    async def is_logged_in(self):
+        return True
+
+    async def get_current_person_no(self):
+        return PERS_NO
+
+    async def add_membership(self, pers_no, conf_no, priority, where):
+        self.calls.append((pers_no, conf_no, priority, where))
+
+
+@pytest.fixture
+def captured(config, tmp_path, monkeypatch):
+    """Capture to a file. Returns a function that returns the captured
+    records and the raw content of the file.
+    """
+    path = tmp_path / 'capture.jsonl'
+    config['HTTPKOM_CAPTURE_FILE'] = str(path)
+    monkeypatch.setattr(capture, '_capture_file', None)
+
+    def captured():
+        capture._capture_file.close()
+        capture._capture_file = None
+        content = path.read_text()
+        return [ json.loads(line) for line in content.splitlines() ], content
+    return captured
+
+
+def put_membership(run, client, headers, pers_no, body, query_string=None):
+    async def put():
+        response = await client.put(
+            '/lyslyskom/persons/%d/memberships/%d' % (pers_no, CONF_NO),
+            headers=headers, json=body, query_string=query_string)
+        return response.status_code
+    return run(put())
+
+
+def test_numbers_are_pseudonyms(run, client, connect, captured):
+    ksession = FakeSession()
+    headers = connect(ksession)
+    assert put_membership(run, client, headers, PERS_NO, dict(priority=100)) == 201
+    assert put_membership(run, client, headers, OTHER_PERS_NO,
+                          dict(pers_no=PERS_NO, conf_no=CONF_NO, text_no=100)) == 201
+    assert ksession.calls == [ (PERS_NO, CONF_NO, 100, 0), (OTHER_PERS_NO, CONF_NO, 100, 0) ]
+
+    records, content = captured()
+    assert [ r['route'] for r in records ] == [
+        '/<string:server_id>/persons/<int:pers_no>/memberships/<int:conf_no>' ] * 2
+    # The logged in person is "self", other numbers are keyed hashes.
+    assert records[0]['args'] == dict(pers_no='self', conf_no=capture._pseudonym(CONF_NO))
+    assert records[1]['args']['pers_no'] == capture._pseudonym(OTHER_PERS_NO)
+    assert records[1]['body']['values'] == dict(
+        pers_no='self', conf_no=capture._pseudonym(CONF_NO), text_no=capture._pseudonym(100))
+    assert records[0]['conn'] == records[1]['conn'] == capture._pseudonym('test-connection')
+    assert 'test-connection' not in content
+
+
+def test_pseudonyms_depend_on_the_key(monkeypatch):
+    pseudonym = capture._pseudonym(PERS_NO)
+    monkeypatch.setattr(capture, '_KEY', b'another key')
+    assert capture._pseudonym(PERS_NO) != pseudonym
+
+
+def test_only_known_query_values_are_written(run, client, connect, captured):
+    put_membership(run, client, connect(FakeSession()), PERS_NO, {},
+                   query_string={ 'fields': 'conf_no', 'name': 'Oskars Testperson',
+                                  'Httpkom-Connection': 'test-connection' })
+    records, content = captured()
+    assert records[0]['query'] == dict(fields='conf_no', name=None)
+    assert 'Oskars Testperson' not in content
+
+
+def test_bodies_are_summarized(run, client, connect, captured):
+    body = dict(priority=100, where=3, name="Oskars Testperson", password="hemligt",
+                text_nos=[ 1, 2, 3 ], aux_items=[ dict(data="Hej") ], type=dict(secret=True))
+    put_membership(run, client, connect(FakeSession()), PERS_NO, body)
+    records, content = captured()
+    assert records[0]['body'] == dict(lists=dict(text_nos=3, aux_items=1),
+                                      values=dict(priority=100, where=3))
+    for raw in ("Oskars Testperson", "hemligt", "Hej", "secret"):
+        assert raw not in content
+
+
+def test_nothing_is_captured_by_default(run, client, connect, monkeypatch):
+    monkeypatch.setattr(capture, '_capture_file', None)
+    put_membership(run, client, connect(FakeSession()), PERS_NO, {})
+    assert capture._capture_file is None
@@ -0,0 +1,192 @@
+import gzip
+import os
+import zlib
+from collections import OrderedDict
+
+import pytest
+from quart import Quart, Response
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from httpkom import compression
+
+
+SMALL = b'{"a": 1}'
+LARGE = b'{"texts": [' + b', '.join(b'{"text_no": %d}' % i for i in range(1000)) + b']}'
+CHUNKS = [ b'{"texts": [', b'{"text_no": 1}', b', {"text_no": 2}' * 500, b']}' ]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(compression, '_cache', OrderedDict())
+    monkeypatch.setattr(compression, '_cache_size', 0)
+    return compression._cache
+
+
+@pytest.fixture
+def client(cache):
+    """A client for an app with only the compression of responses."""
+    app = Quart(__name__)
+    app.after_request(compression.compress_response)
+
+    @app.route('/small')
+    async def small():
+        return Response(SMALL, mimetype='application/json')
+
+    @app.route('/large')
+    async def large():
+        return Response(LARGE, mimetype='application/json')
+
+    @app.route('/image')
+    async def image():
+        return Response(LARGE, mimetype='image/png')
+
+    @app.route('/stream')
+    async def stream():
+        async def chunks():
+            for chunk in CHUNKS:
+                yield chunk
+        return Response(chunks(), mimetype='application/json')
+
+    @app.route('/cached/<int:key>')
+    async def cached(key):
+        # Random, so that it doesn't compress.
+        return compression.set_cache_key(
+            Response(os.urandom(2000), mimetype='text/plain'), key)
+
+    return app.test_client()
+
+
+def get(run, client, path, accept_encoding):
+    async def get():
+        headers = {}
+        if accept_encoding is not None:
+            headers['Accept-Encoding'] = accept_encoding
+        response = await client.get(path, headers=headers)
+        return response, await response.get_data()
+    return run(get())
+
+
+@pytest.mark.parametrize('header, encoding', [
+    (None, None),
+    ('identity', None),
+    ('gzip', 'gzip'),
+    ('br', 'br'),
+    ('gzip, br', 'br'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('*', 'br'),
+    ('gzip;q=0, br;q=0', None),
+    ('deflate', None),
+])
+def test_choose_encoding(monkeypatch, header, encoding):
+    monkeypatch.setattr(compression, 'ENCODINGS', ('br', 'gzip'))
+    assert compression.choose_encoding(parse_accept_header(header, Accept)) == encoding
+
+
+def test_without_brotli_gzip_is_used(monkeypatch):
+    monkeypatch.setattr(compression, 'ENCODINGS', ('gzip',))
+    assert compression.choose_encoding(parse_accept_header('br, gzip;q=0.5', Accept)) == 'gzip'
+    assert compression.choose_encoding(parse_accept_header('br', Accept)) is None
+
+
+@pytest.mark.parametrize('accept_encoding', [ None, 'identity' ])
+def test_identity(run, client, accept_encoding):
+    response, data = get(run, client, '/large', accept_encoding)
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert data == LARGE
+
+
+def test_gzip(run, client):
+    response, data = get(run, client, '/large', 'gzip, deflate')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert int(response.headers['Content-Length']) == len(data) < len(LARGE)
+    assert gzip.decompress(data) == LARGE
+
+
+@pytest.mark.skipif(compression.brotli is None, reason="brotli is not installed")
+def test_brotli(run, client):
+    response, data = get(run, client, '/large', 'gzip, br')
+    assert response.headers['Content-Encoding'] == 'br'
+    assert compression.brotli.decompress(data) == LARGE
+
+
+def test_small_body_is_not_compressed(run, client):
+    response, data = get(run, client, '/small', 'gzip')
+    assert 'Content-Encoding' not in response.headers
+    # The response would have been compressed if it had been larger.
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert data == SMALL
+
+
+def test_incompressible_mimetype(run, client):
+    response, data = get(run, client, '/image', 'gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert 'Vary' not in response.headers
+    assert data == LARGE
+
+
+def test_compression_can_be_turned_off(run, client, config):
+    config['HTTPKOM_COMPRESSION_MIN_SIZE'] = None
+    response, data = get(run, client, '/large', 'gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert data == LARGE
+
+
+def test_stream(run, client):
+    response, data = get(run, client, '/stream', 'gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(data) == b''.join(CHUNKS)
+
+
+def test_stream_chunks_can_be_decompressed_when_received(run):
+    async def chunks():
+        for chunk in CHUNKS:
+            yield chunk
+
+    async def compressed_chunks():
+        return [ chunk async for chunk in compression._compress_stream(chunks(), 'gzip') ]
+
+    decompressor = zlib.decompressobj(31)
+    received = b''
+    for chunk, compressed in zip(CHUNKS, run(compressed_chunks())):
+        received += decompressor.decompress(compressed)
+        # Everything so far, without waiting for the end of the stream.
+        assert received.endswith(chunk)
+    assert received == b''.join(CHUNKS)
+
+
+def test_cache_hit(run, client, cache, monkeypatch):
+    compressed = []
+    compress = compression.compress
+    monkeypatch.setattr(compression, 'compress',
+                        lambda *args, **kwargs: compressed.append(args) or compress(*args, **kwargs))
+    _, first = get(run, client, '/cached/1', 'gzip')
+    _, second = get(run, client, '/cached/1', 'gzip')
+    # The view made a new (random) body, but the cached one is used.
+    assert second == first
+    assert len(compressed) == 1
+    assert list(cache) == [ (1, 'gzip') ]
+    # Uncompressed responses are not cached.
+    get(run, client, '/cached/1', None)
+    assert len(compressed) == 1
+
+
+def test_cache_eviction(run, client, cache, config):
+    # Room for two (random, so incompressible) bodies.
+    config['HTTPKOM_COMPRESSION_CACHE_MAX_BYTES'] = 5000
+    for key in (1, 2, 1, 3):
+        get(run, client, '/cached/%d' % key, 'gzip')
+    # 2 was the least recently used.
+    assert list(cache) == [ (1, 'gzip'), (3, 'gzip') ]
+    assert compression._cache_size == sum(len(v) for v in cache.values()) <= 5000
+
+
+def test_too_large_body_is_not_cached(run, client, cache, config):
+    config['HTTPKOM_COMPRESSION_CACHE_MAX_BYTES'] = 1000
+    response, data = get(run, client, '/cached/1', 'gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(gzip.decompress(data)) == 2000
+    assert cache == {}
+    assert compression._cache_size == 0
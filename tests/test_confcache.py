@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import pytest
+
+import pylyskom.errors as komerror
+from pylyskom.komsession import KomConferenceName
+
+from httpkom import confcache
+
+
+SECRET = 7
+UNKNOWN = 8
+
+
+class FakeSession(object):
+    async def get_conference(self, conf_no, micro=True):
+        if conf_no == UNKNOWN:
+            raise komerror.UndefinedConference(conf_no)
+        return SimpleNamespace(type=SimpleNamespace(secret=conf_no == SECRET))
+
+
+def conference(secret=False, super_conf=0, aux_items=()):
+    return SimpleNamespace(
+        type=SimpleNamespace(secret=secret), creator=None, supervisor=None,
+        permitted_submitters=None, super_conf=KomConferenceName(super_conf, ""),
+        aux_items=[ SimpleNamespace(creator=None, flags=SimpleNamespace(secret=is_secret))
+                    for is_secret in aux_items ])
+
+
+@pytest.mark.parametrize('conf, micro, cacheable', [
+    (conference(), True, True),
+    (conference(), False, True),
+    (conference(secret=True), True, False),
+    (conference(super_conf=SECRET), True, True),
+    (conference(super_conf=SECRET), False, False),
+    (conference(super_conf=UNKNOWN), False, False),
+    (conference(aux_items=[ False ]), False, True),
+    (conference(aux_items=[ False, True ]), False, False),
+])
+def test_is_cacheable(run, conf, micro, cacheable):
+    assert run(confcache._is_cacheable(FakeSession(), conf, micro)) == cacheable
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom import requests
+from pylyskom.datatypes import TextStat
+
+from httpkom import textmaps
+
+
+CONF_NO = 1
+HIGHEST = 600 # texts 1..HIGHEST, local text number l is text 1000 + l
+
+
+class FakeClient(object):
+    """Answers local-to-global(-reverse) requests for a conference with
+    a text for every local text number.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, request):
+        self.requests.append(request)
+        conf_no, local_no, n = request.args
+        if isinstance(request, requests.ReqLocalToGlobal):
+            local_nos = range(local_no, min(local_no + n, HIGHEST + 1))
+            later = local_nos[-1] < HIGHEST
+        else:
+            assert isinstance(request, requests.ReqLocalToGlobalReverse)
+            local_nos = range(max(local_no - n, 1), local_no)
+            later = local_nos[0] > 1
+        return SimpleNamespace(range_begin=local_nos[0], range_end=local_nos[-1] + 1,
+                               later_texts_exists=int(later),
+                               list=[ (l, 1000 + l) for l in local_nos ])
+
+
+class FakeSession(object):
+    def __init__(self):
+        self._client = FakeClient()
+
+    def is_connected(self):
+        return True
+
+    async def is_logged_in(self):
+        return True
+
+    async def get_conference(self, conf_no, micro=True):
+        return SimpleNamespace(highest_local_no=HIGHEST,
+                               type=SimpleNamespace(rd_prot=False, secret=False))
+
+    async def get_text_stat(self, text_no):
+        return TextStat()
+
+
+@pytest.fixture
+def ksession(monkeypatch):
+    monkeypatch.setattr(textmaps, '_maps', OrderedDict())
+    return FakeSession()
+
+
+def get_texts(run, client, headers, **args):
+    async def get():
+        args.setdefault('fields', 'text_no')
+        response = await client.get('/lyslyskom/conferences/%d/texts/' % CONF_NO,
+                                    headers=headers, query_string=args)
+        return response.status_code, await response.get_json()
+    return run(get())
+
+
+@pytest.mark.parametrize('args', [
+    { 'no-of-texts': '0' },
+    { 'no-of-texts': '-1' },
+    { 'no-of-texts': 'ten' },
+    { 'no-of-texts': '1.5' },
+    { 'local-no': 'last' },
+])
+def test_invalid_paging(run, client, connect, ksession, args):
+    status, body = get_texts(run, client, connect(ksession), **args)
+    assert status == 400
+    assert body['error_msg'].startswith('Invalid')
+    assert ksession._client.requests == []
+
+
+def test_page(run, client, connect, ksession):
+    status, body = get_texts(run, client, connect(ksession), **{ 'no-of-texts': '3' })
+    assert status == 200
+    assert body == dict(first_local_no=HIGHEST - 2, last_local_no=HIGHEST, has_more=True,
+                        texts=[ dict(text_no=1000 + l) for l in range(HIGHEST - 2, HIGHEST + 1) ])
+
+
+@pytest.mark.parametrize('no_of_texts', [ 256, 1000000 ])
+def test_page_size_is_capped(run, client, connect, ksession, config, no_of_texts):
+    assert config['HTTPKOM_MAX_TEXTS_PER_PAGE'] == 255
+    status, body = get_texts(run, client, connect(ksession), **{ 'no-of-texts': str(no_of_texts) })
+    assert status == 200
+    assert len(body['texts']) == 255
+    assert body['first_local_no'] == HIGHEST - 254
+    assert body['has_more'] is True
+
+
+@pytest.mark.parametrize('direction, local_no, first, last', [
+    ('backwards', 5, 1, 5),
+    ('forwards', HIGHEST - 4, HIGHEST - 4, HIGHEST),
+])
+def test_last_page_has_no_more(run, client, connect, ksession, direction, local_no, first, last):
+    status, body = get_texts(run, client, connect(ksession), direction=direction,
+                             **{ 'no-of-texts': '5', 'local-no': str(local_no) })
+    assert status == 200
+    assert (body['first_local_no'], body['last_local_no']) == (first, last)
+    assert body['has_more'] is False
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from httpkom import admission, app, drain, sessions
+from httpkom.admission import _Limit
+
+
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+    monkeypatch.setattr(drain, '_state', drain.SERVING)
+    monkeypatch.setattr(drain, '_task', None)
+    monkeypatch.setattr(drain, '_started_at', None)
+    monkeypatch.setattr(drain, '_result', None)
+    monkeypatch.setattr(drain, '_on_drained', [])
+    monkeypatch.setattr(admission, '_global', _Limit())
+    monkeypatch.setattr(admission, '_queued', 0)
+
+
+@pytest.fixture
+def komsessions(monkeypatch):
+    """The LysKOM sessions: how many are being opened, and how many
+    have been closed by the drain.
+    """
+    komsessions = dict(opening=0, closed=0)
+
+    async def close_all_komsessions(batch_size):
+        komsessions['closed'] += 3
+        return 3, 0
+
+    monkeypatch.setattr(sessions, 'opening_komsessions', lambda: komsessions['opening'])
+    monkeypatch.setattr(sessions, 'close_all_komsessions', close_all_komsessions)
+    return komsessions
+
+
+def test_waits_for_running_opening_and_queued_requests(run, komsessions):
+    async def finish_later():
+        await asyncio.sleep(0.06)
+        admission._global.active -= 1
+        await asyncio.sleep(0.06)
+        komsessions['opening'] -= 1
+        await asyncio.sleep(0.06)
+        admission._queued -= 1
+
+    async def main():
+        admission._global.active = 1
+        admission._queued = 1
+        komsessions['opening'] = 1
+        finishing = asyncio.ensure_future(finish_later())
+        abandoned = await drain._wait_for_requests(5)
+        assert finishing.done()
+        return abandoned
+
+    assert run(main()) == 0
+
+
+def test_abandons_requests_after_timeout(run, komsessions):
+    admission._global.active = 1
+    admission._queued = 1
+    assert run(drain._wait_for_requests(0.01)) == 2
+
+
+def test_drain(run, komsessions, config):
+    config['HTTPKOM_DRAIN_TIMEOUT'] = 0.01
+    drained = []
+    drain.on_drained(lambda: drained.append(True))
+
+    async def main():
+        admission._global.active = 1
+        assert not drain.is_draining()
+        task = drain.start()
+        assert drain.start() is task
+        assert drain.is_draining()
+        await drain.drain()
+
+    run(main())
+    assert drained == [ True ]
+    assert komsessions['closed'] == 3
+    assert drain._state == drain.DRAINED
+    result = dict(drain._result)
+    del result['seconds']
+    assert result == dict(requests_abandoned=1, komsessions_closed=3, komsessions_failed=0)
+
+
+def test_failing_on_drained_function(run, komsessions):
+    def fail():
+        raise RuntimeError()
+
+    drained = []
+    drain.on_drained(fail)
+    drain.on_drained(lambda: drained.append(True))
+    run(drain.drain())
+    assert drained == [ True ]
+
+
+def test_admin_endpoint(run, komsessions, config):
+    async def main():
+        client = app.test_client()
+        response = await client.post('/admin/drain')
+        assert response.status_code == 404
+
+        config['HTTPKOM_ADMIN_TOKEN'] = 'secret'
+        response = await client.post('/admin/drain', headers={ 'Authorization': 'Bearer wrong' })
+        assert response.status_code == 403
+        assert not drain.is_draining()
+
+        response = await client.post('/admin/drain', query_string={ 'wait': '1' },
+                                     headers={ 'Authorization': 'Bearer secret' })
+        assert response.status_code == 200
+        return await response.get_json()
+
+    status = run(main())
+    assert status['state'] == drain.DRAINED
+    assert status['result']['komsessions_closed'] == 3
@@ -0,0 +1,144 @@
+import weakref
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import fragments
+
+
+@pytest.fixture(autouse=True)
+def empty(monkeypatch):
+    monkeypatch.setattr(fragments, '_fragments', OrderedDict())
+    monkeypatch.setattr(fragments, '_session_fragments', weakref.WeakKeyDictionary())
+
+
+class Builder(object):
+    """Builds a fragment for a name, and counts the builds."""
+
+    def __init__(self):
+        self.builds = []
+
+    def __call__(self, name):
+        def build():
+            self.builds.append(name)
+            return dict(name=name, list=[ dict(n=1) ])
+        return build
+
+    def coroutine(self, name):
+        async def build():
+            return self(name)()
+        return build
+
+
+class Session(object):
+    pass
+
+
+def test_fragments_are_read_only():
+    fragment = fragments.get_fragment('a', Builder()('a'))
+    assert fragment == dict(name='a', list=(dict(n=1),))
+    with pytest.raises(TypeError):
+        fragment['name'] = 'b'
+    with pytest.raises(TypeError):
+        fragment['list'][0]['n'] = 2
+    with pytest.raises(AttributeError):
+        fragment['list'].append(dict(n=2))
+
+
+def test_session_fragments_are_read_only(run):
+    source = object()
+    fragment = run(fragments.get_session_fragment(
+        Session(), 'a', source, Builder().coroutine('a')))
+    with pytest.raises(TypeError):
+        fragment['name'] = 'b'
+    assert isinstance(fragment['list'], tuple)
+
+
+def test_fragments_are_built_once():
+    builder = Builder()
+    first = fragments.get_fragment('a', builder('a'))
+    assert fragments.get_fragment('a', builder('a')) is first
+    assert builder.builds == [ 'a' ]
+
+
+def test_least_recently_used_fragment_is_evicted(monkeypatch):
+    monkeypatch.setattr(fragments, 'MAX_FRAGMENTS', 2)
+    builder = Builder()
+    for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+        fragments.get_fragment(key, builder(key))
+    # b was evicted by c, and c by b.
+    assert builder.builds == [ 'a', 'b', 'c', 'b' ]
+    assert list(fragments._fragments) == [ 'a', 'b' ]
+
+
+def test_least_recently_used_session_fragment_is_evicted(run, monkeypatch):
+    monkeypatch.setattr(fragments, 'MAX_SESSION_FRAGMENTS', 2)
+    builder = Builder()
+    session = Session()
+    source = object()
+    for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+        run(fragments.get_session_fragment(session, key, source, builder.coroutine(key)))
+    assert builder.builds == [ 'a', 'b', 'c', 'b' ]
+    assert list(fragments._session_fragments[session]) == [ 'a', 'b' ]
+
+
+def test_session_fragment_is_built_again_for_new_source(run):
+    builder = Builder()
+    session = Session()
+    source = object()
+    first = run(fragments.get_session_fragment(session, 'a', source, builder.coroutine('a')))
+    assert run(fragments.get_session_fragment(session, 'a', source, builder.coroutine('a'))) is first
+    run(fragments.get_session_fragment(session, 'a', object(), builder.coroutine('a')))
+    assert builder.builds == [ 'a', 'a' ]
+
+
+def test_sessions_do_not_share_fragments(run):
+    # Even for the same key and source object, since what the session
+    # may see depends on who is logged in.
+    source = object()
+    session1 = Session()
+    session2 = Session()
+    fragment1 = run(fragments.get_session_fragment(
+        session1, 'a', source, Builder().coroutine('secret')))
+    fragment2 = run(fragments.get_session_fragment(
+        session2, 'a', source, Builder().coroutine('public')))
+    assert fragment1['name'] == 'secret'
+    assert fragment2['name'] == 'public'
+    assert run(fragments.get_session_fragment(
+        session2, 'a', source, Builder().coroutine('other')))['name'] == 'public'
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.handlers = {}
+
+    async def register_async_handler(self, msg_no, handler, skip_accept_async):
+        self.handlers[msg_no] = handler
+
+
+def test_new_name_clears_the_session_fragments(run):
+    session = Session()
+    session._client = FakeClient()
+    other_session = Session()
+    run(fragments.register_async_handlers(session))
+    source = object()
+    for s in (session, other_session):
+        run(fragments.get_session_fragment(s, 'a', source, Builder().coroutine('a')))
+
+    run(session._client.handlers[AsyncMessages.NEW_NAME](SimpleNamespace(conf_no=1)))
+    assert session not in fragments._session_fragments
+    assert other_session in fragments._session_fragments
+    builder = Builder()
+    run(fragments.get_session_fragment(session, 'a', source, builder.coroutine('a')))
+    assert builder.builds == [ 'a' ]
+
+
+def test_session_fragments_go_away_with_the_session(run):
+    session = Session()
+    run(fragments.get_session_fragment(session, 'a', object(), Builder().coroutine('a')))
+    assert len(fragments._session_fragments) == 1
+    del session
+    assert len(fragments._session_fragments) == 0
@@ -0,0 +1,60 @@
+import dataclasses
+import datetime
+import decimal
+import json
+import uuid
+from types import MappingProxyType
+
+import pytest
+from quart.json.provider import DefaultJSONProvider
+
+from httpkom import jsonbackend
+
+
+@dataclasses.dataclass
+class Point(object):
+    x: int
+    y: int
+
+
+class Bits(list):
+    """Like the bitstrings in pylyskom."""
+
+
+VALUES = [
+    datetime.datetime(2013, 11, 30, 15, 58, 6),
+    datetime.date(2013, 11, 30),
+    decimal.Decimal('1.50'),
+    uuid.UUID(int=1),
+    Point(1, 2),
+    Bits([ 1, 0 ]),
+    { 'b': [ 1, 2.5, None, True ], 'a': "räksmörgås" },
+]
+
+BACKENDS = [ jsonbackend._json_dumps ]
+if jsonbackend.orjson is not None:
+    BACKENDS.append(jsonbackend._orjson_dumps)
+
+
+@pytest.mark.parametrize('value', VALUES)
+@pytest.mark.parametrize('dumps', BACKENDS)
+def test_backends_serialize_the_same(value, dumps):
+    # The same as Quart's own JSON provider gives, except for
+    # whitespace and the escaping of non-ASCII characters.
+    expected = json.loads(json.dumps(value, default=DefaultJSONProvider.default))
+    assert json.loads(dumps(value)) == expected
+    assert json.loads(dumps(value, indent=True)) == expected
+
+
+@pytest.mark.parametrize('dumps', BACKENDS)
+def test_unknown_type(dumps):
+    with pytest.raises(TypeError):
+        dumps(object())
+
+
+@pytest.mark.parametrize('dumps', BACKENDS)
+def test_read_only_fragments(dumps):
+    # The shared fragments from fragments.py are MappingProxyType and
+    # tuples.
+    value = { 'list': (MappingProxyType({ 'b': (1, 2), 'a': None }),) }
+    assert json.loads(dumps(value)) == { 'list': [ { 'a': None, 'b': [ 1, 2 ] } ] }
@@ -0,0 +1,160 @@
+import json
+
+import pytest
+from quart import jsonify
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.aio import AioKomSession
+from pylyskom.datatypes import ExtendedConfType, Membership, MembershipType, Time, UConference
+
+from httpkom import jsonbackend
+from httpkom.komserialization import to_dict
+
+
+PERS_NO = 14506
+
+
+class FakeConferences(object):
+    def __init__(self, uconfs):
+        self.uconfs = uconfs
+
+    async def get(self, conf_no):
+        if conf_no not in self.uconfs:
+            raise komerror.UndefinedConference(conf_no)
+        return self.uconfs[conf_no]
+
+
+class FakeClient(object):
+    """The parts of AioCachingPersonClient that AioKomSession and the
+    membership views use, for one logged in person.
+    """
+
+    def __init__(self, no_of_memberships, unread_confs=()):
+        self.memberships = []
+        uconfs = { PERS_NO: UConference(name=b'Oskars Testperson', conf_type=ExtendedConfType()) }
+        for position in range(no_of_memberships):
+            conf_no = 100 + position
+            time = Time(seconds=6, minutes=58, hours=15, day=30, month=10, year=113)
+            self.memberships.append(Membership(
+                position=position, last_time_read=time, conference=conf_no, priority=100,
+                added_by=PERS_NO if position % 2 else 0, added_at=time,
+                membership_type=MembershipType([ 0, int(position % 3 == 0), 0, 0, 0, 0, 0, 0 ])))
+            uconfs[conf_no] = UConference(name=('M\xf6te %d' % conf_no).encode('latin1'),
+                                          conf_type=ExtendedConfType(), highest_local_no=position)
+        self.uconferences = FakeConferences(uconfs)
+        # conf_no -> unread text numbers, in the order the server
+        # gives the conferences
+        self.unread = dict((conf_no, list(range(conf_no * 10, conf_no * 10 + conf_no % 3)))
+                           for conf_no in unread_confs)
+
+    def is_connected(self):
+        return True
+
+    def is_logged_in(self):
+        return True
+
+    async def request(self, request):
+        assert isinstance(request, requests.ReqGetUnreadConfs)
+        return list(self.unread)
+
+    async def get_memberships(self, pers_no, first, no_of_memberships, want_read_ranges):
+        return self.memberships[first:first + no_of_memberships]
+
+    async def get_membership(self, pers_no, conf_no, want_read_ranges):
+        for membership in self.memberships:
+            if membership.conference == conf_no:
+                return membership
+        raise komerror.NotMember(conf_no)
+
+    async def get_unread_texts_from_membership(self, membership):
+        return self.unread[membership.conference]
+
+
+def make_session(client):
+    ksession = AioKomSession()
+    ksession._client = client
+    return ksession
+
+
+def get(run, client, headers, path, **args):
+    async def get():
+        response = await client.get('/lyslyskom/persons/%d/memberships/%s' % (PERS_NO, path),
+                                    headers=headers, query_string=args)
+        return response.status_code, json.loads(await response.get_data())
+    return run(get())
+
+
+def jsonified(run, **kwargs):
+    """The response that jsonify (the non-streamed responses) gives."""
+    async def get():
+        return json.loads(await jsonify(**kwargs).get_data())
+    return run(get())
+
+
+@pytest.fixture(params=[ 16 * 1024, 100 ])
+def chunk_size(request, monkeypatch):
+    # Also with small chunks, so that the list is sent in many chunks.
+    monkeypatch.setattr(jsonbackend, 'STREAM_CHUNK_SIZE', request.param)
+
+
+LISTS = [
+    (0, dict()),
+    (1, dict()),
+    (500, dict()),
+    (500, dict(passive='true')),
+    (500, { 'first': '10', 'no-of-memberships': '50' }),
+    (500, { 'first': '490', 'no-of-memberships': '50' }),
+]
+
+
+@pytest.mark.parametrize('no_of_memberships, args', LISTS)
+def test_list_memberships(run, client, connect, chunk_size, no_of_memberships, args):
+    ksession = make_session(FakeClient(no_of_memberships))
+    status, body = get(run, client, connect(ksession), '', **args)
+    assert status == 200
+
+    # The same as the response before it was streamed.
+    memberships, has_more = run(ksession.get_memberships(
+        PERS_NO, int(args.get('first', 0)), int(args.get('no-of-memberships', 100)),
+        unread=False, passive='passive' in args))
+    assert body == jsonified(run, has_more=has_more, memberships=run(
+        to_dict(memberships, ksession)))
+    assert len(body['memberships']) == len(memberships) <= no_of_memberships
+
+
+@pytest.mark.parametrize('unread_confs', [ [], [ 101 ], list(range(100, 400)) ])
+def test_list_unread_memberships(run, client, connect, chunk_size, unread_confs):
+    ksession = make_session(FakeClient(500, unread_confs))
+    status, body = get(run, client, connect(ksession), '', unread='true')
+    assert status == 200
+    memberships, has_more = run(ksession.get_memberships(PERS_NO, 0, 100, unread=True))
+    assert body == jsonified(run, has_more=has_more, memberships=run(
+        to_dict(memberships, ksession)))
+    assert len(body['memberships']) == len(unread_confs)
+
+
+@pytest.mark.parametrize('unread_confs', [ [], [ 101 ], [ 102 ], list(range(100, 400)) ])
+def test_list_membership_unreads(run, client, connect, chunk_size, unread_confs):
+    ksession = make_session(FakeClient(500, unread_confs))
+    status, body = get(run, client, connect(ksession), 'unread/')
+    assert status == 200
+    membership_unreads = run(ksession.get_membership_unreads(PERS_NO))
+    assert body == jsonified(run, list=run(to_dict(membership_unreads, ksession)))
+    # Conferences without unread texts (every third) are left out.
+    assert len(body['list']) == len([ c for c in unread_confs if c % 3 != 0 ])
+
+
+def test_error_for_the_first_membership(run, client, connect):
+    kom_client = FakeClient(3)
+    del kom_client.uconferences.uconfs[101] # 100 is passive
+    status, body = get(run, client, connect(make_session(kom_client)), '')
+    assert status == 400
+    assert body['error_code'] == 9 # undefined-conference
+
+
+def test_error_for_the_first_membership_unread(run, client, connect):
+    status, body = get(run, client, connect(make_session(FakeClient(3, [ 200 ]))), 'unread/')
+    assert status == 400
+    assert body['error_code'] == 13 # not-member
+
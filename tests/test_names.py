@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import names
+from httpkom.names import NameIndex
+
+
+def make_index():
+    index = NameIndex(b'')
+    # In the server's order, which is not the sorted order.
+    index.add(14, b'Oskars Testperson', letterbox=True, hidden=False)
+    index.add(6, b'Inl\xe4gg (av) mig', letterbox=False, hidden=False)
+    index.add(12, b'Oskar Skoog', letterbox=True, hidden=False)
+    index.add(3, b'Nyheter', letterbox=False, hidden=False)
+    index.add(20, b'Hemliga nyheter', letterbox=False, hidden=True)
+    return index
+
+
+def test_lookup():
+    index = make_index()
+    assert index.lookup("oskar", True, False) == [
+        (14, "Oskars Testperson"), (12, "Oskar Skoog") ]
+    assert index.lookup("osk s", True, True) == [ (12, "Oskar Skoog") ]
+    assert index.lookup("oskar", False, True) == []
+    assert index.lookup("inlägg mig", False, True) == [ (6, "Inlägg (av) mig") ]
+
+
+def test_lookup_with_read_protected_match():
+    index = make_index()
+    # Only the server knows if the session may see it.
+    assert index.lookup("hem", False, True) is None
+    assert index.lookup("hem", True, False) == []
+
+
+def test_rename_keeps_order():
+    index = make_index()
+    assert index.rename(14, b'Oskar Testperson')
+    assert not index.rename(99, b'Oskar')
+    assert index.lookup("oskar", True, False) == [
+        (14, "Oskar Testperson"), (12, "Oskar Skoog") ]
+    index.remove(12)
+    assert index.lookup("oskar", True, False) == [ (14, "Oskar Testperson") ]
+    assert len(index) == 4
+
+
+def test_lookup_with_memberships():
+    index = make_index()
+    members = index.new_index()
+    members.add(20, b'Hemliga nyheter', letterbox=False, hidden=False)
+    members.add(30, b'Hemlig (secret) klubb', letterbox=False, hidden=False)
+    # The read protected conference is a membership, so the index can
+    # answer. The secret conference is last, it is not in the dump.
+    assert index.lookup("hem", False, True, members) == [
+        (20, "Hemliga nyheter"), (30, "Hemlig (secret) klubb") ]
+    assert index.lookup("hem", True, False, members) == []
+    assert index.lookup("nyh", False, True, members) == [ (3, "Nyheter") ]
+    assert index.lookup("hem", False, True, index.new_index()) is None
+
+
+PERS_NO = 12
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.memberships = [ 3, 20, 30 ] # conf_nos
+        self.handlers = {}
+
+    async def get_memberships(self, pers_no, first, no_of_confs, want_read_ranges=False):
+        assert pers_no == PERS_NO
+        return [ SimpleNamespace(conference=conf_no) for conf_no in self.memberships ]
+
+    async def register_async_handler(self, msg_no, handler, skip_accept_async):
+        self.handlers[msg_no] = handler
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.lookups = []
+        self.conferences = [] # conferences fetched
+        self._client = FakeClient()
+
+    async def lookup_name(self, name, want_pers, want_confs):
+        self.lookups.append(name)
+        return [ (1, "From the server") ]
+
+    async def get_current_person_no(self):
+        return PERS_NO
+
+    async def get_conference(self, conf_no, micro=True):
+        self.conferences.append(conf_no)
+        if conf_no == 20:
+            name = "Hemliga nyheter"
+        else:
+            name = "Hemlig klubb {}".format(conf_no)
+        return SimpleNamespace(name=name, type=SimpleNamespace(letterbox=False))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = SimpleNamespace(id='test')
+    monkeypatch.setitem(names._indexes, server.id, make_index())
+    return server
+
+
+@pytest.mark.parametrize('name, logged_in, from_server', [
+    ("oskar", False, False),
+    ("oskar", True, False),
+    ("#12", False, True),
+    ("#12", True, True),
+    ("hem", False, True),
+    ("hem", True, False), # a membership
+])
+def test_lookup_name(run, server, name, logged_in, from_server):
+    ksession = FakeSession()
+    matches = run(names.lookup_name(ksession, server, name, True, True, 600, logged_in))
+    assert (ksession.lookups == [ name ]) == from_server
+    assert (matches == [ (1, "From the server") ]) == from_server
+
+
+def lookup(run, ksession, server, name):
+    return run(names.lookup_name(ksession, server, name, False, True, 600, True))
+
+
+def test_member_index_is_kept_until_memberships_change(run, server):
+    ksession = FakeSession()
+    run(names.register_async_handlers(ksession, server.id))
+    assert lookup(run, ksession, server, "hem") == [
+        (20, "Hemliga nyheter"), (30, "Hemlig klubb 30") ]
+    # Public conferences are not fetched.
+    assert ksession.conferences == [ 20, 30 ]
+    assert lookup(run, ksession, server, "hemlig k") == [ (30, "Hemlig klubb 30") ]
+    assert ksession.conferences == [ 20, 30 ]
+
+    run(ksession._client.handlers[AsyncMessages.NEW_NAME](
+        SimpleNamespace(conf_no=30, new_name=b'Hemlig f\xf6rening')))
+    assert lookup(run, ksession, server, "hemlig f") == [ (30, "Hemlig förening") ]
+
+    ksession._client.memberships = [ 3, 31 ]
+    run(ksession._client.handlers[AsyncMessages.LEAVE_CONF](SimpleNamespace(conf_no=30)))
+    assert lookup(run, ksession, server, "hemlig k") == [ (31, "Hemlig klubb 31") ]
+    # Not a member of the read protected conference any more.
+    assert lookup(run, ksession, server, "hem") == [ (1, "From the server") ]
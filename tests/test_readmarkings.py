@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+
+from httpkom import readmarkings
+
+
+class FakeClient(object):
+    def __init__(self, errors=None):
+        self.errors = errors or {} # conf_no -> exception to raise
+        self.calls = [] # (conf_no, local_nos)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self, request):
+        assert isinstance(request, requests.ReqMarkAsRead)
+        conf_no, local_nos = request.args
+        self.calls.append((conf_no, list(local_nos)))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0)
+            if conf_no in self.errors:
+                raise self.errors[conf_no]
+        finally:
+            self.in_flight -= 1
+
+
+class FakeSession(object):
+    def __init__(self, client, text_stats=None):
+        self._client = client
+        self.text_stats = text_stats or {} # text_no -> [ (conf_no, loc_no) ]
+
+    async def get_text_stat(self, text_no):
+        if text_no not in self.text_stats:
+            raise komerror.NoSuchText(text_no)
+        return SimpleNamespace(misc_info=SimpleNamespace(recipient_list=[
+            SimpleNamespace(recpt=conf_no, loc_no=loc_no)
+            for conf_no, loc_no in self.text_stats[text_no] ]))
+
+
+def test_one_request_per_conference(run):
+    client = FakeClient()
+    run(readmarkings.mark_as_read_locals(FakeSession(client), { 1: [ 3, 1, 2, 1 ], 2: [ 7 ] }))
+    assert sorted(client.calls) == [ (1, [ 1, 2, 3 ]), (2, [ 7 ]) ]
+
+
+def test_split_into_requests_of_max_size(run):
+    client = FakeClient()
+    local_nos = list(range(1, 2 * readmarkings._MAX_TEXTS_PER_REQUEST + 2))
+    run(readmarkings.mark_as_read_locals(FakeSession(client), { 1: local_nos }))
+    assert [ len(local_nos) for _, local_nos in client.calls ] == [
+        readmarkings._MAX_TEXTS_PER_REQUEST, readmarkings._MAX_TEXTS_PER_REQUEST, 1 ]
+    assert sum((local_nos for _, local_nos in client.calls), []) == local_nos
+
+
+def test_pipelined_requests_are_limited(run):
+    client = FakeClient()
+    n = 3 * readmarkings._MAX_PIPELINED_REQUESTS
+    run(readmarkings.mark_as_read_locals(FakeSession(client),
+                                         dict((conf_no, [ 1 ]) for conf_no in range(1, n + 1))))
+    assert len(client.calls) == n
+    assert client.max_in_flight == readmarkings._MAX_PIPELINED_REQUESTS
+
+
+def test_not_member_is_ignored(run):
+    client = FakeClient(errors={ 1: komerror.NotMember(1) })
+    run(readmarkings.mark_as_read_locals(FakeSession(client), { 1: [ 1 ], 2: [ 2 ] }))
+    assert sorted(client.calls) == [ (1, [ 1 ]), (2, [ 2 ]) ]
+
+
+def test_errors_are_raised(run):
+    client = FakeClient(errors={ 2: komerror.UndefinedConference(2) })
+    with pytest.raises(komerror.UndefinedConference):
+        run(readmarkings.mark_as_read_locals(FakeSession(client), { 1: [ 1 ], 2: [ 2 ] }))
+
+
+def test_mark_as_read_in_all_recipients(run):
+    client = FakeClient()
+    ksession = FakeSession(client, { 100: [ (1, 10), (2, 20) ], 101: [ (1, 11) ] })
+    assert run(readmarkings.mark_as_read(ksession, [ 101, 100, 102, 100 ])) == [ 102 ]
+    assert sorted(client.calls) == [ (1, [ 10, 11 ]), (2, [ 20 ]) ]
@@ -0,0 +1,129 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import app, singleflight
+
+
+class Fetcher(object):
+    """A fetch that waits until it is released, and counts the calls."""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.released = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def fetch_concurrently(fetcher, shareable, n=3, between=None):
+    """Start n identical lookups, the first one first. between is run
+    after the first lookup has started. Returns the result (or the
+    exception) of each lookup.
+    """
+    key = ('test', 'uconference', (1,))
+
+    async def main():
+        async with app.app_context():
+            first = asyncio.create_task(
+                singleflight._fetch_once(key, 'uconference', fetcher, shareable))
+            await asyncio.sleep(0)
+            if between is not None:
+                between()
+            others = [ asyncio.create_task(
+                singleflight._fetch_once(key, 'uconference', fetcher, shareable))
+                       for _ in range(n - 1) ]
+            await asyncio.sleep(0)
+            fetcher.released.set()
+            return await asyncio.gather(first, *others, return_exceptions=True)
+
+    try:
+        return asyncio.run(main())
+    finally:
+        assert singleflight._inflight == {}
+
+
+def test_concurrent_lookups_are_shared():
+    result = SimpleNamespace(type=SimpleNamespace(secret=False))
+    fetcher = Fetcher(result)
+    assert fetch_concurrently(fetcher, lambda uconf: not uconf.type.secret) == [ result ] * 3
+    assert fetcher.calls == 1
+
+
+def test_secret_conferences_are_not_shared():
+    result = SimpleNamespace(type=SimpleNamespace(secret=True))
+    fetcher = Fetcher(result)
+    assert fetch_concurrently(fetcher, lambda uconf: not uconf.type.secret) == [ result ] * 3
+    # The waiting sessions made their own lookups.
+    assert fetcher.calls == 3
+
+
+def test_error_reaches_every_waiter():
+    error = ValueError("failed")
+    fetcher = Fetcher(error=error)
+    assert fetch_concurrently(fetcher, lambda result: True) == [ error ] * 3
+    # The lookup may only have failed for the session that made it.
+    assert fetcher.calls == 3
+
+
+def test_forgotten_lookup_is_not_shared():
+    fetcher = Fetcher(1)
+    results = fetch_concurrently(fetcher, lambda result: True, n=2,
+                                 between=lambda: singleflight.forget('test', 'uconference', 1))
+    assert results == [ 1, 1 ]
+    assert fetcher.calls == 2
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.handlers = {}
+
+    async def register_async_handler(self, msg_no, handler, skip_accept_async):
+        self.handlers[msg_no] = handler
+
+
+def text_stat(recipients=(), comment_to=(), comment_in=()):
+    return SimpleNamespace(misc_info=SimpleNamespace(
+        recipient_list=[ SimpleNamespace(recpt=conf_no) for conf_no in recipients ],
+        comment_to_list=[ SimpleNamespace(text_no=text_no) for text_no in comment_to ],
+        comment_in_list=[ SimpleNamespace(text_no=text_no) for text_no in comment_in ]))
+
+
+@pytest.mark.parametrize('msg_no, msg, forgotten', [
+    (AsyncMessages.NEW_NAME, SimpleNamespace(conf_no=1),
+     [ ('uconference', 1) ]),
+    (AsyncMessages.NEW_TEXT,
+     SimpleNamespace(text_no=100, text_stat=text_stat(recipients=[ 1 ], comment_to=[ 10 ])),
+     [ ('uconference', 1), ('textstat', 10) ]),
+    (AsyncMessages.DELETED_TEXT,
+     SimpleNamespace(text_no=10, text_stat=text_stat(recipients=[ 1 ], comment_to=[ 9 ],
+                                                     comment_in=[ 11 ])),
+     [ ('textstat', 10), ('textstat', 9), ('textstat', 11) ]),
+    (AsyncMessages.NEW_RECIPIENT, SimpleNamespace(text_no=10, conf_no=1),
+     [ ('uconference', 1), ('textstat', 10) ]),
+    (AsyncMessages.SUB_RECIPIENT, SimpleNamespace(text_no=10, conf_no=1),
+     [ ('textstat', 10) ]),
+])
+def test_async_messages_forget_lookups(run, monkeypatch, msg_no, msg, forgotten):
+    ksession = SimpleNamespace(_client=FakeClient())
+    run(singleflight.register_async_handlers(ksession, 'test'))
+
+    def key(kind, no):
+        return ('test' if kind == 'uconference' else ksession._client, kind, (no,))
+
+    inflight = {}
+    for kind in ('uconference', 'textstat'):
+        for no in (1, 2, 9, 10, 11):
+            inflight[key(kind, no)] = None
+    monkeypatch.setattr(singleflight, '_inflight', dict(inflight))
+    run(ksession._client.handlers[msg_no](msg))
+    assert set(inflight) - set(singleflight._inflight) == set(key(*k) for k in forgotten)
@@ -0,0 +1,299 @@
+import bisect
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import textmaps
+from httpkom.textmaps import BLOCK_SIZE, LocalTextMap
+
+
+def test_unknown():
+    textmap = LocalTextMap(1)
+    assert textmap.lookup(1) is None
+    assert textmap.known_range(1) is None
+
+
+def test_store_and_lookup():
+    textmap = LocalTextMap(1)
+    textmap.store(10, 20, [ (10, 100), (12, 120) ])
+    assert textmap.lookup(10) == 100
+    assert textmap.lookup(11) == 0 # doesn't exist
+    assert textmap.lookup(12) == 120
+    assert textmap.lookup(19) == 0
+    assert textmap.lookup(20) is None
+    assert textmap.lookup(9) is None
+    assert textmap.known_range(15) == (10, 20)
+    assert textmap.texts_in_range(10, 20) == [ (10, 100), (12, 120) ]
+
+
+def test_store_over_blocks():
+    textmap = LocalTextMap(1)
+    textmap.store(BLOCK_SIZE - 2, BLOCK_SIZE + 2, [ (BLOCK_SIZE - 1, 5), (BLOCK_SIZE, 6) ])
+    assert textmap.lookup(BLOCK_SIZE - 1) == 5
+    assert textmap.lookup(BLOCK_SIZE) == 6
+    # Known ranges never extend outside a block.
+    assert textmap.known_range(BLOCK_SIZE - 2) == (BLOCK_SIZE - 2, BLOCK_SIZE)
+    assert textmap.known_range(BLOCK_SIZE) == (BLOCK_SIZE, BLOCK_SIZE + 2)
+
+
+def test_store_adjacent_extends_range():
+    textmap = LocalTextMap(1)
+    textmap.store(10, 20, [ (10, 100) ])
+    textmap.store(20, 30, [ (25, 250) ])
+    assert textmap.known_range(10) == (10, 30)
+    assert textmap.texts_in_range(10, 30) == [ (10, 100), (25, 250) ]
+
+
+def test_store_overlapping_replaces_texts():
+    textmap = LocalTextMap(1)
+    textmap.store(10, 20, [ (10, 100), (15, 150) ])
+    textmap.store(12, 18, []) # 15 has been deleted
+    assert textmap.lookup(10) == 100
+    assert textmap.lookup(15) == 0
+    assert textmap.known_range(10) == (10, 20)
+
+
+def test_store_disjoint_replaces_block():
+    textmap = LocalTextMap(1)
+    textmap.store(10, 20, [ (10, 100) ])
+    textmap.store(30, 40, [ (35, 350) ])
+    assert textmap.lookup(10) is None
+    assert textmap.lookup(35) == 350
+
+
+def test_first_is_known():
+    class TextMapping(object):
+        range_begin = 5
+        range_end = 10
+        list = [ (5, 50) ]
+
+    textmap = LocalTextMap(1)
+    textmap.store_text_mapping(TextMapping(), first_is_known=True)
+    assert textmap.lookup(1) == 0
+    assert textmap.lookup(5) == 50
+
+
+def test_add_text_at_end():
+    textmap = LocalTextMap(1)
+    textmap.store(1, 10, [ (1, 10) ])
+    textmap.add_text(10, 100)
+    assert textmap.lookup(10) == 100
+    assert textmap.known_range(1) == (1, 11)
+
+
+def test_add_text_after_gap_is_ignored():
+    textmap = LocalTextMap(1)
+    textmap.store(1, 10, [ (1, 10) ])
+    textmap.add_text(12, 120)
+    assert textmap.lookup(12) is None
+    assert textmap.lookup(11) is None
+
+
+def test_add_text_first_in_next_block():
+    textmap = LocalTextMap(1)
+    textmap.store(BLOCK_SIZE - 1, BLOCK_SIZE, [ (BLOCK_SIZE - 1, 1) ])
+    textmap.add_text(BLOCK_SIZE, 2)
+    assert textmap.lookup(BLOCK_SIZE) == 2
+
+
+def test_remove_text():
+    textmap = LocalTextMap(1)
+    textmap.store(1, 10, [ (1, 10), (2, 20), (3, 30) ])
+    textmap.remove_text(20, 2)
+    textmap.remove_text(30) # local_no not known
+    textmap.remove_text(10, 2) # wrong local_no, ignored
+    assert textmap.lookup(1) == 10
+    assert textmap.lookup(2) == 0
+    assert textmap.lookup(3) == 0
+
+
+class FakeClient(object):
+    """Answers local-to-global(-reverse) requests for one conference,
+    like the LysKOM server (and benchmarks/fakekom.py).
+    """
+
+    def __init__(self, texts, highest_local_no):
+        self.local_nos = sorted(texts)
+        self.texts = texts # local_no -> text_no
+        self.highest_local_no = highest_local_no
+        self.requests = []
+        self.handlers = {}
+
+    async def register_async_handler(self, msg_no, handler, skip_accept_async):
+        self.handlers[msg_no] = handler
+
+    def _mapping(self, range_begin, range_end, later_texts_exists, local_nos):
+        return SimpleNamespace(range_begin=range_begin, range_end=range_end,
+                               later_texts_exists=later_texts_exists,
+                               list=[ (l, self.texts[l]) for l in local_nos ])
+
+    async def request(self, request):
+        self.requests.append(request)
+        conf_no, local_no, n = request.args
+        assert n <= 255
+        if isinstance(request, requests.ReqLocalToGlobal):
+            if local_no == 0:
+                raise komerror.LocalTextZero()
+            if local_no > self.highest_local_no:
+                raise komerror.NoSuchLocalText(local_no)
+            i = bisect.bisect_left(self.local_nos, local_no)
+            local_nos = self.local_nos[i:i + n]
+            if i + n < len(self.local_nos):
+                return self._mapping(local_no, self.local_nos[i + n], 1, local_nos)
+            return self._mapping(local_no, self.highest_local_no + 1, 0, local_nos)
+        else:
+            assert isinstance(request, requests.ReqLocalToGlobalReverse)
+            if local_no == 0 or local_no > self.highest_local_no + 1:
+                local_no = self.highest_local_no + 1
+            i = bisect.bisect_left(self.local_nos, local_no)
+            start = max(0, i - n)
+            local_nos = self.local_nos[start:i]
+            if start > 0:
+                return self._mapping(local_nos[0], local_no, 1, local_nos)
+            return self._mapping(1, local_no, 0, local_nos)
+
+
+class FakeSession(object):
+    def __init__(self, client, rd_prot=False):
+        self._client = client
+        self.rd_prot = rd_prot
+
+    async def get_conference(self, conf_no, micro=True):
+        return SimpleNamespace(highest_local_no=self._client.highest_local_no,
+                               type=SimpleNamespace(rd_prot=self.rd_prot, secret=False))
+
+
+# Sparse texts in four blocks: a few early texts, a gap of more than
+# one request over the first block boundary, every third local text
+# number in the second block and dense texts over the third block
+# boundary. The last local text numbers don't exist (deleted).
+TEXTS = dict((local_no, 1000 + local_no) for local_no in
+             [ 1, 2, 5, 40 ] +
+             list(range(BLOCK_SIZE + 300, 2 * BLOCK_SIZE, 3)) +
+             list(range(3 * BLOCK_SIZE - 400, 3 * BLOCK_SIZE + 300)))
+HIGHEST = 3 * BLOCK_SIZE + 310
+
+
+def expected(local_no, no_of_texts, backwards):
+    local_nos = sorted(TEXTS)
+    if backwards:
+        if local_no is not None:
+            local_nos = [ l for l in local_nos if l <= local_no ]
+        page = local_nos[-no_of_texts:] if no_of_texts > 0 else []
+        has_more = len(local_nos) > no_of_texts
+    else:
+        if local_no is not None:
+            local_nos = [ l for l in local_nos if l >= local_no ]
+        page = local_nos[:no_of_texts]
+        has_more = len(local_nos) > no_of_texts
+    return [ (l, TEXTS[l]) for l in page ], has_more
+
+
+@pytest.fixture
+def maps(monkeypatch):
+    monkeypatch.setattr(textmaps, '_maps', OrderedDict())
+
+
+PAGES = [
+    (None, 10), (None, 1000), (None, 5000),
+    (HIGHEST + 5, 3), (3 * BLOCK_SIZE, 600), (3 * BLOCK_SIZE - 401, 3),
+    (2 * BLOCK_SIZE - 1, 3), (2 * BLOCK_SIZE + 1, 2), (BLOCK_SIZE + 299, 1),
+    (BLOCK_SIZE + 300, 1), (BLOCK_SIZE, 4), (41, 2), (40, 1), (3, 2), (1, 5),
+    (1, 0), (0, 5),
+]
+
+
+@pytest.mark.parametrize('rd_prot', [ False, True ])
+@pytest.mark.parametrize('backwards', [ True, False ])
+@pytest.mark.parametrize('local_no, no_of_texts', PAGES)
+def test_local_to_global(run, maps, rd_prot, backwards, local_no, no_of_texts):
+    client = FakeClient(TEXTS, HIGHEST)
+    ksession = FakeSession(client, rd_prot)
+    result = run(textmaps.local_to_global(ksession, 'test', 1, local_no, no_of_texts, backwards))
+    assert result == expected(local_no, no_of_texts, backwards)
+
+
+@pytest.mark.parametrize('backwards', [ True, False ])
+def test_pages_in_a_row(run, maps, backwards):
+    """Page through the whole conference, each page starting next to
+    the previous one, like a client does.
+    """
+    client = FakeClient(TEXTS, HIGHEST)
+    ksession = FakeSession(client)
+    local_no = None
+    pages = []
+    while True:
+        mapping, has_more = run(textmaps.local_to_global(
+            ksession, 'test', 1, local_no, 100, backwards))
+        assert (mapping, has_more) == expected(local_no, 100, backwards)
+        pages.append(mapping)
+        if not has_more:
+            break
+        local_no = mapping[0][0] - 1 if backwards else mapping[-1][0] + 1
+    assert len(pages) == (len(TEXTS) + 99) // 100
+    # All of it is in the map now, so a second pass makes no requests.
+    n = len(client.requests)
+    run(textmaps.local_to_global(ksession, 'test', 1, None, len(TEXTS), backwards))
+    assert len(client.requests) == n
+
+
+def test_read_protected_conferences_are_not_cached(run, maps):
+    client = FakeClient(TEXTS, HIGHEST)
+    ksession = FakeSession(client, rd_prot=True)
+    run(textmaps.local_to_global(ksession, 'test', 1, None, 10, True))
+    run(textmaps.local_to_global(ksession, 'test', 1, None, 10, True))
+    assert len(client.requests) == 2
+    assert textmaps._maps == {}
+
+
+class LongRangeClient(FakeClient):
+    """A server that reports ranges that end after the highest local
+    text number it knows of.
+    """
+
+    def _mapping(self, range_begin, range_end, later_texts_exists, local_nos):
+        if range_end == self.highest_local_no + 1:
+            range_end += 50
+        return FakeClient._mapping(self, range_begin, range_end, later_texts_exists, local_nos)
+
+
+def test_store_text_mapping_stops_at_highest():
+    textmap = LocalTextMap(1)
+    textmap.store_text_mapping(SimpleNamespace(range_begin=5, range_end=100,
+                                               list=[ (5, 50), (20, 200) ]),
+                               highest_local_no=9)
+    assert textmap.known_range(5) == (5, 10)
+    assert textmap.lookup(9) == 0
+    assert textmap.lookup(10) is None
+    assert textmap.lookup(20) is None
+
+
+@pytest.mark.parametrize('backwards', [ True, False ])
+def test_range_end_after_highest_is_not_stored(run, maps, backwards):
+    texts = dict((local_no, 1000 + local_no) for local_no in range(1, 11))
+    client = LongRangeClient(texts, 10)
+    ksession = FakeSession(client)
+    result = run(textmaps.local_to_global(ksession, 'test', 1, None, 20, backwards))
+    assert result == (sorted(texts.items()), False)
+    textmap = textmaps._maps[('test', 1)]
+    assert textmap.known_range(1) == (1, 11)
+    assert textmap.lookup(11) is None
+
+    # A new text after the highest is added to the map, and found
+    # without any requests.
+    run(textmaps.register_async_handlers(ksession, 'test'))
+    client.texts[11] = 1011
+    client.local_nos.append(11)
+    client.highest_local_no = 11
+    run(client.handlers[AsyncMessages.NEW_TEXT](SimpleNamespace(
+        text_no=1011, text_stat=SimpleNamespace(misc_info=SimpleNamespace(
+            recipient_list=[ SimpleNamespace(recpt=1, loc_no=11) ])))))
+    n = len(client.requests)
+    mapping, has_more = run(textmaps.local_to_global(ksession, 'test', 1, None, 20, backwards))
+    assert mapping[-1] == (11, 1011)
+    assert len(client.requests) == n
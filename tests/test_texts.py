@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom.komsession import KomPersonName
+
+from httpkom import texts
+from httpkom.komserialization import to_dict
+
+
+TEXT_NO = 100
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.calls = []
+        self.text_stat = SimpleNamespace(
+            author=5, aux_items=[], creation_time=None, no_of_marks=0,
+            misc_info=SimpleNamespace(recipient_list=[], comment_to_list=[], comment_in_list=[]))
+
+    async def get_text(self, text_no):
+        self.calls.append('get_text')
+        return SimpleNamespace(text_no=text_no, subject="Subject", body="Body")
+
+    async def get_text_stat(self, text_no):
+        self.calls.append('get_text_stat')
+        return self.text_stat
+
+    async def get_person_name(self, pers_no):
+        self.calls.append('get_person_name')
+        return KomPersonName(pers_no, "Person")
+
+
+@pytest.mark.parametrize('fields, calls', [
+    (None, [ 'get_text' ]),
+    (frozenset([ 'text_no', 'body' ]), [ 'get_text' ]),
+    (frozenset([ 'subject' ]), [ 'get_text' ]),
+    (frozenset([ 'text_no', 'creation_time' ]), [ 'get_text_stat' ]),
+    (frozenset([ 'text_no', 'author' ]), [ 'get_text_stat', 'get_person_name' ]),
+])
+def test_get_text_only_fetches_the_text_if_wanted(run, fields, calls):
+    ksession = FakeSession()
+    text = run(texts.get_text(ksession, TEXT_NO, fields))
+    assert ksession.calls == calls
+    assert text.text_no == TEXT_NO
+
+
+def test_text_without_body(run):
+    ksession = FakeSession()
+    fields = frozenset([ 'text_no', 'author', 'recipient_list' ])
+    text = run(texts.get_text(ksession, TEXT_NO, fields))
+    assert run(to_dict(text, ksession, fields)) == dict(
+        text_no=TEXT_NO, author=dict(pers_no=5, pers_name="Person"), recipient_list=())
+    assert 'get_text' not in ksession.calls
@@ -0,0 +1,198 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import pylyskom.errors as komerror
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komsession import KomMembershipUnread
+
+from httpkom import app, unreads
+from httpkom.unreads import InvalidVersion, UnreadTracker
+
+
+PERS_NO = 5
+
+
+class FakeClient(object):
+    def __init__(self, unread):
+        self.unread = unread # conf_no -> list of unread text numbers
+        self.passive = set()
+        self.handlers = {}
+        self.fetches = []
+        self.lookups = []
+
+    async def get_membership(self, pers_no, conf_no, want_read_ranges=False):
+        self.lookups.append(conf_no)
+        if conf_no not in self.unread:
+            raise komerror.NotMember(conf_no)
+        self.fetches.append(conf_no)
+        return SimpleNamespace(conference=conf_no,
+                               type=SimpleNamespace(passive=conf_no in self.passive))
+
+    async def get_unread_texts_from_membership(self, membership):
+        return list(self.unread[membership.conference])
+
+    async def register_async_handler(self, msg_no, handler, skip_accept_async):
+        self.handlers[msg_no] = handler
+
+
+class FakeSession(object):
+    """The parts of AioKomSession that the tracker uses."""
+
+    def __init__(self, unread):
+        self._client = FakeClient(unread)
+        self.builds = 0
+
+    async def get_membership_unreads(self, pers_no):
+        self.builds += 1
+        return [ KomMembershipUnread(pers_no, conf_no, len(texts), list(texts))
+                 for conf_no, texts in self._client.unread.items() if len(texts) > 0 ]
+
+
+def unread_by_conf(membership_unreads):
+    return dict((mu.conf_no, mu.unread_texts) for mu in membership_unreads)
+
+
+def test_build(run):
+    ksession = FakeSession({ 1: [ 30, 10, 20 ], 2: [], 3: [ 40 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == {
+        1: [ 10, 20, 30 ], 3: [ 40 ] }
+    # Built once, until it is too old.
+    run(tracker.get_membership_unreads(ksession))
+    assert ksession.builds == 1
+
+
+def test_rebuilt_when_too_old(run):
+    ksession = FakeSession({ 1: [ 10 ] })
+    tracker = UnreadTracker(PERS_NO, 0)
+    run(tracker.get_membership_unreads(ksession))
+    tracker.built_at -= 1
+    run(tracker.get_membership_unreads(ksession))
+    assert ksession.builds == 2
+
+
+def test_add_and_remove_text(run):
+    ksession = FakeSession({ 1: [ 10, 30 ], 2: [ 10 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    run(tracker.get_membership_unreads(ksession))
+    tracker.add_text(1, 20)
+    tracker.add_text(1, 20) # already unread
+    assert list(run(tracker.get_membership_unread(ksession, 1)).unread_texts) == [ 10, 20, 30 ]
+    tracker.remove_text(10) # in all conferences
+    tracker.remove_text(30, 1)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == { 1: [ 20 ] }
+
+
+def test_add_text_to_unknown_conference_marks_it_stale(run):
+    ksession = FakeSession({ 1: [ 10 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    run(tracker.get_membership_unreads(ksession))
+    # A membership without unread texts when the tracker was built.
+    ksession._client.unread[2] = [ 50 ]
+    tracker.add_text(2, 50)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == {
+        1: [ 10 ], 2: [ 50 ] }
+    assert ksession._client.fetches == [ 2 ]
+
+
+def test_new_texts_in_other_conferences_are_ignored(run):
+    ksession = FakeSession({ 1: [ 10 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    run(tracker.get_membership_unreads(ksession))
+    tracker.add_text(2, 50)
+    run(tracker.get_membership_unreads(ksession))
+    tracker.add_text(2, 51)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == { 1: [ 10 ] }
+    # Only asked once if the person is a member.
+    assert ksession._client.lookups == [ 2 ]
+    # Until the person becomes a member.
+    ksession._client.unread[2] = [ 50, 51, 52 ]
+    tracker.membership_changed(2)
+    tracker.add_text(2, 52)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == {
+        1: [ 10 ], 2: [ 50, 51, 52 ] }
+    assert ksession._client.lookups == [ 2, 2 ]
+
+
+def test_passive_memberships_are_not_listed(run):
+    ksession = FakeSession({ 1: [ 10 ], 2: [] })
+    ksession._client.passive.add(2)
+    tracker = UnreadTracker(PERS_NO, 600)
+    run(tracker.get_membership_unreads(ksession))
+    ksession._client.unread[2] = [ 20 ]
+    tracker.membership_changed(2)
+    assert unread_by_conf(run(tracker.get_membership_unreads(ksession))) == { 1: [ 10 ] }
+    assert run(tracker.get_membership_unread(ksession, 2)).unread_texts == [ 20 ]
+
+
+def test_not_a_member(run):
+    ksession = FakeSession({ 1: [ 10 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    with pytest.raises(komerror.NotMember):
+        run(tracker.get_membership_unread(ksession, 2))
+
+
+def test_changes(run):
+    ksession = FakeSession({ 1: [ 10 ], 2: [ 20 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    token, _, _ = run(tracker.get_changes(ksession, "x.0"))
+    tracker.add_text(1, 11)
+    tracker.membership_changed(3)
+    token2, membership_changes, unread_changes = run(tracker.get_changes(ksession, token))
+    assert membership_changes == [ 3 ]
+    assert [ (mu.conf_no, mu.unread_texts) for mu in unread_changes ] == [ (1, [ 10, 11 ]) ]
+    # Nothing has changed since.
+    assert run(tracker.get_changes(ksession, token2))[1:] == ([], [])
+    # A token from another tracker.
+    assert run(tracker.get_changes(ksession, "other.1"))[1:] == (None, None)
+    with pytest.raises(InvalidVersion):
+        run(tracker.get_changes(ksession, "bad"))
+
+
+def test_stop_tracking_cancels_build():
+    ksession = FakeSession({ 1: [ 10 ] })
+
+    async def main():
+        started = asyncio.Event()
+
+        async def get_membership_unreads(pers_no):
+            started.set()
+            await asyncio.sleep(10)
+
+        ksession.get_membership_unreads = get_membership_unreads
+        async with app.app_context():
+            unreads.start_tracking(ksession, PERS_NO)
+        task = unreads.get_tracker(ksession)._build_task
+        await started.wait()
+        unreads.stop_tracking(ksession)
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert unreads.get_tracker(ksession) is None
+
+    asyncio.run(main())
+
+
+def test_own_new_texts_are_not_unread(run):
+    ksession = FakeSession({ 1: [ 10 ] })
+
+    def new_text(text_no, author):
+        stat = SimpleNamespace(author=author, misc_info=SimpleNamespace(
+            recipient_list=[ SimpleNamespace(recpt=1) ]))
+        msg = SimpleNamespace(text_no=text_no, text_stat=stat)
+        return ksession._client.handlers[AsyncMessages.NEW_TEXT](msg)
+
+    async def main():
+        await unreads.register_async_handlers(ksession)
+        tracker = UnreadTracker(PERS_NO, 600)
+        unreads._trackers[ksession] = tracker
+        await tracker.get_membership_unreads(ksession)
+        await new_text(11, PERS_NO)
+        await new_text(12, PERS_NO + 1)
+        return await tracker.get_membership_unread(ksession, 1)
+
+    try:
+        assert run(main()).unread_texts == [ 10, 12 ]
+    finally:
+        unreads.stop_tracking(ksession)
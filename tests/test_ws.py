@@ -0,0 +1,106 @@
+import weakref
+from types import SimpleNamespace
+
+import pytest
+
+from pylyskom.komsession import KomMembershipUnread
+
+from httpkom import names, unreads, ws
+from httpkom.unreads import UnreadTracker
+
+
+PERS_NO = 5
+
+
+class FakeClient(object):
+    def __init__(self, unread):
+        self.unread = unread # conf_no -> list of unread text numbers
+        self.fetches = []
+
+    async def get_membership(self, pers_no, conf_no, want_read_ranges=False):
+        self.fetches.append(conf_no)
+        return SimpleNamespace(conference=conf_no, type=SimpleNamespace(passive=False))
+
+    async def get_unread_texts_from_membership(self, membership):
+        return list(self.unread[membership.conference])
+
+
+class FakeSession(object):
+    def __init__(self, unread):
+        self._client = FakeClient(unread)
+        self.builds = 0
+
+    async def get_membership_unreads(self, pers_no):
+        self.builds += 1
+        return [ KomMembershipUnread(pers_no, conf_no, len(texts), list(texts))
+                 for conf_no, texts in self._client.unread.items() ]
+
+
+@pytest.fixture
+def tracked(run, monkeypatch):
+    """A session with a built unread tracker for PERS_NO."""
+    monkeypatch.setattr(unreads, '_trackers', weakref.WeakKeyDictionary())
+    ksession = FakeSession({ 1: [ 10, 11 ], 2: [ 20 ] })
+    tracker = UnreadTracker(PERS_NO, 600)
+    unreads._trackers[ksession] = tracker
+    run(tracker.get_membership_unreads(ksession))
+    return ksession, tracker
+
+
+def unread_after(run, ksession, tracker, request):
+    """Tell ws that request has been made, and return the unread
+    texts that the tracker gives after it.
+    """
+    ws._raw_request_made(ksession, request)
+    result = run(tracker.get_membership_unreads(ksession))
+    return dict((mu.conf_no, mu.unread_texts) for mu in result)
+
+
+@pytest.mark.parametrize('request_', [
+    '27 1 1 { 1 }', # mark-as-read
+    '77 1 11', # set-last-read
+    '110 1 1 { 1 11 }', # set-read-ranges
+    '40 1 0', # set-unread
+])
+def test_read_marking_makes_conference_stale(run, tracked, request_):
+    ksession, tracker = tracked
+    ksession._client.unread[1] = []
+    assert unread_after(run, ksession, tracker, request_) == { 2: [ 20 ] }
+    assert ksession._client.fetches == [ 1 ]
+    assert ksession.builds == 1
+
+
+@pytest.mark.parametrize('request_, conf_no', [
+    ('100 3 %d 100 0 00000000' % PERS_NO, 3), # add-member
+    ('15 2 %d' % PERS_NO, 2), # sub-member
+    ('102 %d 2 10000000' % PERS_NO, 2), # set-membership-type
+])
+def test_membership_change_makes_conference_stale(run, tracked, monkeypatch, request_, conf_no):
+    ksession, tracker = tracked
+    changed = []
+    monkeypatch.setattr(names, 'membership_changed', changed.append)
+    ksession._client.unread[conf_no] = [ 30 ]
+    assert unread_after(run, ksession, tracker, request_)[conf_no] == [ 30 ]
+    assert ksession._client.fetches == [ conf_no ]
+    assert changed == [ ksession ]
+
+
+def test_membership_of_another_person(run, tracked):
+    ksession, tracker = tracked
+    unread_after(run, ksession, tracker, '100 3 %d 100 0 00000000' % (PERS_NO + 1))
+    assert ksession._client.fetches == []
+
+
+def test_unknown_conference_rebuilds(run, tracked):
+    ksession, tracker = tracked
+    ksession._client.unread[1] = []
+    assert unread_after(run, ksession, tracker, '27 conference 1 { 1 }') == { 2: [ 20 ] }
+    assert ksession.builds == 2
+
+
+@pytest.mark.parametrize('request_', [ '', 'x', '62 0', '9 1 2' ])
+def test_other_requests_change_nothing(run, tracked, request_):
+    ksession, tracker = tracked
+    unread_after(run, ksession, tracker, request_)
+    assert ksession._client.fetches == []
+    assert ksession.builds == 1